@@ -0,0 +1,816 @@
+#!/usr/bin/env python3
+
+'''
+Reads and updates the structure of Matroska files without remuxing them
+'''
+
+import os
+import io
+import math
+import random
+import struct
+import datetime
+import zlib
+
+#EBML ids of the Matroska elements that are read or written
+element_ids = {
+'EBML' : 0x1A45DFA3,
+'Segment' : 0x18538067,
+'SeekHead' : 0x114D9B74,
+'Seek' : 0x4DBB,
+'SeekID' : 0x53AB,
+'SeekPosition' : 0x53AC,
+'Void' : 0xEC,
+'CRC-32' : 0xBF,
+'Cluster' : 0x1F43B675,
+'Info' : 0x1549A966,
+'TimestampScale' : 0x2AD7B1,
+'Duration' : 0x4489,
+'DateUTC' : 0x4461,
+'Title' : 0x7BA9,
+'Tracks' : 0x1654AE6B,
+'TrackEntry' : 0xAE,
+'TrackUID' : 0x73C5,
+'TrackType' : 0x83,
+'Name' : 0x536E,
+'Language' : 0x22B59C,
+'LanguageBCP47' : 0x22B59D,
+'CodecID' : 0x86,
+'CodecPrivate' : 0x63A2,
+'DefaultDuration' : 0x23E383,
+'Video' : 0xE0,
+'PixelWidth' : 0xB0,
+'PixelHeight' : 0xBA,
+'DisplayWidth' : 0x54B0,
+'DisplayHeight' : 0x54BA,
+'DisplayUnit' : 0x54B2,
+'Colour' : 0x55B0,
+'MatrixCoefficients' : 0x55B1,
+'Range' : 0x55B9,
+'TransferCharacteristics' : 0x55BA,
+'Primaries' : 0x55BB,
+'Audio' : 0xE1,
+'SamplingFrequency' : 0xB5,
+'Channels' : 0x9F,
+'BitDepth' : 0x6264,
+'Tags' : 0x1254C367,
+'Tag' : 0x7373,
+'Targets' : 0x63C0,
+'TagTrackUID' : 0x63C5,
+'TagChapterUID' : 0x63C4,
+'TagAttachmentUID' : 0x63C6,
+'SimpleTag' : 0x67C8,
+'TagName' : 0x45A3,
+'TagString' : 0x4487,
+'TagLanguage' : 0x447A,
+'TagDefault' : 0x4484,
+'Attachments' : 0x1941A469,
+'AttachedFile' : 0x61A7,
+'FileDescription' : 0x467E,
+'FileName' : 0x466E,
+'FileMimeType' : 0x4660,
+'FileData' : 0x465C,
+'FileUID' : 0x46AE
+}
+element_names = {element_id : name for name, element_id in element_ids.items()}
+
+#how the data of each element that is read is decoded. Elements not listed here are skipped when reading
+element_types = {
+'SeekHead' : 'master', 'Seek' : 'master', 'SeekID' : 'binary', 'SeekPosition' : 'uint',
+'Info' : 'master', 'TimestampScale' : 'uint', 'Duration' : 'float', 'DateUTC' : 'int', 'Title' : 'string',
+'Tracks' : 'master', 'TrackEntry' : 'master', 'TrackUID' : 'uint', 'TrackType' : 'uint', 'Name' : 'string',
+'Language' : 'string', 'LanguageBCP47' : 'string', 'CodecID' : 'string', 'CodecPrivate' : 'binary', 'DefaultDuration' : 'uint',
+'Video' : 'master', 'PixelWidth' : 'uint', 'PixelHeight' : 'uint', 'DisplayWidth' : 'uint', 'DisplayHeight' : 'uint', 'DisplayUnit' : 'uint',
+'Colour' : 'master', 'MatrixCoefficients' : 'uint', 'Range' : 'uint', 'TransferCharacteristics' : 'uint', 'Primaries' : 'uint',
+'Audio' : 'master', 'SamplingFrequency' : 'float', 'Channels' : 'uint', 'BitDepth' : 'uint',
+'Tags' : 'master', 'Tag' : 'master', 'Targets' : 'master', 'TagTrackUID' : 'uint', 'TagChapterUID' : 'uint', 'TagAttachmentUID' : 'uint',
+'SimpleTag' : 'master', 'TagName' : 'string', 'TagString' : 'string', 'TagLanguage' : 'string', 'TagDefault' : 'uint',
+'Attachments' : 'master', 'AttachedFile' : 'master', 'FileDescription' : 'string', 'FileName' : 'string', 'FileMimeType' : 'string', 'FileUID' : 'uint'
+}
+
+def read_element_id(f):
+    '''
+    Reads an element id, keeping its length marker bits as Matroska ids are written that way
+    Returns None at the end of the file
+    '''
+    first = f.read(1)
+    if not first:
+        return None
+    length = 1
+    while length <= 4 and not first[0] & (0x80 >> (length - 1)):
+        length += 1
+    if length > 4:
+        return None
+    return int.from_bytes(first + f.read(length - 1), 'big')
+
+def read_vint(f):
+    '''
+    Reads an EBML variable size integer
+    Returns the value and the number of bytes it used. The value is None for the reserved unknown size
+    '''
+    first = f.read(1)
+    if not first:
+        return None, 0
+    length = 1
+    while length <= 8 and not first[0] & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        return None, 0
+    value = first[0] & (0xFF >> length)
+    for byte in f.read(length - 1):
+        value = (value << 8) | byte
+    if value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+def encode_vint(value, length=None):
+    '''
+    Returns an EBML variable size integer using the fewest bytes, or the given number of bytes
+    Returns None if the value does not fit in that number of bytes
+    '''
+    if length is None:
+        length = 1
+        while value >= (1 << (7 * length)) - 1:
+            length += 1
+    if length > 8 or value >= (1 << (7 * length)) - 1:
+        return None
+    return ((1 << (7 * length)) | value).to_bytes(length, 'big')
+
+def encode_element_id(name):
+    element_id = element_ids[name]
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+def encode_element(name, data):
+    return encode_element_id(name) + encode_vint(len(data)) + data
+
+def encode_uint(value):
+    return value.to_bytes(max((value.bit_length() + 7) // 8, 1), 'big')
+
+def read_segment(f):
+    '''
+    Reads the EBML header and the start of the Segment
+    Returns the position of the Segment size, the size, the number of bytes used by the size and the position of the Segment data
+    Returns None if the file does not start like a Matroska file
+    '''
+    f.seek(0)
+    if read_element_id(f) != element_ids['EBML']:
+        return None
+    header_size, header_size_length = read_vint(f)
+    if header_size is None:
+        return None
+    f.seek(header_size, 1)
+    if read_element_id(f) != element_ids['Segment']:
+        return None
+    size_position = f.tell()
+    segment_size, size_length = read_vint(f)
+    return {'size position' : size_position, 'size' : segment_size, 'size length' : size_length, 'data position' : f.tell()}
+
+def top_level_elements(f, start, end):
+    '''
+    Lists the id, position, header length and data size of each element between start and end
+    Only element headers are read, the data of each element is skipped
+    '''
+    element_list = []
+    position = start
+    while position < end:
+        f.seek(position)
+        element_id = read_element_id(f)
+        data_size, size_length = read_vint(f)
+        if element_id is None or data_size is None:
+            return None
+        header_length = f.tell() - position
+        element_list.append({'id' : element_id, 'position' : position, 'header length' : header_length, 'size' : data_size})
+        position += header_length + data_size
+    if position != end:
+        return None
+    return element_list
+
+def crc32_element(content):
+    '''
+    Returns a CRC-32 element for the children of a master element that follow it
+    '''
+    return encode_element('CRC-32', struct.pack('<I', zlib.crc32(content)))
+
+def split_crc32(content):
+    '''
+    Splits the content of a master element into its CRC-32 and the children after it
+    ffmpeg writes a CRC-32 as the first child of every top level element, covering the rest of the element
+    Returns (None, content) if there is no CRC-32 and (None, None) if the CRC-32 is not 4 bytes
+    '''
+    f = io.BytesIO(content)
+    if read_element_id(f) != element_ids['CRC-32']:
+        return None, content
+    data_size, size_length = read_vint(f)
+    if data_size != 4:
+        return None, None
+    crc_end = f.tell() + data_size
+    return struct.unpack('<I', content[f.tell():crc_end])[0], content[crc_end:]
+
+def crc32_matches(content):
+    '''
+    Returns False if the content of a master element has a CRC-32 that does not match the children after it
+    '''
+    crc, children = split_crc32(content)
+    return children is not None and (crc is None or crc == zlib.crc32(children))
+
+def seek_head_layout(seek_head, void, new_seek):
+    '''
+    Returns a SeekHead with the new Seek entry added, padded with a Void element to fill the space of the old SeekHead and Void
+    If the SeekHead has a CRC-32 it is calculated again for the new entries
+    Returns None if it does not fit or the SeekHead has a CRC-32 that does not match
+    '''
+    available = seek_head['length'] + (void['header length'] + void['size'] if void else 0)
+    if not crc32_matches(seek_head['content']):
+        return None
+    crc, children = split_crc32(seek_head['content'])
+    content = children + new_seek
+    if crc is not None:
+        content = crc32_element(content) + content
+    #a Void element is at least 2 bytes, so if only 1 byte would be left the SeekHead size is written with an extra byte
+    for size_length in range(len(encode_vint(len(content))), 9):
+        seek_head_bytes = encode_element_id('SeekHead') + encode_vint(len(content), size_length) + content
+        remainder = available - len(seek_head_bytes)
+        if remainder == 0:
+            return seek_head_bytes
+        if remainder >= 2:
+            void_size_length = 1 if remainder - 2 < 127 else 8
+            return seek_head_bytes + encode_element_id('Void') + encode_vint(remainder - 1 - void_size_length, void_size_length) + bytes(remainder - 1 - void_size_length)
+    return None
+
+def append_attachment(mkv_abspath, attachment_abspath, filename, mimetype='application/octet-stream'):
+    '''
+    Adds a file as an attachment by appending an Attachments element to the end of the Matroska file
+    The first SeekHead is given an entry for the attachments, using the space of the Void element that ffmpeg leaves after it, and the Segment size is updated
+    CRC-32 elements are kept up to date, and the Attachments element gets one if the SeekHead has one
+    Once written, the SeekHead and Segment size are read back and checked. If they do not match, the file is put back the way it was
+    Returns False without changing the file if it cannot be updated in place, for example if it already has attachments or no space in the SeekHead
+    '''
+    attachment_size = os.path.getsize(attachment_abspath)
+    with open(mkv_abspath, 'r+b') as f:
+        segment = read_segment(f)
+        if not segment or segment['size'] is None:
+            return False
+        file_end = f.seek(0, 2)
+        #anything after the Segment would be lost to players if the attachments were written after it
+        if segment['data position'] + segment['size'] != file_end:
+            return False
+        element_list = top_level_elements(f, segment['data position'], file_end)
+        if not element_list or element_list[0]['id'] != element_ids['SeekHead']:
+            return False
+        if any(element['id'] == element_ids['Attachments'] for element in element_list):
+            return False
+        seek_head = element_list[0]
+        f.seek(seek_head['position'] + seek_head['header length'])
+        seek_head['content'] = f.read(seek_head['size'])
+        seek_head['length'] = seek_head['header length'] + seek_head['size']
+        void = element_list[1] if len(element_list) > 1 and element_list[1]['id'] == element_ids['Void'] else None
+
+        #positions in the SeekHead are relative to the start of the Segment data
+        new_seek = encode_element('Seek', encode_element('SeekID', encode_element_id('Attachments')) + encode_element('SeekPosition', encode_uint(file_end - segment['data position'])))
+        seek_head_bytes = seek_head_layout(seek_head, void, new_seek)
+        if not seek_head_bytes:
+            return False
+        write_crc = split_crc32(seek_head['content'])[0] is not None
+        file_uid = random.randint(1, (1 << 64) - 1)
+        attached_file_header = encode_element('FileName', filename.encode('utf-8')) + encode_element('FileMimeType', mimetype.encode('utf-8'))
+        attached_file_header += encode_element_id('FileData') + encode_vint(attachment_size)
+        attached_file_footer = encode_element('FileUID', encode_uint(file_uid))
+        attached_file_size = len(attached_file_header) + attachment_size + len(attached_file_footer)
+        attached_file_header = encode_element_id('AttachedFile') + encode_vint(attached_file_size) + attached_file_header
+        attached_file_size += len(encode_element_id('AttachedFile') + encode_vint(attached_file_size))
+        #the CRC-32 is written as a placeholder and filled in once the attached file has been copied
+        crc_placeholder = crc32_element(b'') if write_crc else b''
+        attachments_size = len(crc_placeholder) + attached_file_size
+        attachments_header = encode_element_id('Attachments') + encode_vint(attachments_size)
+        new_segment_size = encode_vint(segment['size'] + len(attachments_header) + attachments_size, segment['size length'])
+        if not new_segment_size:
+            return False
+        f.seek(seek_head['position'])
+        original_seek_head_bytes = f.read(len(seek_head_bytes))
+        f.seek(segment['size position'])
+        original_segment_size = f.read(segment['size length'])
+
+        #the attachments are written and flushed before the SeekHead and Segment size point to them
+        f.seek(file_end)
+        f.write(attachments_header + crc_placeholder + attached_file_header)
+        crc = zlib.crc32(attached_file_header)
+        with open(attachment_abspath, 'rb') as attachment:
+            for buf in iter(lambda: attachment.read(1024 * 1024), b''):
+                f.write(buf)
+                crc = zlib.crc32(buf, crc)
+        f.write(attached_file_footer)
+        if write_crc:
+            f.seek(file_end + len(attachments_header))
+            f.write(encode_element('CRC-32', struct.pack('<I', zlib.crc32(attached_file_footer, crc))))
+        f.flush()
+        os.fsync(f.fileno())
+        f.seek(seek_head['position'])
+        f.write(seek_head_bytes)
+        f.seek(segment['size position'])
+        f.write(new_segment_size)
+        f.flush()
+        os.fsync(f.fileno())
+
+        #read the updated file back before reporting success, since it is a preservation master
+        if not check_appended_attachment(f, seek_head['position'], len(seek_head_bytes), new_seek, file_end):
+            f.seek(seek_head['position'])
+            f.write(original_seek_head_bytes)
+            f.seek(segment['size position'])
+            f.write(original_segment_size)
+            f.truncate(file_end)
+            f.flush()
+            os.fsync(f.fileno())
+            return False
+    return True
+
+def check_appended_attachment(f, seek_head_position, seek_head_length, new_seek, attachments_position):
+    '''
+    Checks a file updated by append_attachment: the Segment ends at the end of the file, the SeekHead has the new entry
+    and every top level element from the SeekHead to the Attachments has a matching CRC-32 if it has one
+    '''
+    segment = read_segment(f)
+    file_end = f.seek(0, 2)
+    if not segment or segment['size'] is None or segment['data position'] + segment['size'] != file_end:
+        return False
+    element_list = top_level_elements(f, segment['data position'], file_end)
+    if not element_list or element_list[0]['position'] != seek_head_position or element_list[0]['id'] != element_ids['SeekHead']:
+        return False
+    #the rewritten SeekHead and its Void must end where the next element starts
+    if not any(element['position'] == seek_head_position + seek_head_length for element in element_list):
+        return False
+    if element_list[-1]['id'] != element_ids['Attachments'] or element_list[-1]['position'] != attachments_position:
+        return False
+    for element in (element_list[0], element_list[-1]):
+        f.seek(element['position'] + element['header length'])
+        content = f.read(element['size'])
+        if not crc32_matches(content):
+            return False
+    f.seek(element_list[0]['position'] + element_list[0]['header length'])
+    return new_seek in split_crc32(f.read(element_list[0]['size']))[1]
+
+#codecs described without ffprobe, with their ffprobe codec name, long name and codec tag
+#video codecs stored by ffmpeg with a BITMAPINFOHEADER are identified by its fourcc and PCM codecs by their bit depth
+native_codecs = {
+('V_MS/VFW/FOURCC', 'FFV1') : ('ffv1', 'FFmpeg video codec #1', 'FFV1'),
+'A_FLAC' : ('flac', 'FLAC (Free Lossless Audio Codec)', '[0][0][0][0]'),
+('A_PCM/INT/LIT', 16) : ('pcm_s16le', 'PCM signed 16-bit little-endian', '[0][0][0][0]'),
+('A_PCM/INT/LIT', 24) : ('pcm_s24le', 'PCM signed 24-bit little-endian', '[0][0][0][0]'),
+('A_PCM/INT/LIT', 32) : ('pcm_s32le', 'PCM signed 32-bit little-endian', '[0][0][0][0]'),
+('A_PCM/INT/BIG', 16) : ('pcm_s16be', 'PCM signed 16-bit big-endian', '[0][0][0][0]'),
+('A_PCM/INT/BIG', 24) : ('pcm_s24be', 'PCM signed 24-bit big-endian', '[0][0][0][0]'),
+('A_PCM/INT/BIG', 32) : ('pcm_s32be', 'PCM signed 32-bit big-endian', '[0][0][0][0]')
+}
+
+#ffmpeg names of the ISO/IEC 23091-4 colour values used by Matroska. Unspecified values are left out like ffprobe does
+color_space_names = {0 : 'gbr', 1 : 'bt709', 4 : 'fcc', 5 : 'bt470bg', 6 : 'smpte170m', 7 : 'smpte240m', 8 : 'ycgco', 9 : 'bt2020nc', 10 : 'bt2020c', 11 : 'smpte2085', 12 : 'chroma-derived-nc', 13 : 'chroma-derived-c', 14 : 'ictcp'}
+color_transfer_names = {1 : 'bt709', 4 : 'bt470m', 5 : 'bt470bg', 6 : 'smpte170m', 7 : 'smpte240m', 8 : 'linear', 9 : 'log100', 10 : 'log316', 11 : 'iec61966-2-4', 12 : 'bt1361e', 13 : 'iec61966-2-1', 14 : 'bt2020-10', 15 : 'bt2020-12', 16 : 'smpte2084', 17 : 'smpte428', 18 : 'arib-std-b67'}
+color_primaries_names = {1 : 'bt709', 4 : 'bt470m', 5 : 'bt470bg', 6 : 'smpte170m', 7 : 'smpte240m', 8 : 'film', 9 : 'bt2020', 10 : 'smpte428', 11 : 'smpte431', 12 : 'smpte432', 22 : 'ebu3213'}
+color_range_names = {1 : 'tv', 2 : 'pc'}
+#tag names that ffmpeg renames when it reads Matroska tags
+tag_renames = {'LEAD_PERFORMER' : 'performer', 'PART_NUMBER' : 'track'}
+
+def decode_value(data, element_type):
+    if element_type == 'uint':
+        return int.from_bytes(data, 'big')
+    if element_type == 'int':
+        return int.from_bytes(data, 'big', signed=True)
+    if element_type == 'float':
+        if len(data) == 4:
+            return struct.unpack('>f', data)[0]
+        return struct.unpack('>d', data)[0] if data else 0.0
+    if element_type == 'string':
+        return data.rstrip(b'\x00').decode('utf-8', errors='replace')
+    return data
+
+def read_children(f, end):
+    '''
+    Reads the child elements of a master element up to its end
+    Returns a list of (name, value) pairs. The value of a child master element is its own list of children
+    '''
+    children = []
+    while f.tell() < end:
+        element_id = read_element_id(f)
+        data_size, size_length = read_vint(f)
+        if element_id is None or data_size is None:
+            raise ValueError('invalid Matroska element')
+        data_end = f.tell() + data_size
+        if data_end > end:
+            raise ValueError('Matroska element is larger than its parent')
+        name = element_names.get(element_id)
+        element_type = element_types.get(name)
+        if element_type == 'master':
+            children.append((name, read_children(f, data_end)))
+        elif element_type:
+            children.append((name, decode_value(f.read(data_size), element_type)))
+        f.seek(data_end)
+    return children
+
+def read_element(f, position, name):
+    '''
+    Reads the children of the master element at a position, or returns None if that element is not there
+    '''
+    f.seek(position)
+    if read_element_id(f) != element_ids[name]:
+        return None
+    data_size, size_length = read_vint(f)
+    if data_size is None:
+        return None
+    return read_children(f, f.tell() + data_size)
+
+def child_value(children, name, default=None):
+    for child_name, value in children:
+        if child_name == name:
+            return value
+    return default
+
+def child_list(children, name):
+    return [value for child_name, value in children if child_name == name]
+
+def metadata_positions(f, segment, file_size):
+    '''
+    Returns the positions of the Info, Tracks, Tags and Attachments elements
+    They are found through the SeekHead, and by reading the element headers before the first Cluster for files without one
+    '''
+    positions = {name : [] for name in ['Info', 'Tracks', 'Tags', 'Attachments']}
+    seek_head_list = []
+    end = file_size if segment['size'] is None else min(segment['data position'] + segment['size'], file_size)
+    position = segment['data position']
+    while position < end:
+        f.seek(position)
+        element_id = read_element_id(f)
+        data_size, size_length = read_vint(f)
+        name = element_names.get(element_id)
+        if data_size is None or name == 'Cluster':
+            break
+        if name in positions:
+            positions[name].append(position)
+        elif name == 'SeekHead':
+            seek_head_list.append(position)
+        position = f.tell() + data_size
+
+    #a SeekHead can point to another SeekHead, so each one is read once until none are left
+    for seek_head_position in seek_head_list:
+        seek_head = read_element(f, seek_head_position, 'SeekHead')
+        for seek in child_list(seek_head or [], 'Seek'):
+            name = element_names.get(int.from_bytes(child_value(seek, 'SeekID', b''), 'big'))
+            if child_value(seek, 'SeekPosition') is None:
+                continue
+            seek_position = segment['data position'] + child_value(seek, 'SeekPosition')
+            if name in positions and seek_position not in positions[name]:
+                positions[name].append(seek_position)
+            elif name == 'SeekHead' and seek_position not in seek_head_list:
+                seek_head_list.append(seek_position)
+    return positions
+
+def reduce_ratio(num, den, maximum):
+    '''
+    Reduces a ratio to the closest one with a numerator and denominator no larger than maximum, the same way as ffmpeg's av_reduce
+    '''
+    a0_num, a0_den, a1_num, a1_den = 0, 1, 1, 0
+    divisor = math.gcd(num, den)
+    if divisor:
+        num //= divisor
+        den //= divisor
+    if num <= maximum and den <= maximum:
+        return num, den
+    while den:
+        x = num // den
+        next_den = num - den * x
+        a2_num = x * a1_num + a0_num
+        a2_den = x * a1_den + a0_den
+        if a2_num > maximum or a2_den > maximum:
+            if a1_num:
+                x = (maximum - a0_num) // a1_num
+            if a1_den:
+                x = min(x, (maximum - a0_den) // a1_den)
+            if den * (2 * x * a1_den + a0_den) > num * a1_den:
+                a1_num, a1_den = x * a1_num + a0_num, x * a1_den + a0_den
+            break
+        a0_num, a0_den, a1_num, a1_den = a1_num, a1_den, a2_num, a2_den
+        num, den = den, next_den
+    return a1_num, a1_den
+
+def range_coder_states():
+    '''
+    Returns the state transition tables of the range coder used for the FFV1 configuration record
+    They are built the same way as ffmpeg's ff_build_rac_states with a factor of 0.05 and a maximum state of 248
+    '''
+    one = 1 << 32
+    factor = int(0.05 * one)
+    max_p = 256 - 8
+    zero_state = [0] * 256
+    one_state = [0] * 256
+    last_p8 = 0
+    p = one // 2
+    for i in range(128):
+        p8 = (256 * p + one // 2) >> 32
+        if p8 <= last_p8:
+            p8 = last_p8 + 1
+        if last_p8 and last_p8 < 256 and p8 <= max_p:
+            one_state[last_p8] = p8
+        p += ((one - p) * factor + one // 2) >> 32
+        last_p8 = p8
+    for i in range(256 - max_p, max_p + 1):
+        if one_state[i]:
+            continue
+        p = (i * one + 128) >> 8
+        p += ((one - p) * factor + one // 2) >> 32
+        p8 = (256 * p + one // 2) >> 32
+        if p8 <= i:
+            p8 = i + 1
+        one_state[i] = min(p8, max_p)
+    for i in range(1, 255):
+        zero_state[i] = 256 - one_state[256 - i]
+    return zero_state, one_state
+
+class RangeDecoder:
+    '''
+    Decodes the symbols of an FFV1 configuration record
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.position = 2
+        self.low = int.from_bytes(data[:2], 'big')
+        self.range = 0xFF00
+        self.zero_state, self.one_state = range_coder_states()
+
+    def refill(self):
+        if self.range < 0x100:
+            self.range <<= 8
+            self.low <<= 8
+            if self.position < len(self.data):
+                self.low += self.data[self.position]
+                self.position += 1
+
+    def get_bit(self, state, index):
+        range1 = (self.range * state[index]) >> 8
+        self.range -= range1
+        if self.low < self.range:
+            state[index] = self.zero_state[state[index]]
+            self.refill()
+            return 0
+        self.low -= self.range
+        state[index] = self.one_state[state[index]]
+        self.range = range1
+        self.refill()
+        return 1
+
+    def get_symbol(self, state, signed=False):
+        if self.get_bit(state, 0):
+            return 0
+        exponent = 0
+        while self.get_bit(state, 1 + min(exponent, 9)):
+            exponent += 1
+            if exponent > 31:
+                raise ValueError('invalid FFV1 symbol')
+        value = 1
+        for i in range(exponent - 1, -1, -1):
+            value += value + self.get_bit(state, 22 + min(i, 9))
+        if signed and self.get_bit(state, 11 + min(exponent, 10)):
+            return -value
+        return value
+
+def ffv1_pix_fmt(codec_private):
+    '''
+    Returns the pixel format and bits per sample of an FFV1 stream from the start of its configuration record (FFV1 version 2 and later)
+    Returns None for layouts that are not listed here
+    '''
+    decoder = RangeDecoder(codec_private)
+    state = [128] * 32
+    version = decoder.get_symbol(state)
+    if version < 2:
+        return None
+    if version > 2:
+        decoder.get_symbol(state)
+    coder_type = decoder.get_symbol(state)
+    if coder_type > 1:
+        #custom state transitions are only used for the slices, they are read to get to the next fields
+        for i in range(1, 256):
+            decoder.get_symbol(state, True)
+    colorspace = decoder.get_symbol(state)
+    bits = decoder.get_symbol(state) or 8
+    chroma_planes = decoder.get_bit(state, 0)
+    h_shift = decoder.get_symbol(state)
+    v_shift = decoder.get_symbol(state)
+    transparency = decoder.get_bit(state, 0)
+    subsampling = {(0, 0) : '444', (0, 1) : '440', (1, 0) : '422', (1, 1) : '420', (2, 0) : '411', (2, 2) : '410'}.get((h_shift, v_shift))
+    if bits not in [8, 9, 10, 12, 14, 16]:
+        return None
+    if colorspace == 0 and not chroma_planes and not transparency:
+        pix_fmt = 'gray' if bits == 8 else 'gray' + str(bits) + 'le'
+    elif colorspace == 0 and subsampling:
+        pix_fmt = ('yuva' if transparency else 'yuv') + subsampling + 'p' + ('' if bits == 8 else str(bits) + 'le')
+    elif colorspace == 1 and bits == 8:
+        pix_fmt = 'bgra' if transparency else 'bgr0'
+    elif colorspace == 1:
+        pix_fmt = ('gbrap' if transparency else 'gbrp') + str(bits) + 'le'
+    else:
+        return None
+    return pix_fmt, bits
+
+def flac_stream_info(codec_private):
+    '''
+    Returns the sample rate, channels and bits per sample from the STREAMINFO block of a FLAC stream
+    '''
+    if codec_private[:4] != b'fLaC' or len(codec_private) < 42:
+        return None
+    info = codec_private[8:42]
+    sample_rate = (info[10] << 12) | (info[11] << 4) | (info[12] >> 4)
+    channels = ((info[12] >> 1) & 0x07) + 1
+    bits = (((info[12] & 0x01) << 4) | (info[13] >> 4)) + 1
+    return sample_rate, channels, bits
+
+def simple_tags(tag_list, prefix=''):
+    '''
+    Returns the tags of a list of SimpleTag elements with the names ffmpeg gives them
+    Nested tags are named parent/child and tags in a language other than the default one are named tag-language
+    '''
+    tags = {}
+    for simple_tag in tag_list:
+        name = child_value(simple_tag, 'TagName')
+        if not name:
+            continue
+        name = prefix + name
+        language = child_value(simple_tag, 'TagLanguage')
+        if language and (not child_value(simple_tag, 'TagDefault', 1) or language != 'und'):
+            name += '-' + language
+        if child_value(simple_tag, 'TagString') is not None:
+            tags[tag_renames.get(name, name)] = child_value(simple_tag, 'TagString')
+        tags.update(simple_tags(child_list(simple_tag, 'SimpleTag'), name + '/'))
+    return tags
+
+def track_stream(index, track):
+    '''
+    Returns the ffprobe stream metadata of a TrackEntry, or None if the track is not one this reader can describe
+    '''
+    codec_id = child_value(track, 'CodecID')
+    codec_private = child_value(track, 'CodecPrivate', b'')
+    stream = {'index' : index}
+    track_type = child_value(track, 'TrackType')
+    if track_type == 1:
+        video = child_value(track, 'Video', [])
+        if codec_id == 'V_MS/VFW/FOURCC' and len(codec_private) > 40:
+            #the codec's own extradata follows the 40 byte BITMAPINFOHEADER
+            codec_id = (codec_id, codec_private[16:20].decode('ascii', errors='replace'))
+            codec_private = codec_private[40:]
+        if codec_id not in native_codecs or not child_value(track, 'DefaultDuration'):
+            return None
+        format_bits = ffv1_pix_fmt(codec_private)
+        width = child_value(video, 'PixelWidth')
+        height = child_value(video, 'PixelHeight')
+        #ffmpeg works out the sample aspect ratio the same way for every display unit except unknown
+        if not format_bits or not width or not height or child_value(video, 'DisplayUnit', 0) > 3:
+            return None
+        if not child_value(video, 'DisplayWidth', width) or not child_value(video, 'DisplayHeight', height):
+            return None
+        codec_name, codec_long_name, codec_tag_string = native_codecs[codec_id]
+        sar_num, sar_den = reduce_ratio(height * child_value(video, 'DisplayWidth', width), width * child_value(video, 'DisplayHeight', height), 2 ** 31 - 1)
+        dar_num, dar_den = reduce_ratio(width * sar_num, height * sar_den, 1024 * 1024)
+        rate_num, rate_den = reduce_ratio(1000000000, child_value(track, 'DefaultDuration'), 30000)
+        #ffprobe works out the real frame rate from the timestamps when the default duration does not give a usual frame rate
+        if not rate_den * 5 < rate_num < rate_den * 1000:
+            return None
+        stream.update({
+        'codec_name' : codec_name,
+        'codec_long_name' : codec_long_name,
+        'codec_type' : 'video',
+        'codec_tag_string' : codec_tag_string,
+        'width' : width,
+        'height' : height,
+        'sample_aspect_ratio' : str(sar_num) + ':' + str(sar_den),
+        'display_aspect_ratio' : str(dar_num) + ':' + str(dar_den),
+        'pix_fmt' : format_bits[0]
+        })
+        colour = child_value(video, 'Colour', [])
+        for key, name, names in [('color_range', 'Range', color_range_names), ('color_space', 'MatrixCoefficients', color_space_names), ('color_transfer', 'TransferCharacteristics', color_transfer_names), ('color_primaries', 'Primaries', color_primaries_names)]:
+            if child_value(colour, name) in names:
+                stream[key] = names[child_value(colour, name)]
+        stream.update({
+        'r_frame_rate' : str(rate_num) + '/' + str(rate_den),
+        'avg_frame_rate' : str(rate_num) + '/' + str(rate_den),
+        'bits_per_raw_sample' : str(format_bits[1])
+        })
+    elif track_type == 2:
+        audio = child_value(track, 'Audio', [])
+        sample_rate = int(child_value(audio, 'SamplingFrequency', 8000.0))
+        channels = child_value(audio, 'Channels', 1)
+        bits = child_value(audio, 'BitDepth')
+        if codec_id == 'A_FLAC':
+            stream_info = flac_stream_info(codec_private)
+            if not stream_info:
+                return None
+            sample_rate, channels, bits = stream_info
+        else:
+            codec_id = (codec_id, bits)
+        if codec_id not in native_codecs:
+            return None
+        codec_name, codec_long_name, codec_tag_string = native_codecs[codec_id]
+        stream.update({
+        'codec_name' : codec_name,
+        'codec_long_name' : codec_long_name,
+        'codec_type' : 'audio',
+        'codec_tag_string' : codec_tag_string,
+        'sample_rate' : str(sample_rate),
+        'channels' : channels,
+        'r_frame_rate' : '0/0',
+        'avg_frame_rate' : '0/0'
+        })
+        #ffmpeg only sets the raw bits per sample of PCM that is decoded to 32 bit samples
+        if codec_name == 'flac' or bits > 16:
+            stream['bits_per_raw_sample'] = str(bits)
+    else:
+        return None
+    stream['tags'] = {}
+    if child_value(track, 'Name'):
+        stream['tags']['title'] = child_value(track, 'Name')
+    #ffmpeg reads a missing language as English and leaves out undetermined languages
+    if child_value(track, 'Language', 'eng') != 'und':
+        stream['tags']['language'] = child_value(track, 'Language', 'eng')
+    return stream
+
+def probe_metadata(input_file_abspath):
+    '''
+    Returns the stream and format metadata of a Matroska file in the layout of ffprobe -show_streams -show_format
+    Only the header, Info, Tracks, Tags and Attachments are read, so this takes milliseconds however large the file is
+    Returns None if the file has anything this reader does not describe the same way as ffprobe, so that ffprobe can be used instead
+    '''
+    try:
+        with open(input_file_abspath, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            segment = read_segment(f)
+            if not segment:
+                return None
+            positions = metadata_positions(f, segment, file_size)
+            if not positions['Info'] or not positions['Tracks']:
+                return None
+            info = read_element(f, positions['Info'][0], 'Info')
+            tracks = read_element(f, positions['Tracks'][0], 'Tracks')
+            tag_list = []
+            for position in positions['Tags']:
+                tag_list.extend(child_list(read_element(f, position, 'Tags') or [], 'Tag'))
+            attached_files = []
+            for position in positions['Attachments']:
+                attached_files.extend(child_list(read_element(f, position, 'Attachments') or [], 'AttachedFile'))
+    except (OSError, ValueError, struct.error):
+        return None
+    if info is None or tracks is None or child_value(info, 'Duration') is None:
+        return None
+
+    streams = []
+    track_streams = {}
+    for track in child_list(tracks, 'TrackEntry'):
+        stream = track_stream(len(streams), track)
+        if not stream:
+            return None
+        streams.append(stream)
+        track_streams[child_value(track, 'TrackUID')] = stream
+    attachment_streams = {}
+    for attached_file in attached_files:
+        #attached images are shown by ffprobe as video streams, so only other attachments are described here
+        if child_value(attached_file, 'FileMimeType') != 'application/octet-stream':
+            return None
+        if not child_value(attached_file, 'FileName'):
+            continue
+        stream = {'index' : len(streams), 'codec_type' : 'attachment', 'codec_tag_string' : '[0][0][0][0]', 'tags' : {'filename' : child_value(attached_file, 'FileName'), 'mimetype' : 'application/octet-stream'}}
+        if child_value(attached_file, 'FileDescription'):
+            stream['tags']['title'] = child_value(attached_file, 'FileDescription')
+        streams.append(stream)
+        attachment_streams[child_value(attached_file, 'FileUID')] = stream
+
+    format_tags = {}
+    if child_value(info, 'Title'):
+        format_tags['title'] = child_value(info, 'Title')
+    if child_value(info, 'DateUTC') is not None:
+        creation_time = datetime.datetime(2001, 1, 1) + datetime.timedelta(microseconds=child_value(info, 'DateUTC') // 1000)
+        format_tags['creation_time'] = creation_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    for tag in tag_list:
+        targets = child_value(tag, 'Targets', [])
+        tags = simple_tags(child_list(tag, 'SimpleTag'))
+        if child_value(targets, 'TagTrackUID'):
+            if child_value(targets, 'TagTrackUID') in track_streams:
+                track_streams[child_value(targets, 'TagTrackUID')]['tags'].update(tags)
+        elif child_value(targets, 'TagChapterUID'):
+            continue
+        elif child_value(targets, 'TagAttachmentUID'):
+            if child_value(targets, 'TagAttachmentUID') in attachment_streams:
+                attachment_streams[child_value(targets, 'TagAttachmentUID')]['tags'].update(tags)
+        else:
+            format_tags.update(tags)
+    for stream in streams:
+        if not stream['tags']:
+            del stream['tags']
+
+    #the duration is truncated to microseconds like ffmpeg does
+    duration = int(child_value(info, 'Duration') * child_value(info, 'TimestampScale', 1000000) / 1000)
+    format_metadata = {
+    'filename' : input_file_abspath,
+    'nb_streams' : len(streams),
+    'nb_programs' : 0,
+    'format_name' : 'matroska,webm',
+    'format_long_name' : 'Matroska / WebM',
+    'duration' : '%.6f' % (duration / 1000000),
+    'size' : str(file_size)
+    }
+    if format_tags:
+        format_metadata['tags'] = format_tags
+    return {'streams' : streams, 'format' : format_metadata}
@@ -6,10 +6,15 @@ import os
 import glob
 import subprocess
 import datetime
+import time
+import traceback
+import tempfile
+import concurrent.futures
 from aja_mov2ffv1.mov2ffv1parameters import args
 from aja_mov2ffv1 import mov2ffv1supportfuncs
 from aja_mov2ffv1 import corefuncs
 from aja_mov2ffv1 import mov2ffv1passfail_checks
+from aja_mov2ffv1 import mov2ffv1tuning
 
 #TO DO: general cleanup
 
@@ -40,14 +45,42 @@ def aja_mov2ffv1_main():
     #assign input directory and output directory
     indir = corefuncs.input_check()
     outdir = corefuncs.output_check()
+    #with --scratch each file's output folder is made on scratch and moved to the output folder once the file is finished
+    stagingdir = corefuncs.scratch_check(outdir)
     #check that mixdown argument is valid if provided
     mov2ffv1supportfuncs.check_mixdown_arg()
+    #check that the number of parallel jobs is valid
+    mov2ffv1supportfuncs.check_jobs_arg()
+    #check that the checksum algorithms are supported
+    corefuncs.digests_check()
     #check that required programs are present
     if not args.skip_qcli:
         corefuncs.qcli_check()
     corefuncs.mediaconch_check()
     corefuncs.ffprobe_check()
     ffvers = corefuncs.get_ffmpeg_version()
+    #check that ffmpeg supports the encoders and filters that will be used
+    ffmpegEncoders = ['ffv1']
+    ffmpegFilters = []
+    if not args.skip_ac:
+        ffmpegEncoders += ['libx264', 'aac']
+        ffmpegFilters.append('amerge')
+    if not args.skip_spectrogram:
+        ffmpegFilters.append('showspectrumpic')
+    if args.fanout:
+        ffmpegFilters += ['fps', 'scale', 'tile']
+    corefuncs.ffmpeg_component_check(ffmpegEncoders, ffmpegFilters)
+
+    if args.tune_ffv1:
+        #tune with the first MOV file in the input folder, then exit
+        tuneList = sorted(glob.glob1(indir, "*.mov"))
+        if not tuneList:
+            print ("No MOV files found in", indir, "to tune FFV1 settings with")
+            quit()
+        mov2ffv1tuning.tune_ffv1(os.path.join(indir, tuneList[0]))
+        quit()
+    ffv1Settings = mov2ffv1tuning.ffv1_settings()
+    print ("FFV1 settings:", ', '.join(key + ' ' + str(ffv1Settings[key]) for key in ffv1Settings))
 
     #verify that mediaconch policies are present
     corefuncs.mediaconch_policy_exists(movPolicy)
@@ -73,155 +106,554 @@ def aja_mov2ffv1_main():
     "Runtime"
     ]
 
+    #bundle everything the per-file pipeline needs so that it can be handed to worker processes
+    batchDict = {
+    'indir' : indir,
+    'outdir' : outdir,
+    'stagingdir' : stagingdir,
+    'pm_identifier' : pm_identifier,
+    'ac_identifier' : ac_identifier,
+    'metadata_identifier' : metadata_identifier,
+    'pm_filename_identifier' : pm_filename_identifier,
+    'movPolicy' : movPolicy,
+    'mkvPolicy' : mkvPolicy,
+    'ffvers' : ffvers,
+    'csvDict' : csvDict,
+    'csvHeaderList' : csvHeaderList
+    }
+
     print ("***STARTING PROCESS***")
+    batchStartTime = time.time()
 
-    for movFilename in glob.glob1(indir, "*.mov"):
-        #create names that will be used in the script
-        #TO DO: handle transcoding legacy files (either need a flag that avoids appending pm to the output filename or the ability to read the desired output filename from the CSV file
-        inputAbsPath = os.path.join(indir, movFilename)
-        baseFilename = movFilename.replace('.mov','')
-        baseOutput = os.path.join(outdir, baseFilename)
-        pmOutputFolder = os.path.join(baseOutput, pm_identifier)
-        mkvBaseFilename = (baseFilename + pm_filename_identifier ) if pm_filename_identifier else (baseFilename)
-        mkvFilename = mkvBaseFilename + '.mkv'
-        outputAbsPath = os.path.join(pmOutputFolder, mkvFilename)
-        tempMasterFile = os.path.join(pmOutputFolder, baseFilename + '-tmp.mkv')
-        framemd5File = mkvBaseFilename + '.framemd5'
-        framemd5AbsPath = os.path.join(pmOutputFolder, framemd5File)
-        acOutputFolder = os.path.join(baseOutput, ac_identifier)
-        acAbsPath = os.path.join(acOutputFolder, baseFilename + '-' + ac_identifier + '.mp4')
-        metaOutputFolder = os.path.join(baseOutput, metadata_identifier)
-        jsonAbsPath = os.path.join(metaOutputFolder, baseFilename + '-' + metadata_identifier + '.json')
-        pmMD5AbsPath = os.path.join(pmOutputFolder, mkvBaseFilename + '.md5')
-        
-        #generate ffprobe metadata from input
-        input_metadata = mov2ffv1supportfuncs.ffprobe_report(movFilename, inputAbsPath)  
+    movList = glob.glob1(indir, "*.mov")
+    if args.batch_mediaconch:
+        #check every input file against the MOV policy with a single mediaconch run
+        print ("*checking", len(movList), "MOV files with mediaconch*")
+        batchDict['movMediaconchResults'] = mov2ffv1supportfuncs.mediaconch_batch_check([os.path.join(indir, movFilename) for movFilename in movList], movPolicy)
+    batchResults = []
+    if args.jobs > 1:
+        #run whole-file pipelines in a pool of worker processes
+        #each worker sends its output to its own log file so that the console only shows progress
+        logFolder = os.path.join(outdir, 'logs')
+        if not os.path.isdir(logFolder):
+            os.mkdir(logFolder)
+        print ("processing", len(movList), "files with", args.jobs, "parallel jobs")
+        print ("per-file logs will be written to", logFolder)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            #files are submitted as jobs free up so that a file only starts once there is room on scratch for it
+            #the input size is used as the expected size of a file's outputs on scratch
+            #while other files are running, the next file waits for one of them to finish instead of blocking here,
+            #as the space they take up is only released once this loop has queued their transfers
+            waitingList = list(movList)
+            futureDict = {}
+            while waitingList or futureDict:
+                while waitingList and len(futureDict) < args.jobs:
+                    movFilename = waitingList[0]
+                    if not corefuncs.wait_for_scratch_space(movFilename, os.path.getsize(os.path.join(indir, movFilename)), block=not futureDict):
+                        break
+                    waitingList.pop(0)
+                    futureDict[executor.submit(process_mov_file_logged, movFilename, batchDict, logFolder)] = movFilename
+                doneFutures, notDoneFutures = concurrent.futures.wait(futureDict, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in doneFutures:
+                    movFilename = futureDict.pop(future)
+                    try:
+                        fileResults = future.result()
+                    except (Exception, SystemExit) as e:
+                        fileResults = mov2ffv1supportfuncs.failed_file_results(movFilename, e)
+                    print ("finished", movFilename + ":", fileResults['Status'])
+                    batchResults.append(fileResults)
+                    if not args.batch_mediaconch:
+                        transfer_file_output(fileResults, batchDict)
+                    corefuncs.release_scratch_space(movFilename)
+    else:
+        for movFilename in movList:
+            corefuncs.wait_for_scratch_space(movFilename, os.path.getsize(os.path.join(indir, movFilename)))
+            fileResults = process_mov_file(movFilename, batchDict)
+            batchResults.append(fileResults)
+            if not args.batch_mediaconch:
+                transfer_file_output(fileResults, batchDict)
+            corefuncs.release_scratch_space(movFilename)
+
+    if args.batch_mediaconch:
+        finish_batch_mediaconch(batchResults, batchDict)
+        #output folders are only moved off scratch once mediaconch has checked the MKVs and the json sidecars are written
+        for fileResults in batchResults:
+            transfer_file_output(fileResults, batchDict)
+
+    if args.scratch_path:
+        transferResults = corefuncs.finish_transfers()
+        for fileResults in batchResults:
+            if fileResults['File'] in transferResults:
+                fileResults['Transfer'] = transferResults[fileResults['File']]
+
+    mov2ffv1supportfuncs.print_batch_summary(batchResults)
+    #resource usage of every tool run for the batch, including the tool checks and batch mediaconch runs
+    batchToolUsage = corefuncs.batch_command_summary([fileResults['Tool usage'] for fileResults in batchResults if fileResults.get('Tool usage')] + [corefuncs.item_command_summary('batch')])
+    corefuncs.print_command_summary(batchToolUsage)
+    if args.metrics_file:
+        timingDict = {fileResults['File'] : fileResults['Stage timings'] for fileResults in batchResults if fileResults.get('Stage timings')}
+        corefuncs.write_prometheus_metrics(args.metrics_file, 'aja_mov2ffv1', timingDict, time.time() - batchStartTime, batchToolUsage)
+
+def transfer_file_output(fileResults, batchDict):
+    '''
+    Queues the output folder of a finished file to be moved from scratch to the output folder
+    Output folders of files that did not finish are left on scratch so that the file can pick up where it left off when the batch is run again
+    '''
+    if not args.scratch_path:
+        return
+    baseFilename = fileResults['File'].replace('.mov','')
+    scratchFolder = os.path.join(batchDict['stagingdir'], baseFilename)
+    if not os.path.isdir(scratchFolder):
+        return
+    if fileResults['Status'] == 'COMPLETE':
+        corefuncs.queue_transfer(fileResults['File'], scratchFolder, os.path.join(batchDict['outdir'], baseFilename), corefuncs.journal_path(batchDict['outdir']))
+    else:
+        fileResults['Transfer'] = 'not transferred, outputs kept in ' + scratchFolder
+
+def write_json_sidecar(itemDict, stageResults):
+    '''
+    Gathers the QC results of a file and writes its json sidecar
+    '''
+    verificationDict = stageResults['lossless verification']
+    output_metadata = stageResults['output metadata']
+    #create a dictionary with the mediaconch results from the MOV and MKV files
+    mediaconchResults_dict = {
+    'MOV Mediaconch Policy': stageResults['MOV Mediaconch Policy'],
+    'MKV Implementation':  stageResults['MKV Implementation'],
+    'MKV Mediaconch Policy': stageResults['MKV Mediaconch Policy'],
+    }
+    #PASS/FAIL - check if any mediaconch results failed and append failed policies to results
+    mediaconchResults = mov2ffv1passfail_checks.parse_mediaconchResults(mediaconchResults_dict)
+    
+    #log system info
+    systemInfo = mov2ffv1supportfuncs.generate_system_log(itemDict['ffvers'], itemDict['tstime'], itemDict['tftime'])      
+    
+    #PASS/FAIL - are files lossless
+    losslessCheck = mov2ffv1passfail_checks.lossless_check(itemDict['input_metadata'], output_metadata, verificationDict['streamMD5status'], verificationDict['framemd5Status'])
+    
+    #create a dictionary containing QC results
+    qcResults = mov2ffv1supportfuncs.qc_results(itemDict['inventoryCheck'], losslessCheck, mediaconchResults)
+    
+    #create json metadata file
+    #TO DO: combine checksums into a single dictionary to reduce variables needed here
+    mov2ffv1supportfuncs.create_json(itemDict['jsonAbsPath'], systemInfo, itemDict['input_metadata'], verificationDict['mov_stream_sum'], stageResults['pm checksum'], verificationDict['mkv_stream_sum'], itemDict['baseFilename'], output_metadata, itemDict['item_csvDict'], qcResults, itemDict['stageTimings'], itemDict.get('toolUsage') or corefuncs.item_command_summary(itemDict['movFilename'], clear=False))
+    return qcResults
+
+def write_qc_log_row(itemDict, stageResults):
+    '''
+    Adds the QC results of a file to the qc log csv file
+    '''
+    qcResults = stageResults['json']
+    output_metadata = stageResults['output metadata']
+    #log access copy filename if access copy was created
+    #TO DO: verify that access copy runtime matches pm runtime?
+    if os.path.isfile(itemDict['acAbsPath']):
+        acFilename = itemDict['baseFilename'] + '-' + itemDict['ac_identifier'] + '.mp4'
+    else:
+        acFilename = "No access copy found"
         
-        #create a list of needed output folders and make them
-        if not args.skip_ac:
-            outFolders = [pmOutputFolder, acOutputFolder, metaOutputFolder]
+    #get current date for logging when QC happned
+    qcDate = str(datetime.datetime.today().strftime('%Y-%m-%d'))
+    
+    #create the list that will go in the qc log csv file
+    #should correspond to the csvHeaderList earlier in the script
+    csvWriteList = [
+    qcResults['QC']['Inventory Check'],
+    qcDate,
+    qcResults['QC']['Lossless Check'],
+    qcDate,
+    qcResults['QC']['Mediaconch Results'],
+    qcDate,
+    None,
+    None,
+    None,
+    acFilename,
+    itemDict['mkvFilename'],
+    mov2ffv1supportfuncs.convert_runtime(output_metadata['file metadata']['duration'])
+    ]
+    
+    #Add QC results to QC log csv file
+    mov2ffv1supportfuncs.write_output_csv(itemDict['outdir'], itemDict['csvHeaderList'], csvWriteList, output_metadata, qcResults)
+
+def finish_batch_mediaconch(batchResults, batchDict):
+    '''
+    Checks every MKV in the batch with one mediaconch run for the implementation check and one for the policy
+    Then writes the json sidecar and qc log row of each file
+    '''
+    pendingResults = [fileResults for fileResults in batchResults if fileResults.get('Pending')]
+    if not pendingResults:
+        return
+    print ("*checking", len(pendingResults), "MKV files with mediaconch*")
+    mkvList = [fileResults['Pending']['itemDict']['outputAbsPath'] for fileResults in pendingResults]
+    implementationResults = mov2ffv1supportfuncs.mediaconch_batch_check(mkvList)
+    policyResults = mov2ffv1supportfuncs.mediaconch_batch_check(mkvList, batchDict['mkvPolicy'])
+    for fileResults in pendingResults:
+        pendingDict = fileResults.pop('Pending')
+        itemDict = pendingDict['itemDict']
+        corefuncs.set_command_item(itemDict['movFilename'])
+        stageResults = pendingDict['stageResults']
+        stageResults['MOV Mediaconch Policy'] = batchDict['movMediaconchResults'].get(itemDict['inputAbsPath'], 'FAIL')
+        stageResults['MKV Implementation'] = implementationResults.get(itemDict['outputAbsPath'], 'FAIL')
+        stageResults['MKV Mediaconch Policy'] = policyResults.get(itemDict['outputAbsPath'], 'FAIL')
+        #the json sidecar and qc log row may already have been written by an earlier run of the batch
+        jsonJournal = corefuncs.journal_lookup(itemDict['journalAbsPath'], itemDict['movFilename'], 'json')
+        if jsonJournal:
+            stageResults['json'] = jsonJournal['result']
         else:
-            outFolders = [pmOutputFolder, metaOutputFolder]
-        mov2ffv1supportfuncs.create_transcode_output_folders(baseOutput, outFolders)
-        
-        print ("\n")
-        #get information about item from csv inventory
-        print("*checking inventory for", baseFilename + "*")
-        item_csvDict = csvDict.get(baseFilename)
-        #PASS/FAIL - was the file found in the inventory
-        inventoryCheck = mov2ffv1passfail_checks.inventory_check(item_csvDict)
-        
+            print ("*writing metadata for", itemDict['baseFilename'] + "*")
+            stageStartTime = time.time()
+            stageResults['json'] = write_json_sidecar(itemDict, stageResults)
+            itemDict['stageTimings']['json'] = corefuncs.stage_timing(stageStartTime, [], [itemDict['jsonAbsPath']])
+            corefuncs.journal_record(itemDict['journalAbsPath'], itemDict['movFilename'], 'json', [itemDict['jsonAbsPath']], stageResults['json'], timing=itemDict['stageTimings']['json'])
+        if not corefuncs.journal_lookup(itemDict['journalAbsPath'], itemDict['movFilename'], 'qc log'):
+            write_qc_log_row(itemDict, stageResults)
+            corefuncs.journal_record(itemDict['journalAbsPath'], itemDict['movFilename'], 'qc log')
+        fileResults.update(stageResults['json']['QC'])
+        fileResults['Stage timings'] = itemDict['stageTimings']
+        fileResults['Status'] = 'COMPLETE'
+        corefuncs.set_command_item('batch')
+
+def process_mov_file_logged(movFilename, batchDict, logFolder):
+    '''
+    Runs process_mov_file with stdout/stderr (including ffmpeg and other tools) sent to a per-file log
+    '''
+    logAbsPath = os.path.join(logFolder, movFilename.replace('.mov','') + '.log')
+    with mov2ffv1supportfuncs.redirect_output(logAbsPath):
+        try:
+            fileResults = process_mov_file(movFilename, batchDict)
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            fileResults = mov2ffv1supportfuncs.failed_file_results(movFilename, e)
+    fileResults['Log'] = logAbsPath
+    return fileResults
+
+def process_mov_file(movFilename, batchDict):
+    '''
+    Runs the full pipeline on a single MOV file and returns a dictionary summarizing the results
+    '''
+    indir = batchDict['indir']
+    outdir = batchDict['outdir']
+    pm_identifier = batchDict['pm_identifier']
+    ac_identifier = batchDict['ac_identifier']
+    metadata_identifier = batchDict['metadata_identifier']
+    pm_filename_identifier = batchDict['pm_filename_identifier']
+    movPolicy = batchDict['movPolicy']
+    mkvPolicy = batchDict['mkvPolicy']
+    ffvers = batchDict['ffvers']
+    csvDict = batchDict['csvDict']
+    csvHeaderList = batchDict['csvHeaderList']
+    fileStartTime = time.time()
+    #commands run for this file are counted against it
+    corefuncs.set_command_item(movFilename)
+    fileResults = {'File' : movFilename, 'Status' : 'FAIL', 'Inventory Check' : None, 'Lossless Check' : None, 'Mediaconch Results' : None}
+
+    #create names that will be used in the script
+    #TO DO: handle transcoding legacy files (either need a flag that avoids appending pm to the output filename or the ability to read the desired output filename from the CSV file
+    inputAbsPath = os.path.join(indir, movFilename)
+    baseFilename = movFilename.replace('.mov','')
+    baseOutput = os.path.join(batchDict['stagingdir'], baseFilename)
+    pmOutputFolder = os.path.join(baseOutput, pm_identifier)
+    mkvBaseFilename = (baseFilename + pm_filename_identifier ) if pm_filename_identifier else (baseFilename)
+    mkvFilename = mkvBaseFilename + '.mkv'
+    outputAbsPath = os.path.join(pmOutputFolder, mkvFilename)
+    tempMasterFile = os.path.join(pmOutputFolder, baseFilename + '-tmp.mkv')
+    framemd5File = mkvBaseFilename + '.framemd5'
+    framemd5AbsPath = os.path.join(pmOutputFolder, framemd5File)
+    acOutputFolder = os.path.join(baseOutput, ac_identifier)
+    acAbsPath = os.path.join(acOutputFolder, baseFilename + '-' + ac_identifier + '.mp4')
+    metaOutputFolder = os.path.join(baseOutput, metadata_identifier)
+    jsonAbsPath = os.path.join(metaOutputFolder, baseFilename + '-' + metadata_identifier + '.json')
+    #checksum sidecars are named after the file with the algorithm as the extension (.md5, .sha256, ...)
+    pmSidecarList = corefuncs.digest_sidecar_list(os.path.join(pmOutputFolder, mkvBaseFilename))
+    contactSheetAbsPath = os.path.join(metaOutputFolder, baseFilename + '-contactsheet.png')
+    framemd5ReportAbsPath = os.path.join(metaOutputFolder, baseFilename + '-framemd5_mismatches.txt')
+    acSidecarList = corefuncs.digest_sidecar_list(os.path.join(acOutputFolder, baseFilename + '-' + ac_identifier))
+    
+    journalAbsPath = corefuncs.journal_path(outdir)
+    if args.scratch_path:
+        #a file that an earlier run finished and moved to the output folder is not processed again
+        transferJournal = corefuncs.journal_lookup(journalAbsPath, movFilename, 'transfer')
+        if transferJournal:
+            print ("*skipping", baseFilename + ", already transferred to", transferJournal['result']['output folder'] + "*")
+            jsonJournal = corefuncs.journal_lookup(journalAbsPath, movFilename, 'json')
+            if jsonJournal:
+                fileResults.update(jsonJournal['result']['QC'])
+            fileResults['Status'] = 'COMPLETE'
+            fileResults['Runtime'] = time.time() - fileStartTime
+            fileResults['Tool usage'] = corefuncs.item_command_summary(movFilename)
+            corefuncs.set_command_item('batch')
+            return fileResults
+        if not os.path.isdir(baseOutput):
+            #stages recorded by an earlier run point at outputs that are not on scratch, so they all run again
+            corefuncs.journal_reset(journalAbsPath, movFilename)
+
+    #generate ffprobe metadata from input
+    input_metadata = mov2ffv1supportfuncs.ffprobe_report(movFilename, inputAbsPath)  
+    
+    #create a list of needed output folders and make them
+    if not args.skip_ac:
+        outFolders = [pmOutputFolder, acOutputFolder, metaOutputFolder]
+    else:
+        outFolders = [pmOutputFolder, metaOutputFolder]
+    mov2ffv1supportfuncs.create_transcode_output_folders(baseOutput, outFolders)
+    
+    print ("\n")
+    #get information about item from csv inventory
+    print("*checking inventory for", baseFilename + "*")
+    item_csvDict = csvDict.get(baseFilename)
+    #PASS/FAIL - was the file found in the inventory
+    inventoryCheck = mov2ffv1passfail_checks.inventory_check(item_csvDict)
+    
+    #losslessly transcode with ffmpeg
+    transcode_nameDict = {
+    'inputAbsPath' : inputAbsPath,
+    'tempMasterFile' : tempMasterFile,
+    'framemd5AbsPath' : framemd5AbsPath,
+    'outputAbsPath' : outputAbsPath,
+    'framemd5File' : framemd5File,
+    'acAbsPath' : acAbsPath,
+    'metaOutputFolder' : metaOutputFolder,
+    'baseFilename' : baseFilename,
+    'contactSheetAbsPath' : contactSheetAbsPath
+    }
+    audioStreamCounter = input_metadata['techMetaA']['audio stream count']
+    #the number of frames is used to report the frames per second of stages that decode the video
+    try:
+        frameRateNum, frameRateDen = input_metadata['techMetaV']['framerate'].split('/')
+        frameCount = round(float(input_metadata['file metadata']['duration']) * int(frameRateNum) / int(frameRateDen))
+    except (AttributeError, KeyError, TypeError, ValueError, ZeroDivisionError):
+        frameCount = None
+    stageTimings = {}
+    spectrogramList = [mov2ffv1supportfuncs.spectrogram_output(metaOutputFolder, baseFilename, index) for index in range(audioStreamCounter)]
+
+    #skip the transcode if the journal shows that it finished in an earlier run and the mkv is unchanged
+    transcodeJournal = corefuncs.journal_lookup(journalAbsPath, movFilename, 'transcode')
+    if transcodeJournal and not os.path.isfile(framemd5AbsPath) and not corefuncs.journal_lookup(journalAbsPath, movFilename, 'lossless verification'):
+        #the framemd5 is still needed to verify the transcode
+        transcodeJournal = None
+    if transcodeJournal:
+        print ("*skipping transcode of", baseFilename + ", found in journal*")
+        mov_stream_sum = transcodeJournal['result']['mov_stream_sum']
+        acHash = transcodeJournal['result']['acHash']
+        tstime = transcodeJournal['result']['tstime']
+        tftime = transcodeJournal['result']['tftime']
+        if transcodeJournal['timing']:
+            stageTimings['transcode'] = transcodeJournal['timing']
+    else:
+        #outputs left by a run of this batch that stopped partway through the transcode are removed so that ffmpeg can write them again
+        if corefuncs.journal_lookup(journalAbsPath, movFilename, 'transcode started'):
+            incompleteList = [outputFile for outputFile in [outputAbsPath, tempMasterFile, framemd5AbsPath, acAbsPath, contactSheetAbsPath] + spectrogramList if os.path.isfile(outputFile)]
+            if incompleteList:
+                print ("*removing outputs of an earlier run that did not finish or no longer match the journal*")
+                mov2ffv1supportfuncs.delete_files(incompleteList)
+        #every later stage depends on the mkv, so they all run again
+        corefuncs.journal_reset(journalAbsPath, movFilename)
+        corefuncs.journal_record(journalAbsPath, movFilename, 'transcode started')
+
         print ("*losslessly transcoding", baseFilename + "*")
-        
+
         #log transcode start time
         tstime = datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+        stageStartTime = time.time()
+
+        #the stream md5s of the input are created while transcoding
+        #with --fanout the access copy and spectrograms are also created while transcoding
+        mov_stream_sum, acHash = mov2ffv1supportfuncs.ffv1_lossless_transcode(input_metadata, transcode_nameDict, audioStreamCounter)
 
-        #losslessly transcode with ffmpeg
-        transcode_nameDict = {
-        'inputAbsPath' : inputAbsPath,
-        'tempMasterFile' : tempMasterFile,
-        'framemd5AbsPath' : framemd5AbsPath,
-        'outputAbsPath' : outputAbsPath,
-        'framemd5File' : framemd5File
-        }
-        audioStreamCounter = input_metadata['techMetaA']['audio stream count']
-        mov2ffv1supportfuncs.ffv1_lossless_transcode(input_metadata, transcode_nameDict, audioStreamCounter)
-        
         #log transcode finish time
         tftime = datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S')
-        
-        #If ffv1 file was succesfully created, do remaining verification and transcoding work
+        transcodeOutputList = [outputAbsPath, framemd5AbsPath]
+        if args.fanout:
+            transcodeOutputList += [acAbsPath, contactSheetAbsPath] + spectrogramList
+        stageTimings['transcode'] = corefuncs.stage_timing(stageStartTime, [inputAbsPath], transcodeOutputList, frameCount)
         if os.path.isfile(outputAbsPath):
-            #create checksum sidecar file for preservation master
-            print ("*creating checksum*")
-            mkvHash = corefuncs.hashlib_md5(outputAbsPath)
-            with open (pmMD5AbsPath, 'w',  newline='\n') as f:
-                print(mkvHash, '*' + mkvFilename, file=f)
-            
-            #compare streamMD5s
-            print ("*verifying losslessness*")
-            mov_stream_sum = mov2ffv1supportfuncs.checksum_streams(inputAbsPath, audioStreamCounter)
-            mkv_stream_sum = mov2ffv1supportfuncs.checksum_streams(outputAbsPath, audioStreamCounter)
-            #PASS/FAIL - check if input stream md5s match output stream md5s
-            streamMD5status = mov2ffv1passfail_checks.stream_md5_status(mov_stream_sum, mkv_stream_sum)
-            
-            #create a dictionary with the mediaconch results from the MOV and MKV files
-            mediaconchResults_dict = {
-            'MOV Mediaconch Policy': mov2ffv1supportfuncs.mediaconch_policy_check(inputAbsPath, movPolicy),
-            'MKV Implementation':  mov2ffv1supportfuncs.mediaconch_implementation_check(outputAbsPath),
-            'MKV Mediaconch Policy': mov2ffv1supportfuncs.mediaconch_policy_check(outputAbsPath, mkvPolicy),
-            }
-            #PASS/FAIL - check if any mediaconch results failed and append failed policies to results
-            mediaconchResults = mov2ffv1passfail_checks.parse_mediaconchResults(mediaconchResults_dict)
-            
-            #run ffprobe on the output file
-            output_metadata = mov2ffv1supportfuncs.ffprobe_report(mkvFilename, outputAbsPath)
-            #log system info
-            systemInfo = mov2ffv1supportfuncs.generate_system_log(ffvers, tstime, tftime)      
-            
-            #PASS/FAIL - are files lossless
-            losslessCheck = mov2ffv1passfail_checks.lossless_check(input_metadata, output_metadata, streamMD5status)
-            
-            #create a dictionary containing QC results
-            qcResults = mov2ffv1supportfuncs.qc_results(inventoryCheck, losslessCheck, mediaconchResults)
-            
-            #create json metadata file
-            #TO DO: combine checksums into a single dictionary to reduce variables needed here
-            mov2ffv1supportfuncs.create_json(jsonAbsPath, systemInfo, input_metadata, mov_stream_sum, mkvHash, mkv_stream_sum, baseFilename, output_metadata, item_csvDict, qcResults)
-            
-            if not args.skip_ac:
-                #create access copy
-                print ('*transcoding access copy*')
-                mov2ffv1supportfuncs.two_pass_h264_encoding(audioStreamCounter, outputAbsPath, acAbsPath)
-                
-                #create checksum sidecar file for access copy
-                acHash = corefuncs.hashlib_md5(acAbsPath)
-                with open (os.path.join(acOutputFolder, baseFilename + '-' + ac_identifier + '.md5'), 'w',  newline='\n') as f:
-                    print(acHash, '*' + baseFilename + '-' + ac_identifier + '.mp4', file=f)
-                
-            #log access copy filename if access copy was created
-            #TO DO: verify that access copy runtime matches pm runtime?
-            if os.path.isfile(acAbsPath):
-                acFilename = baseFilename + '-' + ac_identifier + '.mp4'
+            corefuncs.journal_record(journalAbsPath, movFilename, 'transcode', [outputAbsPath], {'mov_stream_sum' : mov_stream_sum, 'acHash' : acHash, 'tstime' : tstime, 'tftime' : tftime}, timing=stageTimings['transcode'])
+
+    #values needed to write the json sidecar and qc log row once the remaining stages have finished
+    itemDict = {
+    'inputAbsPath' : inputAbsPath,
+    'outputAbsPath' : outputAbsPath,
+    'baseFilename' : baseFilename,
+    'mkvFilename' : mkvFilename,
+    'acAbsPath' : acAbsPath,
+    'ac_identifier' : ac_identifier,
+    'jsonAbsPath' : jsonAbsPath,
+    'outdir' : outdir,
+    'csvHeaderList' : csvHeaderList,
+    'input_metadata' : input_metadata,
+    'item_csvDict' : item_csvDict,
+    'inventoryCheck' : inventoryCheck,
+    'ffvers' : ffvers,
+    'tstime' : tstime,
+    'tftime' : tftime,
+    'journalAbsPath' : journalAbsPath,
+    'movFilename' : movFilename,
+    'stageTimings' : stageTimings
+    }
+    
+    #If ffv1 file was succesfully created, do remaining verification and transcoding work
+    if os.path.isfile(outputAbsPath):
+        #stages that were run again instead of being skipped because of the journal
+        rerunStages = set()
+        def journaled_stage(stageName, stageFunction, dependencyList, readList, writeList, journalList, hashedOutput, stageFrameCount):
+            '''
+            Wraps a stage so that it is timed and is skipped if the journal shows that it finished and its outputs are unchanged
+            A stage is not skipped if a stage it depends on was run again
+            hashedOutput is an output whose checksums are the result of the stage
+            '''
+            def run_stage(stageResults):
+                journalEntry = corefuncs.journal_lookup(journalAbsPath, movFilename, stageName)
+                if journalEntry and hashedOutput and set(journalEntry['result'] or []) != set(corefuncs.digest_list()):
+                    #the checksums are made again when --digests has changed since the journaled run
+                    journalEntry = None
+                if journalEntry and rerunStages.intersection(dependencyList):
+                    journalEntry = None
+                if journalEntry:
+                    corefuncs.print_message("*skipping", stageName, "for", baseFilename + ", found in journal*")
+                    if journalEntry['timing']:
+                        stageTimings[stageName] = journalEntry['timing']
+                    return journalEntry['result']
+                rerunStages.add(stageName)
+                stageStartTime = time.time()
+                stageResult = stageFunction(stageResults)
+                stageTimings[stageName] = corefuncs.stage_timing(stageStartTime, readList, writeList, stageFrameCount)
+                corefuncs.journal_record(journalAbsPath, movFilename, stageName, journalList, stageResult, {hashedOutput : stageResult['md5']} if hashedOutput else {}, stageTimings[stageName])
+                return stageResult
+            return run_stage
+
+        #each remaining step is a stage that only depends on the finished MKV and the stages it lists
+        #stages run as soon as their dependencies finish, with up to --stage_jobs stages running at the same time
+        def pm_checksum_stage(stageResults):
+            if not args.hash_on_write:
+                corefuncs.print_message("*creating checksum*")
+                mkvHash = corefuncs.hashlib_digests(outputAbsPath)
             else:
-                acFilename = "No access copy found"
-                
-            #get current date for logging when QC happned
-            qcDate = str(datetime.datetime.today().strftime('%Y-%m-%d'))
-            
-            #create the list that will go in the qc log csv file
-            #should correspond to the csvHeaderList earlier in the script
-            csvWriteList = [
-            qcResults['QC']['Inventory Check'],
-            qcDate,
-            qcResults['QC']['Lossless Check'],
-            qcDate,
-            qcResults['QC']['Mediaconch Results'],
-            qcDate,
-            None,
-            None,
-            None,
-            acFilename,
-            mkvFilename,
-            mov2ffv1supportfuncs.convert_runtime(output_metadata['file metadata']['duration'])
-            ]
-            
-            #Add QC results to QC log csv file
-            mov2ffv1supportfuncs.write_output_csv(outdir, csvHeaderList, csvWriteList, output_metadata, qcResults)
+                mkvHash = stageResults['lossless verification']['mkvHash']
+                if set(mkvHash) != set(corefuncs.digest_list()):
+                    #the verification was journaled by a run that used different --digests
+                    corefuncs.print_message("*creating checksum*")
+                    mkvHash = corefuncs.hashlib_digests(outputAbsPath)
+            #create checksum sidecar files for preservation master
+            corefuncs.write_digest_sidecars(mkvHash, mkvFilename, os.path.join(pmOutputFolder, mkvBaseFilename))
+            return mkvHash
+
+        def lossless_verification_stage(stageResults):
+            if not args.hash_on_write:
+                mkv_md5 = None
+                corefuncs.print_message("*verifying losslessness*")
+            else:
+                #create the preservation master checksums from the same read that creates the stream md5s
+                mkv_md5 = corefuncs.MultiDigest()
+                corefuncs.print_message("*verifying losslessness and creating checksum*")
+            verificationDict = {'mov_stream_sum' : mov_stream_sum}
+            if not mov_stream_sum:
+                verificationDict['mov_stream_sum'] = mov2ffv1supportfuncs.checksum_streams(inputAbsPath, audioStreamCounter)
+            #decode the output once to get its stream md5s and the framemd5 to compare against the input's framemd5
+            with tempfile.TemporaryDirectory() as verifyFolder:
+                mkvFramemd5AbsPath = os.path.join(verifyFolder, framemd5File)
+                verificationDict['mkv_stream_sum'] = mov2ffv1supportfuncs.checksum_streams(outputAbsPath, audioStreamCounter, mkv_md5, mkvFramemd5AbsPath)
+                framemd5_comparison = mov2ffv1supportfuncs.compare_framemd5(framemd5AbsPath, mkvFramemd5AbsPath, framemd5ReportAbsPath)
+            if mkv_md5:
+                verificationDict['mkvHash'] = mkv_md5.hexdigests()
+            #the framemd5 was only kept for verification if it has been embedded in the mkv
+            if args.embed_framemd5:
+                mov2ffv1supportfuncs.delete_files([framemd5AbsPath])
+            #PASS/FAIL - check if the frame checksums of the input and output match
+            verificationDict['framemd5Status'] = mov2ffv1passfail_checks.framemd5_status(framemd5_comparison)
+            #PASS/FAIL - check if input stream md5s match output stream md5s
+            verificationDict['streamMD5status'] = mov2ffv1passfail_checks.stream_md5_status(verificationDict['mov_stream_sum'], verificationDict['mkv_stream_sum'])
+            return verificationDict
+
+        def access_copy_stage(stageResults):
+            #create access copy
+            acCopyHash = acHash
+            if not args.fanout:
+                corefuncs.print_message('*transcoding access copy*')
+                acCopyHash = mov2ffv1supportfuncs.two_pass_h264_encoding(audioStreamCounter, outputAbsPath, acAbsPath)
             
+            #create checksum sidecar files for access copy
+            if not acCopyHash or set(acCopyHash) != set(corefuncs.digest_list()):
+                acCopyHash = corefuncs.hashlib_digests(acAbsPath)
+            corefuncs.write_digest_sidecars(acCopyHash, baseFilename + '-' + ac_identifier + '.mp4', os.path.join(acOutputFolder, baseFilename + '-' + ac_identifier))
+            return acCopyHash
+
+        def spectrogram_stage(stageResults):
             #create spectrogram for pm audio channels
-            if audioStreamCounter > 0 and not args.skip_spectrogram:
-                print ("*generating QC spectrograms*")
-                channel_layout_list = input_metadata['techMetaA']['channels']
-                mov2ffv1supportfuncs.generate_spectrogram(outputAbsPath, channel_layout_list, metaOutputFolder, baseFilename)
-            
+            corefuncs.print_message("*generating QC spectrograms*")
+            channel_layout_list = input_metadata['techMetaA']['channels']
+            mov2ffv1supportfuncs.generate_spectrogram(outputAbsPath, channel_layout_list, metaOutputFolder, baseFilename)
+
+        def qctools_stage(stageResults):
             #create qctools report
-            if not args.skip_qcli:
-                print ("*creating qctools report*")
-                mov2ffv1supportfuncs.generate_qctools(outputAbsPath)
-            
-        else:
-            print ('No file in output folder.  Skipping file processing')
+            corefuncs.print_message("*creating qctools report*")
+            mov2ffv1supportfuncs.generate_qctools(outputAbsPath)
+
+        #stages are listed in the order they run when --stage_jobs is 1
+        stageDict = {
+        'pm checksum' : (pm_checksum_stage, ['lossless verification'] if args.hash_on_write else []),
+        'lossless verification' : (lossless_verification_stage, [])
+        }
+        if not args.batch_mediaconch:
+            stageDict['MOV Mediaconch Policy'] = (lambda stageResults: mov2ffv1supportfuncs.mediaconch_policy_check(inputAbsPath, movPolicy), [])
+            stageDict['MKV Implementation'] = (lambda stageResults: mov2ffv1supportfuncs.mediaconch_implementation_check(outputAbsPath), [])
+            stageDict['MKV Mediaconch Policy'] = (lambda stageResults: mov2ffv1supportfuncs.mediaconch_policy_check(outputAbsPath, mkvPolicy), [])
+        #run ffprobe on the output file
+        stageDict['output metadata'] = (lambda stageResults: mov2ffv1supportfuncs.ffprobe_report(mkvFilename, outputAbsPath), [])
+        if not args.batch_mediaconch:
+            stageDict['json'] = (lambda stageResults: write_json_sidecar(itemDict, stageResults), ['pm checksum', 'lossless verification', 'MOV Mediaconch Policy', 'MKV Implementation', 'MKV Mediaconch Policy', 'output metadata'])
+        if not args.skip_ac:
+            stageDict['access copy'] = (access_copy_stage, [])
+        if not args.batch_mediaconch:
+            stageDict['qc log'] = (lambda stageResults: write_qc_log_row(itemDict, stageResults), ['json', 'output metadata'] + (['access copy'] if not args.skip_ac else []))
+        if audioStreamCounter > 0 and not args.skip_spectrogram and not args.fanout:
+            stageDict['spectrograms'] = (spectrogram_stage, [])
+        if not args.skip_qcli:
+            stageDict['qctools'] = (qctools_stage, [])
+        if 'json' in stageDict:
+            #the json sidecar is written once every other stage has finished so that it includes all of their timings
+            stageDict['json'] = (stageDict['json'][0], [stageName for stageName in stageDict if stageName not in ['json', 'qc log']])
+        #for each stage: the files it reads, the files it writes, the outputs checked by the journal,
+        #the output whose checksums are the stage's result and the number of frames it decodes
+        qctoolsList = [outputAbsPath + '.qctools.mkv', outputAbsPath + '.qctools.xml.gz']
+        stageIODict = {
+        'pm checksum' : ([] if args.hash_on_write else [outputAbsPath], pmSidecarList, pmSidecarList + [outputAbsPath], outputAbsPath, None),
+        'lossless verification' : ([outputAbsPath], [], [], None, frameCount),
+        'MOV Mediaconch Policy' : ([inputAbsPath], [], [], None, None),
+        'MKV Implementation' : ([outputAbsPath], [], [], None, None),
+        'MKV Mediaconch Policy' : ([outputAbsPath], [], [], None, None),
+        'json' : ([], [jsonAbsPath], [jsonAbsPath], None, None),
+        'access copy' : ([] if args.fanout else [outputAbsPath], [acAbsPath] + acSidecarList, [acAbsPath] + acSidecarList, acAbsPath, None if args.fanout else frameCount),
+        'spectrograms' : ([outputAbsPath], spectrogramList, spectrogramList, None, None),
+        'qctools' : ([outputAbsPath], qctoolsList, qctoolsList, None, frameCount)
+        }
+        for stageName, (stageFunction, dependencyList) in stageDict.items():
+            readList, writeList, journalList, hashedOutput, stageFrameCount = stageIODict.get(stageName, ([], [], [], None, None))
+            stageDict[stageName] = (journaled_stage(stageName, stageFunction, dependencyList, readList, writeList, journalList, hashedOutput, stageFrameCount), dependencyList)
+        stageResults = corefuncs.run_stage_graph(stageDict, args.stage_jobs)
+        
+        if args.batch_mediaconch:
+            #the json sidecar and qc log row are written after the whole batch has been checked with mediaconch
+            fileResults['Status'] = 'AWAITING MEDIACONCH'
+            fileResults['Pending'] = {'itemDict' : itemDict, 'stageResults' : stageResults}
+            fileResults['Runtime'] = time.time() - fileStartTime
+            #with parallel jobs the json sidecar is written by another process, so the tool usage is saved with the file's values
+            fileResults['Tool usage'] = corefuncs.item_command_summary(movFilename)
+            itemDict['toolUsage'] = fileResults['Tool usage']
+            corefuncs.set_command_item('batch')
+            return fileResults
+        qcResults = stageResults['json']
+        
+        fileResults.update(qcResults['QC'])
+        fileResults['Stage timings'] = stageTimings
+        fileResults['Status'] = 'COMPLETE'
+    else:
+        print ('No file in output folder.  Skipping file processing')
+        fileResults['Status'] = 'NO OUTPUT'
+
+    fileResults['Runtime'] = time.time() - fileStartTime
+    fileResults['Tool usage'] = corefuncs.item_command_summary(movFilename)
+    corefuncs.set_command_item('batch')
+    return fileResults
 
 #TO DO: (low/not priority) add ability to automatically pull trim times from CSV (-ss 00:00:02 -t 02:13:52)?
 #import time
@@ -6,6 +6,7 @@ Argument parser for in-house AJA v210/mov to ffv1/mkv script
 
 import argparse
 import sys
+import os
 
 parser = argparse.ArgumentParser()
 
@@ -17,13 +18,35 @@ parser.add_argument('--qcli', action='store', dest='qcli_path', default='qcli',
 parser.add_argument('--mediaconch', action='store', dest='mediaconch_path', default='mediaconch', type=str, help='For setting a custom mediaconch path')
 parser.add_argument('--verbose', required=False, action='store_true', help='view ffmpeg output when transcoding')
 parser.add_argument('--mixdown', action='store', dest='mixdown', default='copy', type=str, help='How the audio streams will be mapped for the access copy. If excluded, this will default to copying the stream configuration of the input. Inputs include: copy, 4to3, and 4to2. 4to3 takes 4 mono tracks and mixes tracks 1&2 to stereo while leaving tracks 3&4 mono. 4to2 takes 4 mono tracks and mixes tracks 1&2 and 3&4 to stereo.')
-parser.add_argument('--slices', action='store', dest='ffv1_slice_count', default='16', choices=[4,6,9,12,16,24,30], type=int, help='Set the FFV1 slice count used by ffmpeg when losslessly transcoding files. Default is 16.')
+parser.add_argument('--slices', action='store', dest='ffv1_slice_count', choices=[4,6,9,12,16,24,30], type=int, help='Set the FFV1 slice count used by ffmpeg when losslessly transcoding files. Defaults to the slice count in the FFV1 profile made by --tune_ffv1, or 16 if this machine has not been tuned.')
+parser.add_argument('--tune_ffv1', required=False, action='store_true', dest='tune_ffv1', help='Encode the start of the first MOV file in the input folder with different FFV1 slice, thread, context and coder settings, then save the settings with the best speed and compression as the FFV1 profile for this machine and exit. Use with --jobs to tune for that many files running at the same time')
+parser.add_argument('--tune_frames', action='store', dest='tune_frames', default=300, type=int, help='Number of frames encoded for each setting by --tune_ffv1. Default is 300')
+parser.add_argument('--ffv1_profile', action='store', dest='ffv1_profile', default=os.path.join(os.path.expanduser('~'), '.config', 'transcoding_scripts', 'ffv1_profile.json'), type=str, help='File where --tune_ffv1 saves the FFV1 settings for each machine. Defaults to .config/transcoding_scripts/ffv1_profile.json in the home folder')
 parser.add_argument('--skipac', required=False, action='store_true', dest='skip_ac', help='skip access copy transcoding')
 parser.add_argument('--skipqcli', required=False, action='store_true', dest='skip_qcli', help='skip generating qc tools report')
 parser.add_argument('--skipspectrogram', required=False, action='store_true', dest='skip_spectrogram', help='skip generating spectrograms')
 parser.add_argument('--keep_filename', required=False, action='store_true', dest='keep_filename', help='MKV preservation master will have the same filename as the source MOV file')
-parser.add_argument('--embed_framemd5', required=False, action='store_true', dest='embed_framemd5', help='remux preservation file to embed framemd5')
+parser.add_argument('--embed_framemd5', required=False, action='store_true', dest='embed_framemd5', help='embed the framemd5 in the preservation file as an attachment')
+parser.add_argument('--jobs', '-j', action='store', dest='jobs', default=1, type=int, help='Number of files to process at the same time. Default is 1. When more than 1 job is used, the output of each file is written to its own log in a logs folder in the output directory')
+parser.add_argument('--stage_jobs', action='store', dest='stage_jobs', default=1, type=int, help='Number of steps that can run at the same time for each file once the FFV1 file has been created (checksums, mediaconch, access copy, spectrograms, qctools report). Default is 1')
+parser.add_argument('--batch_mediaconch', required=False, action='store_true', dest='batch_mediaconch', help='Check all files in the batch with one mediaconch run per policy instead of running mediaconch for each file. The json sidecars and qc log are written once every file has been transcoded')
 parser.add_argument('--input_policy', required=False, action='store', dest='input_policy', help='Mediaconch policy for input files')
 parser.add_argument('--output_policy', required=False, action='store', dest='output_policy', help='Mediaconch policy for output files')
+parser.add_argument('--hash_on_write', required=False, action='store_true', dest='hash_on_write', help='Create checksums without reading finished files back from disk. The MKV checksum is made while the MKV is read to verify stream checksums and the access copy is written as a fragmented MP4 through a pipe that is checksummed as it is written')
+parser.add_argument('--fanout', required=False, action='store_true', dest='fanout', help='Create the access copy, spectrograms and a contact sheet from the same decode of the input as the FFV1 transcode. The access copy is a single pass encode instead of two pass')
+parser.add_argument('--digests', action='store', dest='digests', default='md5', type=str, help='Comma separated list of checksum algorithms for the preservation and access files, for example md5,sha256,blake2b. Every checksum is made from the same read of the file and written to its own sidecar file. md5 is always included. Default is md5')
+parser.add_argument('--read_block_size', action='store', dest='read_block_size', default=4, type=int, help='Size in MiB of the blocks that files are read in when they are checksummed. Default is 4')
+parser.add_argument('--keep_page_cache', required=False, action='store_true', dest='keep_page_cache', help='Leave files that have been checksummed in the page cache. By default they are dropped from the cache as they are read so that they do not push out data that other programs are using')
+parser.add_argument('--direct_io', required=False, action='store_true', dest='direct_io', help='Read files that are checksummed with O_DIRECT (F_NOCACHE on macOS) so they do not go through the page cache at all. Falls back to normal reads on filesystems that do not support it')
+parser.add_argument('--probe_cache', action='store', dest='probe_cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'transcoding_scripts', 'ffprobe'), type=str, help='Folder where ffprobe results are cached between runs. Defaults to .cache/transcoding_scripts/ffprobe in the home folder')
+parser.add_argument('--no_probe_cache', required=False, action='store_true', dest='no_probe_cache', help='Do not read or write the ffprobe cache')
+parser.add_argument('--ffprobe_mkv', required=False, action='store_true', dest='ffprobe_mkv', help='Use ffprobe for the metadata of MKV files. By default the Matroska header, Info, Tracks, Tags and Attachments are read directly and ffprobe is only used for MKVs with codecs or layouts the reader does not handle')
+parser.add_argument('--ffprobe_mov', required=False, action='store_true', dest='ffprobe_mov', help='Use ffprobe for the metadata of MOV files. By default the moov atom is read directly and ffprobe is only used for MOVs with codecs or layouts the reader does not handle')
+parser.add_argument('--tool_cache', action='store', dest='tool_cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'transcoding_scripts', 'tools.json'), type=str, help='File where the versions, encoders and filters of ffmpeg, ffprobe and other tools are cached between runs. Entries are refreshed when a tool is replaced. Defaults to .cache/transcoding_scripts/tools.json in the home folder')
+parser.add_argument('--no_tool_cache', required=False, action='store_true', dest='no_tool_cache', help='Do not read or write the tool cache')
+parser.add_argument('--no_journal', required=False, action='store_true', dest='no_journal', help='Do not use the job journal (transcode_journal.sqlite in the output folder). By default, finished stages are recorded in the journal and skipped when the batch is run again, as long as their outputs are unchanged')
+parser.add_argument('--scratch', action='store', dest='scratch_path', type=str, help='Fast local folder where each file is transcoded and checked before its output folder is moved to the output folder. Each finished output folder is copied in the background while the next file is processed, and every copied file is read back and checked against its checksums before the scratch copy is removed')
+parser.add_argument('--scratch_limit', action='store', dest='scratch_limit', default=100, type=float, help='With --scratch, new files wait to start while output folders that have not been transferred yet, together with the files still being processed, would take up more than this many GB of scratch. The size of the input file is used as the size of its outputs until they are transferred. Default is 100')
+parser.add_argument('--metrics_file', action='store', dest='metrics_file', type=str, help='Write the wall time, bytes read and written and throughput of every stage to this file in the Prometheus text format, for example a .prom file in the node_exporter textfile collector folder')
 
 args = parser.parse_args()
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from aja_mov2ffv1 import corefuncs
+
 def inventory_check(item_csvDict):
     if item_csvDict is None:
         print("unable to locate file in csv data!")
@@ -23,14 +25,23 @@ def parse_mediaconchResults(mediaconchResults_dict):
 
 def stream_md5_status(input_streammd5, output_streammd5):
     if output_streammd5 == input_streammd5:
-        print ('stream checksums match.  Your file is lossless')
+        corefuncs.print_message('stream checksums match.  Your file is lossless')
         streamMD5status = "PASS"
     else:
-        print ('stream checksums do not match.  Output file may not be lossless')
+        corefuncs.print_message('stream checksums do not match.  Output file may not be lossless')
         streamMD5status = "FAIL"
     return streamMD5status
 
-def lossless_check(input_metadata, output_metadata, streamMD5status):
+def framemd5_status(framemd5_comparison):
+    if framemd5_comparison['mismatched frames'] or framemd5_comparison['frames missing from output'] or framemd5_comparison['extra frames in output']:
+        corefuncs.print_message('frame checksums do not match.', framemd5_comparison['mismatched frames'], 'mismatched,', framemd5_comparison['frames missing from output'], 'missing and', framemd5_comparison['extra frames in output'], 'extra frames')
+        framemd5Status = "FAIL"
+    else:
+        corefuncs.print_message('frame checksums match for all', framemd5_comparison['frames compared'], 'frames')
+        framemd5Status = "PASS"
+    return framemd5Status
+
+def lossless_check(input_metadata, output_metadata, streamMD5status, framemd5Status=None):
     if output_metadata.get('output_techMetaA') == input_metadata.get('input_techMetaA') and output_metadata.get('output_techMetaV') == output_metadata.get('input_techMetaV'):
         QC_techMeta = "PASS"
     else:
@@ -38,6 +49,8 @@ def lossless_check(input_metadata, output_metadata, streamMD5status):
         QC_techMeta = "FAIL"
         
     losslessCheckDict = {'technical metadata' : QC_techMeta, 'stream checksums' : streamMD5status}
+    if framemd5Status:
+        losslessCheckDict['frame checksums'] = framemd5Status
     if "FAIL" in losslessCheckDict.values():
         losslessCheck = "FAIL"
         losslessFail = []
@@ -8,7 +8,19 @@ import json
 import csv
 import datetime
 import time
+import contextlib
+import tempfile
+import xml.etree.ElementTree as ET
+try:
+    import fcntl
+except ImportError:
+    #fcntl is not available on Windows, which uses msvcrt to lock files instead
+    fcntl = None
+    import msvcrt
 from aja_mov2ffv1 import equipment_dict
+from aja_mov2ffv1 import corefuncs
+from aja_mov2ffv1 import mov2ffv1tuning
+from aja_mov2ffv1 import matroska
 from aja_mov2ffv1.mov2ffv1parameters import args
 
 def create_transcode_output_folders(baseOutput, outputFolderList):
@@ -40,18 +52,25 @@ def check_mixdown_arg():
         print ("please use one of: copy, swap, 4to3, 4to2")
         quit()  
 
+def check_jobs_arg():
+    if args.jobs < 1 or args.stage_jobs < 1:
+        print("The number of jobs must be 1 or more")
+        quit()
+
 def ffprobe_report(filename, input_file_abspath):
     '''
     returns nested dictionary with ffprobe metadata
     '''
-    video_output = json.loads(subprocess.check_output([args.ffprobe_path, '-v', 'error', '-select_streams', 'v', '-show_entries', 'stream=codec_name,avg_frame_rate,codec_time_base,width,height,pix_fmt,sample_aspect_ratio,display_aspect_ratio,color_range,color_space,color_transfer,color_primaries,chroma_location,field_order,codec_tag_string', input_file_abspath, '-of', 'json']).decode("ascii").rstrip())
-    audio_output = json.loads(subprocess.check_output([args.ffprobe_path, '-v', 'error', '-select_streams', 'a', '-show_entries', 'stream=codec_long_name,bits_per_raw_sample,sample_rate,channels', input_file_abspath, '-of', 'json']).decode("ascii").rstrip())
-    format_output = json.loads(subprocess.check_output([args.ffprobe_path, '-v', 'error', '-show_entries', 'format=duration,size,nb_streams', input_file_abspath, '-of', 'json']).decode("ascii").rstrip())
-    data_output = json.loads(subprocess.check_output([args.ffprobe_path, '-v', 'error', '-select_streams', 'd', '-show_entries', 'stream=codec_tag_string', input_file_abspath, '-of', 'json']).decode("ascii").rstrip())
-    attachment_output = json.loads(subprocess.check_output([args.ffprobe_path, '-v', 'error', '-select_streams', 't', '-show_entries', 'stream_tags=filename', input_file_abspath, '-of', 'json']).decode("ascii").rstrip())
+    #all metadata comes from a single (cached) ffprobe call that is split up by stream type
+    probe_output = corefuncs.ffprobe_json(input_file_abspath)
+    video_output = {'streams' : corefuncs.ffprobe_streams(input_file_abspath, 'video')}
+    audio_output = {'streams' : corefuncs.ffprobe_streams(input_file_abspath, 'audio')}
+    format_output = {'format' : probe_output['format']}
+    data_output = {'streams' : corefuncs.ffprobe_streams(input_file_abspath, 'data')}
+    attachment_output = {'streams' : corefuncs.ffprobe_streams(input_file_abspath, 'attachment')}
     
     #cleaning up attachment output
-    tags = [streams.get('tags') for streams in (attachment_output['streams'])]
+    tags = [streams.get('tags', {}) for streams in (attachment_output['streams'])]
     attachment_list = []
     for i in tags:
         attachmentFilename = [i.get('filename')]
@@ -112,6 +131,12 @@ def ffprobe_report(filename, input_file_abspath):
     return ffprobe_metadata
 
 def ffv1_lossless_transcode(input_metadata, transcode_nameDict, audioStreamCounter):
+    '''
+    Losslessly transcodes the input to FFV1/MKV and creates the framemd5 of the input
+    Returns the stream md5s of the input, which are created from the same decode as the transcode
+    With --fanout, the access copy, spectrograms and contact sheet are also created from the same decode
+    Also returns the checksums of the access copy if it was checksummed while it was written, otherwise None
+    '''
     #get relevant names from nameDict
     inputAbsPath = transcode_nameDict.get('inputAbsPath')
     tempMasterFile = transcode_nameDict.get('tempMasterFile')
@@ -123,7 +148,11 @@ def ffv1_lossless_transcode(input_metadata, transcode_nameDict, audioStreamCount
     ffmpeg_command = [args.ffmpeg_path]
     if not args.verbose:
         ffmpeg_command.extend(('-loglevel', 'error'))
-    ffmpeg_command.extend(['-i', inputAbsPath, '-map', '0', '-dn', '-c:v', 'ffv1', '-level', '3', '-g', '1', '-slices', str(args.ffv1_slice_count), '-slicecrc', '1'])
+    ffmpeg_command.extend(['-i', inputAbsPath])
+    if args.fanout:
+        filter_graph, fanout_args = fanout_outputs(input_metadata, transcode_nameDict, audioStreamCounter)
+        ffmpeg_command.extend(('-filter_complex', filter_graph))
+    ffmpeg_command.extend(['-map', '0', '-dn'] + mov2ffv1tuning.ffv1_options())
     #TO DO: consider putting color data in a list or dict to replace the following if statements with a single if statement in a for loop
     if input_metadata['techMetaV']['color primaries']:
         ffmpeg_command.extend(('-color_primaries', input_metadata['techMetaV']['color primaries']))
@@ -133,20 +162,80 @@ def ffv1_lossless_transcode(input_metadata, transcode_nameDict, audioStreamCount
         ffmpeg_command.extend(('-colorspace', input_metadata['techMetaV']['color space']))
     if audioStreamCounter > 0:
         ffmpeg_command.extend(('-c:a', 'copy'))
-    ffmpeg_command.extend((tempMasterFile if args.embed_framemd5 else outputAbsPath, '-f', 'framemd5', '-an', framemd5AbsPath))
+    ffmpeg_command.extend((outputAbsPath, '-f', 'framemd5', '-an', framemd5AbsPath))
 
-    #execute ffmpeg command
-    subprocess.run(ffmpeg_command)
+    acHash = None
+    with tempfile.TemporaryDirectory() as md5Folder:
+        #add stream md5 outputs so the input's stream md5s come from the same decode as the transcode
+        stream_md5_args, md5FileList = stream_md5_outputs(md5Folder, audioStreamCounter)
+        ffmpeg_command.extend(stream_md5_args)
+        if args.fanout:
+            ffmpeg_command.extend(fanout_args)
 
-    #remux to attach framemd5
+        #execute ffmpeg command
+        if args.fanout and args.hash_on_write and not args.skip_ac:
+            try:
+                acHash = corefuncs.pipe_to_file_digests(ffmpeg_command, transcode_nameDict.get('acAbsPath'))
+            except subprocess.CalledProcessError:
+                #the transcode is checked like the other outputs below, but the partial access copy has been removed
+                acHash = None
+        else:
+            corefuncs.run_command(ffmpeg_command)
+        try:
+            stream_sum = read_stream_md5s(md5FileList)
+        except FileNotFoundError:
+            stream_sum = None
+
+    #attach framemd5
+    #the framemd5 file is kept so that it can be compared against the framemd5 of the output
     if args.embed_framemd5:
-        add_attachment = [args.ffmpeg_path, '-loglevel', 'error', '-i', tempMasterFile, '-c', 'copy', '-map', '0', '-attach', framemd5AbsPath, '-metadata:s:t:0', 'mimetype=application/octet-stream', '-metadata:s:t:0', 'filename=' + framemd5File, outputAbsPath]    
-        if os.path.isfile(tempMasterFile):
-            subprocess.call(add_attachment)
-            filesToDelete = [tempMasterFile, framemd5AbsPath]
-            delete_files(filesToDelete)
+        if os.path.isfile(outputAbsPath) and os.path.isfile(framemd5AbsPath):
+            #the attachment is appended to the mkv in place, which only writes the size of the framemd5
+            #if the mkv cannot be updated in place it is remuxed with the attachment instead
+            if not matroska.append_attachment(outputAbsPath, framemd5AbsPath, framemd5File):
+                print ("*could not attach framemd5 in place, remuxing*")
+                os.replace(outputAbsPath, tempMasterFile)
+                add_attachment = [args.ffmpeg_path, '-loglevel', 'error', '-i', tempMasterFile, '-c', 'copy', '-map', '0', '-attach', framemd5AbsPath, '-metadata:s:t:0', 'mimetype=application/octet-stream', '-metadata:s:t:0', 'filename=' + framemd5File, outputAbsPath]
+                corefuncs.run_command(add_attachment)
+                filesToDelete = [tempMasterFile]
+                delete_files(filesToDelete)
         else:
-            print ("There was an issue finding the file", tempMasterFile)
+            print ("There was an issue finding the file", outputAbsPath)
+    return stream_sum, acHash
+
+def fanout_outputs(input_metadata, transcode_nameDict, audioStreamCounter):
+    '''
+    Returns the filter graph and output arguments that add the access copy, spectrograms and a contact sheet to the transcode command
+    Everything is made from the same decode of the input as the FFV1 file
+    Because there is only one decode, the access copy is a single pass encode at the same bitrate as the two pass encode
+    If --hash_on_write is used, the access copy is written to stdout as a fragmented mp4
+    '''
+    filter_list = []
+    output_args = []
+    if not args.skip_ac:
+        output_args += ['-c:v', 'libx264', '-preset', 'medium', '-b:v', '8000k', '-pix_fmt', 'yuv420p']
+        if audioStreamCounter > 0:
+            if args.mixdown == 'copy':
+                output_args += ['-c:a', 'aac', '-b:a', '128k']
+            if args.mixdown == '4to3' and audioStreamCounter == 4:
+                filter_list.append('[0:a:0][0:a:1]amerge=inputs=2[ac_a]')
+                output_args += ['-map', '0:v', '-map', '[ac_a]', '-map', '0:a:2', '-map', '0:a:3']
+            if args.mixdown == '4to2' and audioStreamCounter == 4:
+                filter_list.extend(('[0:a:0][0:a:1]amerge=inputs=2[ac_a]', '[0:a:2][0:a:3]amerge=inputs=2[ac_b]'))
+                output_args += ['-map', '0:v', '-map', '[ac_a]', '-map', '[ac_b]']
+        if args.hash_on_write:
+            output_args += ['-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4', 'pipe:1']
+        else:
+            output_args += [transcode_nameDict.get('acAbsPath')]
+    if audioStreamCounter > 0 and not args.skip_spectrogram:
+        spectrogram_filter_list, spectrogram_args = spectrogram_outputs(input_metadata['techMetaA']['channels'], transcode_nameDict.get('metaOutputFolder'), transcode_nameDict.get('baseFilename'))
+        filter_list.extend(spectrogram_filter_list)
+        output_args += spectrogram_args
+    #pick 16 evenly spaced frames for a 4x4 contact sheet
+    sheet_rate = 16 / max(float(input_metadata['file metadata']['duration']), 1)
+    filter_list.append('[0:v]fps=%(a)s,scale=320:-2,tile=4x4[contactsheet]' % {"a" : sheet_rate})
+    output_args += ['-map', '[contactsheet]', '-frames:v', '1', transcode_nameDict.get('contactSheetAbsPath')]
+    return ';'.join(filter_list), output_args
 
 def delete_files(list):
     '''
@@ -156,87 +245,242 @@ def delete_files(list):
         try:
             os.remove(i)
         except FileNotFoundError:
-            print ("unable to delete " + i)
-            print ("File not found")
+            corefuncs.print_message("unable to delete " + i + ", file not found")
+
+def stream_md5_outputs(md5Folder, audioStreamCounter):
+    '''
+    Returns the ffmpeg output arguments for an md5 of the video streams and an md5 of each audio stream
+    Also returns the list of md5 files that the outputs will be written to
+    '''
+    md5FileList = [os.path.join(md5Folder, 'v.md5')]
+    stream_md5_args = ['-map', '0:v', '-an', '-f', 'md5', md5FileList[0]]
+    for i in range(audioStreamCounter):
+        md5FileList.append(os.path.join(md5Folder, 'a' + str(i) + '.md5'))
+        stream_md5_args += ['-vn', '-map', '0:a:%(a)s' % {"a" : i}]
+        stream_md5_args += ['-c:a', 'pcm_s24le', '-f', 'md5', md5FileList[-1]]
+    return stream_md5_args, md5FileList
 
-def checksum_streams(input, audioStreamCounter):
+def read_stream_md5s(md5FileList):
+    '''
+    Reads the checksums from the files written by ffmpeg's md5 muxer
+    '''
+    stream_sum = []
+    for md5File in md5FileList:
+        with open(md5File) as f:
+            stream_sum.append(f.read().rstrip().replace('MD5=', ''))
+    return stream_sum
+
+def checksum_streams(input, audioStreamCounter, file_md5=None, framemd5_path=None):
     '''
     Gets the stream md5 of a file
     Uses both video and all audio streams if audio is present
+    All of the stream md5s come from one ffmpeg command with an md5 output per stream so the file is only read and decoded once
+    If a hashlib or MultiDigest object is passed as file_md5, the file is fed to ffmpeg through a pipe and every byte read is added to file_md5
+    This creates the checksums of the whole file from the same read (only use this with formats that ffmpeg can read from a pipe, like MKV)
+    If framemd5_path is set, a framemd5 of the video is also written from the same decode
     '''
-    stream_sum=[]
-    stream_sum_command = [args.ffmpeg_path, '-loglevel', 'error', '-i', input, '-map', '0:v', '-an']
-    
-    stream_sum_command.extend(('-f', 'md5', '-'))
-    video_stream_sum = subprocess.check_output(stream_sum_command).decode("ascii").rstrip()
-    stream_sum.append(video_stream_sum.replace('MD5=', ''))
-    for i in range(audioStreamCounter):
-        audio_sum_command = [args.ffmpeg_path]
-        audio_sum_command += ['-loglevel', 'error', '-y', '-i', input]
-        audio_sum_command += ['-vn', '-map', '0:a:%(a)s' % {"a" : i}]
-        audio_sum_command += ['-c:a', 'pcm_s24le', '-f', 'md5', '-']
-        audio_stream_sum = subprocess.check_output(audio_sum_command).decode("ascii").rstrip()
-        stream_sum.append(audio_stream_sum.replace('MD5=', ''))
+    with tempfile.TemporaryDirectory() as md5Folder:
+        stream_sum_command = [args.ffmpeg_path, '-loglevel', 'error', '-y', '-i', 'pipe:0' if file_md5 else input]
+        if framemd5_path:
+            stream_sum_command += ['-f', 'framemd5', '-an', framemd5_path]
+        stream_md5_args, md5FileList = stream_md5_outputs(md5Folder, audioStreamCounter)
+        stream_sum_command += stream_md5_args
+        if file_md5:
+            start_time = time.time()
+            process = corefuncs.AccountedPopen(stream_sum_command, stdin=subprocess.PIPE)
+            pipe_closed = False
+            #the rest of the file is still read and hashed if ffmpeg stops reading early, so that file_md5 covers the whole file
+            for buf in corefuncs.read_blocks(input):
+                file_md5.update(buf)
+                if pipe_closed:
+                    continue
+                try:
+                    process.stdin.write(buf)
+                except BrokenPipeError:
+                    pipe_closed = True
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+            corefuncs.record_command(process, start_time)
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, stream_sum_command)
+        else:
+            corefuncs.run_command(stream_sum_command, check=True)
+        stream_sum = read_stream_md5s(md5FileList)
     return stream_sum
 
+def read_framemd5(framemd5_path, time_bases):
+    '''
+    Yields the frame entries of a framemd5 file one line at a time
+    Time bases from the header are added to the time_bases dictionary as they are read
+    '''
+    with open(framemd5_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#tb'):
+                #header format is "#tb 0: 1001/30000"
+                stream, tb = line[3:].split(':')
+                num, den = tb.strip().split('/')
+                time_bases[int(stream)] = (int(num), int(den))
+            elif not line.startswith('#'):
+                stream, dts, pts, duration, size, hash = [field.strip() for field in line.split(',')]
+                yield int(stream), int(pts), size, hash
+
+def compare_framemd5(source_framemd5, output_framemd5, reportAbsPath, print_limit=10):
+    '''
+    Compares two framemd5 files line by line without loading either into memory
+    Every frame that does not match is written to a report file with its frame number and timestamp
+    Returns a dictionary summarizing the comparison
+    '''
+    source_time_bases = {}
+    output_time_bases = {}
+    source_frames = read_framemd5(source_framemd5, source_time_bases)
+    output_frames = read_framemd5(output_framemd5, output_time_bases)
+    frame_counters = {}
+    frames_compared = 0
+    mismatch_count = 0
+    missing_frames = 0
+    extra_frames = 0
+    report = None
+    try:
+        while True:
+            source_frame = next(source_frames, None)
+            output_frame = next(output_frames, None)
+            if source_frame is None and output_frame is None:
+                break
+            if source_frame is None:
+                extra_frames += 1
+                continue
+            if output_frame is None:
+                missing_frames += 1
+                continue
+            stream, pts, size, hash = source_frame
+            frame_number = frame_counters.get(stream, 0)
+            frame_counters[stream] = frame_number + 1
+            frames_compared += 1
+            if output_frame[0] != stream or output_frame[2] != size or output_frame[3] != hash:
+                mismatch_count += 1
+                num, den = source_time_bases.get(stream, (0, 1))
+                mismatch = 'stream ' + str(stream) + ', frame ' + str(frame_number) + ', pts ' + str(pts) + ', time ' + '%.3f' % (pts * num / den) + 's'
+                if report is None:
+                    report = open(reportAbsPath, 'w', newline='\n')
+                    print('frames that do not match between', os.path.basename(source_framemd5), 'and the output file', file=report)
+                print(mismatch, file=report)
+                if mismatch_count <= print_limit:
+                    corefuncs.print_message('\tframe checksum mismatch:', mismatch)
+    finally:
+        if report:
+            report.close()
+    if mismatch_count > print_limit:
+        corefuncs.print_message('\t' + str(mismatch_count - print_limit), 'more mismatched frames. See', reportAbsPath)
+    framemd5_comparison = {
+    'frames compared' : frames_compared,
+    'mismatched frames' : mismatch_count,
+    'frames missing from output' : missing_frames,
+    'extra frames in output' : extra_frames,
+    'mismatch report' : reportAbsPath if report else None
+    }
+    return framemd5_comparison
+
 def two_pass_h264_encoding(audioStreamCounter, outputAbsPath, acAbsPath):
+    '''
+    Creates an h264 access copy
+    Returns the checksums of the access copy if they were created while writing the file (--hash_on_write), otherwise None
+    '''
     if os.name == 'nt':
         nullOut = 'NUL'
     else:
         nullOut = '/dev/null'
-    pass1 = [args.ffmpeg_path]
-    if not args.verbose:
-        pass1 += ['-loglevel', 'error']
-    pass1 += ['-y', '-i', outputAbsPath, '-c:v', 'libx264', '-preset', 'medium', '-b:v', '8000k', '-pix_fmt', 'yuv420p', '-pass', '1']
-    if audioStreamCounter > 0:
-        if args.mixdown == 'copy':    
-            pass1 += ['-c:a', 'aac', '-b:a', '128k']
-        if args.mixdown == '4to3' and audioStreamCounter == 4:
-            pass1 += ['-filter_complex', '[0:a:0][0:a:1]amerge=inputs=2[a]', '-map', '0:v', '-map', '[a]', '-map', '0:a:2', '-map', '0:a:3']
-        if args.mixdown == '4to2' and audioStreamCounter == 4:
-            pass1 += ['-filter_complex', '[0:a:0][0:a:1]amerge=inputs=2[a];[0:a:2][0:a:3]amerge=inputs=2[b]', '-map', '0:v', '-map', '[a]', '-map', '[b]']
-    pass1 += ['-f', 'mp4', nullOut]
-    pass2 = [args.ffmpeg_path]
-    if not args.verbose:
-        pass2 += ['-loglevel', 'error']
-    pass2 += ['-y', '-i', outputAbsPath, '-c:v', 'libx264', '-preset', 'medium', '-b:v', '8000k', '-pix_fmt', 'yuv420p', '-pass', '2']
-    if audioStreamCounter > 0:
-        if args.mixdown == 'copy':
-            pass2 += ['-c:a', 'aac', '-b:a', '128k']
-        if args.mixdown == '4to3' and audioStreamCounter == 4:
-            pass2 += ['-filter_complex', '[0:a:0][0:a:1]amerge=inputs=2[a]', '-map', '0:v', '-map', '[a]', '-map', '0:a:2', '-map', '0:a:3']
-        if args.mixdown == '4to2' and audioStreamCounter == 4:
-            pass2 += ['-filter_complex', '[0:a:0][0:a:1]amerge=inputs=2[a];[0:a:2][0:a:3]amerge=inputs=2[b]', '-map', '0:v', '-map', '[a]', '-map', '[b]']
-    pass2 += [acAbsPath]
-    subprocess.run(pass1)
-    subprocess.run(pass2)
+    #each file gets its own pass log so that access copies made by parallel jobs do not overwrite each other's first pass stats
+    with tempfile.TemporaryDirectory() as passLogFolder:
+        passLogAbsPath = os.path.join(passLogFolder, 'ffmpeg2pass')
+        pass1 = [args.ffmpeg_path]
+        if not args.verbose:
+            pass1 += ['-loglevel', 'error']
+        pass1 += ['-y', '-i', outputAbsPath, '-c:v', 'libx264', '-preset', 'medium', '-b:v', '8000k', '-pix_fmt', 'yuv420p', '-pass', '1', '-passlogfile', passLogAbsPath]
+        if audioStreamCounter > 0:
+            if args.mixdown == 'copy':    
+                pass1 += ['-c:a', 'aac', '-b:a', '128k']
+            if args.mixdown == '4to3' and audioStreamCounter == 4:
+                pass1 += ['-filter_complex', '[0:a:0][0:a:1]amerge=inputs=2[a]', '-map', '0:v', '-map', '[a]', '-map', '0:a:2', '-map', '0:a:3']
+            if args.mixdown == '4to2' and audioStreamCounter == 4:
+                pass1 += ['-filter_complex', '[0:a:0][0:a:1]amerge=inputs=2[a];[0:a:2][0:a:3]amerge=inputs=2[b]', '-map', '0:v', '-map', '[a]', '-map', '[b]']
+        pass1 += ['-f', 'mp4', nullOut]
+        pass2 = [args.ffmpeg_path]
+        if not args.verbose:
+            pass2 += ['-loglevel', 'error']
+        pass2 += ['-y', '-i', outputAbsPath, '-c:v', 'libx264', '-preset', 'medium', '-b:v', '8000k', '-pix_fmt', 'yuv420p', '-pass', '2', '-passlogfile', passLogAbsPath]
+        if audioStreamCounter > 0:
+            if args.mixdown == 'copy':
+                pass2 += ['-c:a', 'aac', '-b:a', '128k']
+            if args.mixdown == '4to3' and audioStreamCounter == 4:
+                pass2 += ['-filter_complex', '[0:a:0][0:a:1]amerge=inputs=2[a]', '-map', '0:v', '-map', '[a]', '-map', '0:a:2', '-map', '0:a:3']
+            if args.mixdown == '4to2' and audioStreamCounter == 4:
+                pass2 += ['-filter_complex', '[0:a:0][0:a:1]amerge=inputs=2[a];[0:a:2][0:a:3]amerge=inputs=2[b]', '-map', '0:v', '-map', '[a]', '-map', '[b]']
+        corefuncs.run_command(pass1)
+        if args.hash_on_write:
+            #write a fragmented mp4 through a pipe so that the checksum is created while the file is written
+            pass2 += ['-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4', 'pipe:1']
+            acHash = corefuncs.pipe_to_file_digests(pass2, acAbsPath)
+        else:
+            pass2 += [acAbsPath]
+            corefuncs.run_command(pass2)
+            acHash = None
+    return acHash
 
-def generate_spectrogram(input, channel_layout_list, outputFolder, outputName):
+def spectrogram_filter(index, channels):
     '''
-    Creates a spectrogram for each audio track in the input
+    Returns the showspectrumpic filter for an audio track
+    Tracks with more than one channel get a separate spectrogram per channel
     '''
     spectrogram_resolution = "1928x1080"
+    if channels > 1:
+        return '[0:a:%(a)s]showspectrumpic=mode=separate:s=%(b)s' % {"a" : index, "b" : spectrogram_resolution}
+    else:
+        return '[0:a:%(a)s]showspectrumpic=s=%(b)s' % {"a" : index, "b" : spectrogram_resolution}
+
+def spectrogram_output(outputFolder, outputName, index):
+    return os.path.join(outputFolder, outputName + '_0a' + str(index) + '.png')
+
+def spectrogram_outputs(channel_layout_list, outputFolder, outputName):
+    '''
+    Returns a showspectrumpic branch for every audio track and the output arguments that map each branch to its png
+    '''
+    filter_list = []
+    output_args = []
     for index, item in enumerate(channel_layout_list):
-        output = os.path.join(outputFolder, outputName + '_0a' + str(index) + '.png')
-        spectrogram_args = [args.ffmpeg_path]
-        spectrogram_args += ['-loglevel', 'error', '-y']
-        spectrogram_args += ['-i', input, '-lavfi']
-        if item > 1:
-            spectrogram_args += ['[0:a:%(a)s]showspectrumpic=mode=separate:s=%(b)s' % {"a" : index, "b" : spectrogram_resolution}]
-        else:
-            spectrogram_args += ['[0:a:%(a)s]showspectrumpic=s=%(b)s' % {"a" : index, "b" : spectrogram_resolution}]
-        spectrogram_args += [output]
-        subprocess.run(spectrogram_args)
+        filter_list.append(spectrogram_filter(index, item) + '[spectrogram' + str(index) + ']')
+        output_args += ['-map', '[spectrogram' + str(index) + ']', '-frames:v', '1']
+        output_args += [spectrogram_output(outputFolder, outputName, index)]
+    return filter_list, output_args
+
+def generate_spectrogram(input, channel_layout_list, outputFolder, outputName):
+    '''
+    Creates a spectrogram for each audio track in the input
+    All spectrograms come from one ffmpeg command that has a showspectrumpic branch per track
+    Video and data packets are discarded by the demuxer so that they are never decoded
+    '''
+    filter_list, output_args = spectrogram_outputs(channel_layout_list, outputFolder, outputName)
+    spectrogram_args = [args.ffmpeg_path]
+    spectrogram_args += ['-loglevel', 'error', '-y']
+    spectrogram_args += ['-discard:v', 'all', '-discard:d', 'all', '-i', input]
+    spectrogram_args += ['-filter_complex', ';'.join(filter_list)]
+    spectrogram_args += output_args
+    corefuncs.run_command(spectrogram_args)
 
 def generate_qctools(input):
     '''
     uses qcli to generate a QCTools report
     '''
     qctools_args = [args.qcli_path, '-i', input]
-    subprocess.run(qctools_args)
+    corefuncs.run_command(qctools_args)
 
 def mediaconch_policy_check(input, policy):
-    mediaconchResults = subprocess.check_output([args.mediaconch_path, '--policy=' + policy, input]).decode("ascii").rstrip().split()[0]
+    mediaconchResults = corefuncs.run_command([args.mediaconch_path, '--policy=' + policy, input], check=True, stdout=subprocess.PIPE).stdout.decode("ascii").rstrip().split()[0]
     if mediaconchResults == "pass!":
         mediaconchResults = "PASS"
     else:
@@ -244,13 +488,64 @@ def mediaconch_policy_check(input, policy):
     return mediaconchResults
 
 def mediaconch_implementation_check(input):
-    mediaconchResults = subprocess.check_output([args.mediaconch_path, input]).decode("ascii").rstrip().split()[0]
+    mediaconchResults = corefuncs.run_command([args.mediaconch_path, input], check=True, stdout=subprocess.PIPE).stdout.decode("ascii").rstrip().split()[0]
     if mediaconchResults == "pass!":
         mediaconchResults = "PASS"
     else:
         mediaconchResults = "FAIL"
     return mediaconchResults
 
+def mediaconch_batch_check(fileList, policy=None, chunk_size=100):
+    '''
+    Checks many files with one mediaconch run (per chunk of files) and parses the XML report
+    Uses the policy if one is given, otherwise runs the implementation check
+    Returns a dictionary of PASS/FAIL results keyed by the path of each file
+    '''
+    mediaconchResults = {}
+    for i in range(0, len(fileList), chunk_size):
+        chunk = fileList[i:i + chunk_size]
+        mediaconch_command = [args.mediaconch_path]
+        if policy:
+            mediaconch_command += ['--policy=' + policy]
+        else:
+            mediaconch_command += ['-mc']
+        mediaconch_command += ['-fx'] + chunk
+        report = corefuncs.run_command(mediaconch_command, stdout=subprocess.PIPE).stdout
+        mediaconchResults.update(parse_mediaconch_xml(report, chunk, policy))
+    return mediaconchResults
+
+def parse_mediaconch_xml(report, fileList, policy):
+    '''
+    Reads PASS/FAIL results for each file out of a MediaConch XML report
+    Files that are missing from the report are marked as FAIL
+    '''
+    mediaconchResults = {input : "FAIL" for input in fileList}
+    fileLookup = {os.path.normcase(os.path.abspath(input)) : input for input in fileList}
+    try:
+        root = ET.fromstring(report)
+    except ET.ParseError:
+        corefuncs.print_message("Unable to read mediaconch report")
+        return mediaconchResults
+    for media in root.iter():
+        if media.tag.split('}')[-1] != 'media':
+            continue
+        input = fileLookup.get(os.path.normcase(os.path.abspath(media.get('ref', ''))))
+        if not input:
+            continue
+        outcomes = []
+        for element in media.iter():
+            tag = element.tag.split('}')[-1]
+            if policy and tag == 'policy' and element.get('outcome'):
+                outcomes.append(element.get('outcome'))
+            elif not policy and tag == 'check':
+                outcomes.append('fail' if int(element.get('fail_count', '0')) > 0 else 'pass')
+        if outcomes and policy:
+            #the first policy element is the top level result of the policy
+            mediaconchResults[input] = "PASS" if outcomes[0] == 'pass' else "FAIL"
+        elif outcomes:
+            mediaconchResults[input] = "FAIL" if 'fail' in outcomes else "PASS"
+    return mediaconchResults
+
 def generate_system_log(ffvers, tstime, tftime):
     #gather system info for json output
     osinfo = platform.platform()
@@ -394,17 +689,92 @@ def convert_runtime(duration):
     runtime = time.strftime("%H:%M:%S", time.gmtime(float(duration)))
     return runtime
 
+@contextlib.contextmanager
+def locked_file(lockFile):
+    '''
+    Holds an exclusive lock on an open file so that only one process at a time can run the enclosed code
+    '''
+    if fcntl is None:
+        lockFile.seek(0)
+        #LK_LOCK retries for 10 seconds before raising an error so keep trying until the lock is free
+        while True:
+            try:
+                msvcrt.locking(lockFile.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                continue
+        try:
+            yield
+        finally:
+            lockFile.seek(0)
+            msvcrt.locking(lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+
 def write_output_csv(outdir, csvHeaderList, csvWriteList, output_metadata, qcResults):
     csv_file = os.path.join(outdir, "qc_log.csv")
-    csvOutFileExists = os.path.isfile(csv_file)
 
-    with open(csv_file, 'a') as f:
+    #lock the csv file so that parallel jobs can't write over each other or write the header twice
+    with open(csv_file, 'a') as f, locked_file(f):
+        #the header is only written by the job that finds the file empty once it holds the lock
+        csvOutFileExists = os.fstat(f.fileno()).st_size > 0
         writer = csv.writer(f, delimiter=',', lineterminator='\n')
         if not csvOutFileExists:
             writer.writerow(csvHeaderList)
         writer.writerow(csvWriteList)
+        #the row is written out before the lock is released
+        f.flush()
+
+@contextlib.contextmanager
+def redirect_output(logAbsPath):
+    '''
+    Sends stdout and stderr to a log file, including the output of any programs run with subprocess
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+    with open(logAbsPath, 'a') as logFile:
+        os.dup2(logFile.fileno(), 1)
+        os.dup2(logFile.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+
+def failed_file_results(movFilename, error):
+    '''
+    Returns the batch summary entry for a file whose pipeline stopped with an error
+    '''
+    return {'File' : movFilename, 'Status' : 'ERROR', 'Error' : repr(error)}
+
+def print_batch_summary(batchResults):
+    '''
+    Prints the results of every file in the batch
+    '''
+    print ("\n***BATCH SUMMARY***")
+    for fileResults in sorted(batchResults, key=lambda i: i['File']):
+        print (fileResults['File'] + ':', fileResults['Status'])
+        for key in ['Inventory Check', 'Lossless Check', 'Mediaconch Results', 'Transfer', 'Error', 'Log']:
+            if fileResults.get(key):
+                print ('\t' + key + ':', fileResults[key])
+        if fileResults.get('Runtime'):
+            print ('\tProcessing time:', convert_runtime(fileResults['Runtime']))
+    statusList = [fileResults['Status'] for fileResults in batchResults]
+    print ("files processed:", len(statusList))
+    for status in sorted(set(statusList)):
+        print ('\t' + status + ':', statusList.count(status))
 
-def create_json(jsonAbsPath, systemInfo, input_metadata, mov_stream_sum, mkvHash, mkv_stream_sum, baseFilename, output_metadata, item_csvDict, qcResults):
+def create_json(jsonAbsPath, systemInfo, input_metadata, mov_stream_sum, mkvHash, mkv_stream_sum, baseFilename, output_metadata, item_csvDict, qcResults, stageTimings=None, toolUsage=None):
     input_techMetaV = input_metadata.get('techMetaV')
     input_techMetaA = input_metadata.get('techMetaA')
     input_file_metadata = input_metadata.get('file metadata')
@@ -421,7 +791,12 @@ def create_json(jsonAbsPath, systemInfo, input_metadata, mov_stream_sum, mkvHash
     ffv1_file_meta = {}
     #add stream checksums to metadata
     mov_md5_dict = {'a/v streamMD5s': mov_stream_sum}
-    ffv1_md5_dict = {'md5 checksum': mkvHash, 'a/v streamMD5s': mkv_stream_sum}
+    #mkvHash holds a checksum for each algorithm in --digests
+    ffv1_md5_dict = {'md5 checksum': mkvHash.get('md5')}
+    for digest_name in mkvHash:
+        if digest_name != 'md5':
+            ffv1_md5_dict[digest_name + ' checksum'] = mkvHash[digest_name]
+    ffv1_md5_dict['a/v streamMD5s'] = mkv_stream_sum
     input_file_metadata = {**input_file_metadata, **mov_md5_dict}
     output_file_metadata = {**output_file_metadata, **ffv1_md5_dict}
     ffv1_file_meta = {'post-transcode metadata' : output_file_metadata}
@@ -448,5 +823,11 @@ def create_json(jsonAbsPath, systemInfo, input_metadata, mov_stream_sum, mkvHash
     data[baseFilename].append(mov_file_meta)        
     data[baseFilename].append(techdata)
     data[baseFilename].append(qcResults)
+    if stageTimings:
+        #wall time, bytes read and written and throughput of each stage that has finished
+        data[baseFilename].append({'stage timings' : stageTimings})
+    if toolUsage:
+        #number of runs, CPU time and peak memory use of each external tool
+        data[baseFilename].append({'tool usage' : toolUsage})
     with open(jsonAbsPath, 'w', newline='\n') as outfile:
         json.dump(data, outfile, indent=4)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+'''
+Finds the FFV1 encoder settings that work best on the current machine
+'''
+
+import os
+import json
+import time
+import socket
+import datetime
+import subprocess
+from aja_mov2ffv1.mov2ffv1parameters import args
+from aja_mov2ffv1 import corefuncs
+
+#slice counts allowed by the FFV1 level 3 spec for 4:2:2 video, same as the --slices choices
+slice_choices = [4, 6, 9, 12, 16, 24, 30]
+#settings used when there is no profile for this machine
+default_ffv1_settings = {'slices' : 16}
+#a setting is only picked for its smaller files if it is at least this fast compared to the fastest setting
+speed_margin = 0.9
+
+ffv1_profile_settings = None
+
+def load_ffv1_profile():
+    '''
+    Returns the saved FFV1 profile of this machine, or None if it has not been tuned
+    Profiles are stored by host name so a profile file in a shared home folder works for several machines
+    '''
+    try:
+        with open(args.ffv1_profile) as f:
+            return json.load(f).get(socket.gethostname())
+    except (OSError, ValueError):
+        return None
+
+def ffv1_settings():
+    '''
+    Returns the slices, threads, context and coder used for FFV1 transcodes
+    The saved profile is used if there is one and --slices overrides its slice count
+    '''
+    global ffv1_profile_settings
+    if ffv1_profile_settings is None:
+        profile = load_ffv1_profile()
+        if profile:
+            ffv1_profile_settings = {key : profile[key] for key in ['slices', 'threads', 'context', 'coder']}
+            if profile.get('cpu count') != os.cpu_count():
+                print("FFV1 profile was made with", profile.get('cpu count'), "CPUs but this machine has", os.cpu_count(), "- run --tune_ffv1 again to update it")
+        else:
+            ffv1_profile_settings = dict(default_ffv1_settings)
+    settings = dict(ffv1_profile_settings)
+    if args.ffv1_slice_count:
+        settings['slices'] = args.ffv1_slice_count
+        #extra threads beyond the slice count are left idle by the encoder
+        if settings.get('threads'):
+            settings['threads'] = min(settings['threads'], settings['slices'])
+    return settings
+
+def ffv1_options(settings=None):
+    '''
+    Returns the ffmpeg output options for an FFV1 level 3 encode with the given settings
+    '''
+    if settings is None:
+        settings = ffv1_settings()
+    ffv1_args = ['-c:v', 'ffv1', '-level', '3', '-g', '1', '-slices', str(settings['slices']), '-slicecrc', '1']
+    if settings.get('threads'):
+        ffv1_args += ['-threads', str(settings['threads'])]
+    if settings.get('context') is not None:
+        ffv1_args += ['-context', str(settings['context'])]
+    if settings.get('coder') is not None:
+        ffv1_args += ['-coder', str(settings['coder'])]
+    return ffv1_args
+
+def encode_sample(sample_abspath, frame_count, settings):
+    '''
+    Encodes the start of a sample file to FFV1 with the given settings
+    The output goes through a pipe and is only counted, so disk speed does not affect the result
+    Returns the wall time, CPU time and size of the encode
+    '''
+    ffmpeg_command = [args.ffmpeg_path, '-loglevel', 'error', '-i', sample_abspath, '-map', '0:v:0', '-an', '-frames:v', str(frame_count)]
+    ffmpeg_command += ffv1_options(settings) + ['-f', 'matroska', 'pipe:1']
+    output_size = 0
+    start_time = time.time()
+    with corefuncs.AccountedPopen(ffmpeg_command, stdout=subprocess.PIPE) as process:
+        for chunk in iter(lambda: process.stdout.read(1024 * 1024), b''):
+            output_size += len(chunk)
+    command_record = corefuncs.record_command(process, start_time)
+    if process.returncode != 0:
+        print("Error encoding FFV1 sample with", settings)
+        quit()
+    return command_record['wall time'], (command_record['user cpu'] or 0) + (command_record['system cpu'] or 0), output_size
+
+def pick_settings(result_list):
+    '''
+    Picks the setting with the smallest output among the settings that are nearly as fast as the fastest one
+    '''
+    fastest_fps = max(result['fps'] for result in result_list)
+    fast_enough = [result for result in result_list if result['fps'] >= fastest_fps * speed_margin]
+    return min(fast_enough, key=lambda result: result['size'])
+
+def tune_ffv1(sample_abspath):
+    '''
+    Encodes a sample with different FFV1 settings and saves the best settings as this machine's profile
+    Slice counts are compared first, then context and coder are compared with the chosen slice count
+    Threads are limited to the CPUs available to each of the --jobs parallel files
+    '''
+    if args.tune_frames < 1:
+        print("--tune_frames must be at least 1")
+        quit()
+    video_streams = corefuncs.ffprobe_streams(sample_abspath, 'video')
+    if not video_streams:
+        print("No video stream found in", sample_abspath)
+        quit()
+    width = video_streams[0]['width']
+    height = video_streams[0]['height']
+    frameRateNum, frameRateDen = video_streams[0]['avg_frame_rate'].split('/')
+    duration = float(corefuncs.ffprobe_json(sample_abspath)['format']['duration'])
+    #streams with no frames can report an avg_frame_rate of 0/0
+    if int(frameRateDen) == 0:
+        frame_count = 0
+    else:
+        frame_count = min(args.tune_frames, round(duration * int(frameRateNum) / int(frameRateDen)))
+    if frame_count < 1:
+        print("No frames found in", sample_abspath, "to tune FFV1 settings with")
+        quit()
+    #v210 packs 6 pixels into 16 bytes and pads each line to a multiple of 48 pixels
+    uncompressed_size = frame_count * height * ((width + 47) // 48) * 128
+    cpus_per_job = max(os.cpu_count() // args.jobs, 1)
+
+    #read the sample once so the first setting does not also measure a cold disk cache
+    with open(sample_abspath, 'rb') as f:
+        while f.read(1024 * 1024 * 16):
+            pass
+
+    print("*tuning FFV1 settings with", frame_count, "frames of", os.path.basename(sample_abspath) + "*")
+    result_list = []
+    def try_settings(settings):
+        wall_time, cpu_time, output_size = encode_sample(sample_abspath, frame_count, settings)
+        result = dict(settings)
+        result.update({
+        'fps' : round(frame_count / wall_time, 2),
+        'cpu seconds per frame' : round(cpu_time / frame_count, 4),
+        'size' : output_size,
+        'compression ratio' : round(uncompressed_size / output_size, 3)
+        })
+        print('\t' + ', '.join(key + ' ' + str(settings[key]) for key in settings) + ':', result['fps'], 'fps, compression ratio', result['compression ratio'])
+        result_list.append(result)
+        return result
+
+    slice_results = [try_settings({'slices' : slices, 'threads' : min(slices, cpus_per_job), 'context' : 0, 'coder' : 1}) for slices in slice_choices]
+    best_slices = pick_settings(slice_results)
+    coder_results = [best_slices]
+    for context, coder in [(1, 1), (0, 2), (1, 2)]:
+        coder_results.append(try_settings({'slices' : best_slices['slices'], 'threads' : best_slices['threads'], 'context' : context, 'coder' : coder}))
+    chosen = pick_settings(coder_results)
+
+    profile = {key : chosen[key] for key in ['slices', 'threads', 'context', 'coder', 'fps', 'compression ratio']}
+    profile.update({
+    'cpu count' : os.cpu_count(),
+    'jobs' : args.jobs,
+    'sample' : sample_abspath,
+    'frames' : frame_count,
+    'ffmpeg version' : corefuncs.get_ffmpeg_version(),
+    'date' : datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S'),
+    'results' : result_list
+    })
+    try:
+        with open(args.ffv1_profile) as f:
+            profile_dict = json.load(f)
+    except (OSError, ValueError):
+        profile_dict = {}
+    profile_dict[socket.gethostname()] = profile
+    os.makedirs(os.path.dirname(os.path.abspath(args.ffv1_profile)), exist_ok=True)
+    temp_profile_abspath = args.ffv1_profile + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_profile_abspath, 'w') as f:
+        json.dump(profile_dict, f, indent=4)
+    os.replace(temp_profile_abspath, args.ffv1_profile)
+    print("chosen FFV1 settings: slices", chosen['slices'], "threads", chosen['threads'], "context", chosen['context'], "coder", chosen['coder'])
+    print("profile saved to", args.ffv1_profile)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+'''
+Reads the metadata of QuickTime/MOV files from the moov atom without running ffprobe
+'''
+
+import os
+import struct
+from aja_mov2ffv1 import matroska
+
+#video codecs described without ffprobe, with their ffprobe codec name, long name, pixel format and bits per sample
+video_codecs = {
+'v210' : ('v210', 'Uncompressed 4:2:2 10-bit', 'yuv422p10le', 10),
+'v410' : ('v410', 'Uncompressed 4:4:4 10-bit', 'yuv444p10le', 10),
+'2vuy' : ('rawvideo', 'raw video', 'uyvy422', None)
+}
+#ffprobe long names of the PCM codecs that are described without ffprobe
+pcm_codecs = {
+'pcm_s16le' : 'PCM signed 16-bit little-endian',
+'pcm_s16be' : 'PCM signed 16-bit big-endian',
+'pcm_s24le' : 'PCM signed 24-bit little-endian',
+'pcm_s24be' : 'PCM signed 24-bit big-endian',
+'pcm_s32le' : 'PCM signed 32-bit little-endian',
+'pcm_s32be' : 'PCM signed 32-bit big-endian',
+'pcm_f32le' : 'PCM 32-bit floating point little-endian',
+'pcm_f32be' : 'PCM 32-bit floating point big-endian'
+}
+
+def read_atoms(data, start=0, end=None):
+    '''
+    Returns the type, data start and data end of each atom between start and end of a block of data
+    '''
+    atom_list = []
+    end = len(data) if end is None else end
+    position = start
+    #older QuickTime files can end a list of atoms with a 4 byte terminator
+    while position + 8 <= end:
+        size, atom_type = struct.unpack('>I4s', data[position:position + 8])
+        header_length = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[position + 8:position + 16])[0]
+            header_length = 16
+        elif size == 0:
+            size = end - position
+        if size < header_length or position + size > end:
+            raise ValueError('invalid atom size')
+        atom_list.append((atom_type.decode('latin-1'), position + header_length, position + size))
+        position += size
+    return atom_list
+
+def find_atom(data, atom_list, path):
+    '''
+    Returns the data start and end of the first atom found by following a list of atom types, or None
+    '''
+    for depth, atom_type in enumerate(path):
+        matches = [atom for atom in atom_list if atom[0] == atom_type]
+        if not matches:
+            return None
+        if depth == len(path) - 1:
+            return matches[0][1], matches[0][2]
+        atom_list = read_atoms(data, matches[0][1], matches[0][2])
+
+def read_moov(f, file_size):
+    '''
+    Returns the contents of the moov atom
+    Only the atom headers are read on the way, so a moov at the end of the file is found without reading the mdat
+    '''
+    position = 0
+    while position + 8 <= file_size:
+        f.seek(position)
+        header = f.read(16)
+        size, atom_type = struct.unpack('>I4s', header[:8])
+        header_length = 8
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+            header_length = 16
+        elif size == 0:
+            size = file_size - position
+        if size < header_length:
+            return None
+        if atom_type == b'moov':
+            f.seek(position + header_length)
+            return f.read(size - header_length)
+        position += size
+    return None
+
+def timescale_duration(data, start):
+    '''
+    Returns the timescale and duration of a mvhd or mdhd atom
+    '''
+    if data[start] == 1:
+        return struct.unpack('>IQ', data[start + 20:start + 32])
+    return struct.unpack('>II', data[start + 12:start + 20])
+
+def pcm_codec(fourcc, bits, little_endian, lpcm_flags):
+    '''
+    Returns the ffmpeg name of a PCM codec from its QuickTime fourcc, or None if it is not one listed here
+    '''
+    if fourcc in ['sowt', 'twos'] and bits in [16, 24, 32]:
+        return 'pcm_s' + str(bits) + ('le' if fourcc == 'sowt' else 'be')
+    if fourcc in ['in24', 'in32']:
+        return 'pcm_s' + fourcc[2:] + ('le' if little_endian else 'be')
+    if fourcc == 'fl32':
+        return 'pcm_f32' + ('le' if little_endian else 'be')
+    #lpcm flags are 1 for float, 2 for big-endian and 4 for signed integer
+    if fourcc == 'lpcm' and bits in [16, 24, 32] and lpcm_flags & 0x04 and not lpcm_flags & 0x01:
+        return 'pcm_s' + str(bits) + ('be' if lpcm_flags & 0x02 else 'le')
+    if fourcc == 'lpcm' and bits == 32 and lpcm_flags & 0x01:
+        return 'pcm_f32' + ('be' if lpcm_flags & 0x02 else 'le')
+    return None
+
+def video_stream(data, entry_start, entry_end, fourcc, stream):
+    '''
+    Adds the codec, frame size, aspect ratio and colour of a video sample description to a stream
+    Returns None if the codec is not one this reader describes
+    '''
+    if fourcc not in video_codecs:
+        return None
+    codec_name, codec_long_name, pix_fmt, bits = video_codecs[fourcc]
+    width, height = struct.unpack('>HH', data[entry_start + 32:entry_start + 36])
+    stream.update({
+    'codec_name' : codec_name,
+    'codec_long_name' : codec_long_name,
+    'codec_type' : 'video',
+    'codec_tag_string' : fourcc,
+    'width' : width,
+    'height' : height
+    })
+    #the sample description is 86 bytes long before its extension atoms
+    extensions = read_atoms(data, entry_start + 86, entry_end)
+    pasp = find_atom(data, extensions, ['pasp'])
+    if pasp:
+        h_spacing, v_spacing = struct.unpack('>II', data[pasp[0]:pasp[0] + 8])
+        if h_spacing and v_spacing:
+            sar_num, sar_den = matroska.reduce_ratio(h_spacing, v_spacing, 32767)
+            dar_num, dar_den = matroska.reduce_ratio(width * sar_num, height * sar_den, 1024 * 1024)
+            stream['sample_aspect_ratio'] = str(sar_num) + ':' + str(sar_den)
+            stream['display_aspect_ratio'] = str(dar_num) + ':' + str(dar_den)
+    stream['pix_fmt'] = pix_fmt
+    colr = find_atom(data, extensions, ['colr'])
+    if colr and data[colr[0]:colr[0] + 4] in [b'nclc', b'nclx']:
+        primaries, transfer, matrix = struct.unpack('>HHH', data[colr[0] + 4:colr[0] + 10])
+        if data[colr[0]:colr[0] + 4] == b'nclx' and colr[1] - colr[0] > 10:
+            stream['color_range'] = 'pc' if data[colr[0] + 10] & 0x80 else 'tv'
+        for key, value, names in [('color_space', matrix, matroska.color_space_names), ('color_transfer', transfer, matroska.color_transfer_names), ('color_primaries', primaries, matroska.color_primaries_names)]:
+            if value in names:
+                stream[key] = names[value]
+            elif value != 2:
+                return None
+    if bits:
+        stream['bits_per_raw_sample'] = str(bits)
+    return stream
+
+def audio_stream(data, entry_start, entry_end, fourcc, timescale, stream):
+    '''
+    Adds the codec, sample rate, channels and bits per sample of a sound sample description to a stream
+    Returns None if the codec is not one this reader describes
+    '''
+    version = struct.unpack('>H', data[entry_start + 16:entry_start + 18])[0]
+    channels, bits = struct.unpack('>HH', data[entry_start + 24:entry_start + 28])
+    sample_rate = struct.unpack('>I', data[entry_start + 32:entry_start + 36])[0] >> 16
+    lpcm_flags = 0
+    extensions_start = entry_start + 36
+    if version == 1:
+        extensions_start += 16
+    elif version == 2:
+        sample_rate, channels = struct.unpack('>dI', data[entry_start + 40:entry_start + 52])
+        bits, lpcm_flags = struct.unpack('>II', data[entry_start + 56:entry_start + 64])
+        sample_rate = int(sample_rate)
+        extensions_start += 36
+    #sample rates above 65535 do not fit in version 0 and 1 sample descriptions
+    if not sample_rate or (version < 2 and sample_rate != timescale):
+        return None
+    #the enda atom marks little-endian samples and can be inside a wave atom
+    extensions = read_atoms(data, extensions_start, entry_end)
+    enda = find_atom(data, extensions, ['enda']) or find_atom(data, extensions, ['wave', 'enda'])
+    little_endian = bool(enda and struct.unpack('>H', data[enda[0]:enda[0] + 2])[0])
+    codec_name = pcm_codec(fourcc, bits, little_endian, lpcm_flags)
+    if not codec_name:
+        return None
+    stream.update({
+    'codec_name' : codec_name,
+    'codec_long_name' : pcm_codecs[codec_name],
+    'codec_type' : 'audio',
+    'codec_tag_string' : fourcc,
+    'sample_rate' : str(sample_rate),
+    'channels' : channels,
+    'r_frame_rate' : '0/0',
+    'avg_frame_rate' : '0/0'
+    })
+    #ffmpeg only sets the raw bits per sample of PCM that is decoded to 32 bit integer samples
+    #the bits come from the codec, as in24 and in32 sample descriptions can keep the old 16 bit sample size
+    if codec_name.startswith('pcm_s') and codec_name[5:7] != '16':
+        stream['bits_per_raw_sample'] = codec_name[5:7]
+    return stream
+
+def track_stream(data, trak, index):
+    '''
+    Returns the ffprobe stream metadata and the duration in microseconds of a trak atom
+    Returns None if the track is not one this reader describes
+    '''
+    trak_atoms = read_atoms(data, trak[0], trak[1])
+    handler = find_atom(data, trak_atoms, ['mdia', 'hdlr'])
+    mdhd = find_atom(data, trak_atoms, ['mdia', 'mdhd'])
+    stsd = find_atom(data, trak_atoms, ['mdia', 'minf', 'stbl', 'stsd'])
+    stts = find_atom(data, trak_atoms, ['mdia', 'minf', 'stbl', 'stts'])
+    if not handler or not mdhd or not stsd or not stts:
+        return None
+    #edit lists that do not start the media at its beginning change the timing, which only ffprobe works out
+    elst = find_atom(data, trak_atoms, ['edts', 'elst'])
+    if elst:
+        entry_count = struct.unpack('>I', data[elst[0] + 4:elst[0] + 8])[0]
+        media_time = struct.unpack('>q', data[elst[0] + 16:elst[0] + 24])[0] if data[elst[0]] == 1 else struct.unpack('>i', data[elst[0] + 12:elst[0] + 16])[0]
+        if entry_count != 1 or media_time != 0:
+            return None
+    handler_type = data[handler[0] + 8:handler[0] + 12].decode('latin-1')
+    timescale, duration = timescale_duration(data, mdhd[0])
+    entry_start = stsd[0] + 8
+    entry_size = struct.unpack('>I', data[entry_start:entry_start + 4])[0]
+    entry_end = entry_start + entry_size
+    fourcc = data[entry_start + 4:entry_start + 8].decode('latin-1')
+    if not timescale or entry_end > stsd[1]:
+        return None
+    stream = {'index' : index}
+    if handler_type == 'vide':
+        #the average frame rate is the number of frames over the summed frame durations
+        stts_count = struct.unpack('>I', data[stts[0] + 4:stts[0] + 8])[0]
+        stts_entries = [struct.unpack('>II', data[stts[0] + 8 + 8 * i:stts[0] + 16 + 8 * i]) for i in range(stts_count)]
+        frame_count = sum(entry[0] for entry in stts_entries)
+        frame_durations = sum(entry[0] * entry[1] for entry in stts_entries)
+        if not video_stream(data, entry_start, entry_end, fourcc, stream) or not frame_durations:
+            return None
+        #without a pasp atom ffmpeg works out the aspect ratio from the display size in tkhd if it differs from the frame size
+        tkhd = find_atom(data, trak_atoms, ['tkhd'])
+        if 'sample_aspect_ratio' not in stream and tkhd:
+            size_start = tkhd[0] + (88 if data[tkhd[0]] == 1 else 76)
+            display_width, display_height = struct.unpack('>II', data[size_start:size_start + 8])
+            if (display_width >> 16, display_height >> 16) != (stream['width'], stream['height']):
+                return None
+        #ffprobe works out the real frame rate from the timestamps when the frame durations vary
+        if not (stts_count == 1 or (stts_count == 2 and stts_entries[1][0] == 1)):
+            return None
+        rate_num, rate_den = matroska.reduce_ratio(timescale, stts_entries[0][1], 2 ** 31 - 1)
+        avg_num, avg_den = matroska.reduce_ratio(timescale * frame_count, frame_durations, 2 ** 31 - 1)
+        stream['r_frame_rate'] = str(rate_num) + '/' + str(rate_den)
+        stream['avg_frame_rate'] = str(avg_num) + '/' + str(avg_den)
+        if 'bits_per_raw_sample' in stream:
+            #keep the ffprobe order of the fields
+            stream['bits_per_raw_sample'] = stream.pop('bits_per_raw_sample')
+    elif handler_type == 'soun':
+        if not audio_stream(data, entry_start, entry_end, fourcc, timescale, stream):
+            return None
+    elif handler_type == 'tmcd' and fourcc == 'tmcd':
+        #the frame rate of a timecode track is its timescale over its frame duration, as written in the sample description
+        tmcd_timescale, frame_duration = struct.unpack('>II', data[entry_start + 24:entry_start + 32])
+        stream.update({
+        'codec_type' : 'data',
+        'codec_tag_string' : fourcc,
+        'r_frame_rate' : '0/0',
+        'avg_frame_rate' : str(tmcd_timescale) + '/' + str(frame_duration)
+        })
+    else:
+        return None
+    #durations are rounded to microseconds like ffmpeg does
+    return stream, (duration * 1000000 + timescale // 2) // timescale
+
+def probe_metadata(input_file_abspath):
+    '''
+    Returns the stream and format metadata of a QuickTime file in the layout of ffprobe -show_streams -show_format
+    Only the moov atom is read, so this takes milliseconds however large the file is. Tags are not read
+    Returns None if the file has anything this reader does not describe the same way as ffprobe, so that ffprobe can be used instead
+    '''
+    try:
+        with open(input_file_abspath, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            moov = read_moov(f, file_size)
+        if not moov:
+            return None
+        moov_atoms = read_atoms(moov)
+        mvhd = find_atom(moov, moov_atoms, ['mvhd'])
+        #fragmented and compressed movies keep their metadata elsewhere
+        if not mvhd or find_atom(moov, moov_atoms, ['mvex']) or find_atom(moov, moov_atoms, ['cmov']):
+            return None
+        movie_timescale, movie_duration = timescale_duration(moov, mvhd[0])
+        if not movie_timescale:
+            return None
+        duration = (movie_duration * 1000000 + movie_timescale // 2) // movie_timescale
+        streams = []
+        for trak in [(atom[1], atom[2]) for atom in moov_atoms if atom[0] == 'trak']:
+            track = track_stream(moov, trak, len(streams))
+            if not track:
+                return None
+            streams.append(track[0])
+            #the file lasts as long as its longest track
+            duration = max(duration, track[1])
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        return None
+    if not streams:
+        return None
+    format_metadata = {
+    'filename' : input_file_abspath,
+    'nb_streams' : len(streams),
+    'nb_programs' : 0,
+    'format_name' : 'mov,mp4,m4a,3gp,3g2,mj2',
+    'format_long_name' : 'QuickTime / MOV',
+    'duration' : '%.6f' % (duration / 1000000),
+    'size' : str(file_size)
+    }
+    return {'streams' : streams, 'format' : format_metadata}
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+
+parser = argparse.ArgumentParser(description='Creates synthetic v210/MOV files and DPX sequences for benchmarking aja_mov2ffv1 and dpx2ffv1')
+parser.add_argument('--output', '-o', action='store', dest='output_path', required=True, type=str, help='full path to the folder where fixtures are created')
+parser.add_argument('--mov_count', action='store', dest='mov_count', default=3, type=int, help='number of MOV files to create. Default is 3')
+parser.add_argument('--mov_seconds', action='store', dest='mov_seconds', default=10, type=float, help='duration of each MOV file in seconds. Default is 10')
+parser.add_argument('--mov_size', action='store', dest='mov_size', default='720x486', type=str, help='frame size of the MOV files. Default is 720x486')
+parser.add_argument('--dpx_count', action='store', dest='dpx_count', default=2, type=int, help='number of DPX sequences (titles) to create. Default is 2')
+parser.add_argument('--dpx_frames', action='store', dest='dpx_frames', default=48, type=int, help='number of frames in each DPX sequence. Default is 48')
+parser.add_argument('--dpx_size', action='store', dest='dpx_size', default='2048x1556', type=str, help='frame size of the DPX files. Default is 2048x1556')
+parser.add_argument('--stub', required=False, action='store_true', help='create tiny fixtures for measuring orchestration overhead with the stub tools. Use with a large --mov_count and --dpx_count, for example 2000')
+parser.add_argument('--ffmpeg', action='store', dest='ffmpeg_path', default='ffmpeg', type=str, help='For setting a custom ffmpeg path')
+parser.add_argument('--ffprobe', action='store', dest='ffprobe_path', default='ffprobe', type=str, help='For setting a custom ffprobe path')
+args = parser.parse_args()
+
+#the stub fixtures only need to be valid files. Their size is kept small so that the tools finish almost instantly
+if args.stub:
+    args.mov_seconds = 0.1
+    args.mov_size = '48x32'
+    args.dpx_frames = 4
+    args.dpx_size = '64x36'
+
+#audio tracks are mono like the AJA captures, one tone per track so that each track has a different checksum
+audio_frequencies = [440, 550, 660, 880]
+
+def md5_file(filename):
+    '''
+    Returns the md5 of a file
+    '''
+    hash_md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+def run_ffmpeg(command):
+    try:
+        subprocess.run(command, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        print('Error running', command[0])
+        quit()
+
+def make_mov(output_abspath):
+    '''
+    Creates a v210/MOV file with 4 PCM tracks from the lavfi test sources
+    The bitexact flags leave out the encoder version and creation time so that every run creates the same file
+    '''
+    ffmpeg_command = [args.ffmpeg_path, '-y', '-v', 'error']
+    ffmpeg_command += ['-f', 'lavfi', '-i', 'testsrc2=size=' + args.mov_size + ':rate=30000/1001:duration=' + str(args.mov_seconds)]
+    for frequency in audio_frequencies:
+        ffmpeg_command += ['-f', 'lavfi', '-i', 'sine=frequency=' + str(frequency) + ':sample_rate=48000:duration=' + str(args.mov_seconds)]
+    ffmpeg_command += ['-map', '0:v']
+    for i in range(len(audio_frequencies)):
+        ffmpeg_command += ['-map', str(i + 1) + ':a']
+    ffmpeg_command += ['-c:v', 'v210', '-pix_fmt', 'yuv422p10le', '-color_primaries', 'smpte170m', '-color_trc', 'bt709', '-colorspace', 'smpte170m', '-c:a', 'pcm_s24le']
+    ffmpeg_command += ['-map_metadata', '-1', '-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact', output_abspath]
+    run_ffmpeg(ffmpeg_command)
+
+def make_dpx_sequence(title, output_folder):
+    '''
+    Creates a 10 bit RGB DPX sequence from the lavfi test source
+    Files are named title_0000001.dpx like the scanner output dpx2ffv1 expects
+    '''
+    os.makedirs(output_folder)
+    ffmpeg_command = [args.ffmpeg_path, '-y', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=' + args.dpx_size + ':rate=24', '-frames:v', str(args.dpx_frames)]
+    ffmpeg_command += ['-c:v', 'dpx', '-pix_fmt', 'gbrp10le', '-fflags', '+bitexact', '-flags:v', '+bitexact', os.path.join(output_folder, title + '_%07d.dpx')]
+    run_ffmpeg(ffmpeg_command)
+
+def copy_dpx_sequence(source_title, source_folder, title, output_folder):
+    os.makedirs(output_folder)
+    for filename in sorted(os.listdir(source_folder)):
+        shutil.copyfile(os.path.join(source_folder, filename), os.path.join(output_folder, filename.replace(source_title, title, 1)))
+
+def record_probe_template(mov_abspath, template_abspath):
+    '''
+    Saves the ffprobe output of a fixture so the stub ffprobe can return it without reading any files
+    '''
+    try:
+        probe_output = subprocess.run([args.ffprobe_path, '-v', 'error', '-show_streams', '-show_format', mov_abspath, '-of', 'json'], check=True, stdout=subprocess.PIPE).stdout
+    except (OSError, subprocess.CalledProcessError):
+        print('Error running', args.ffprobe_path)
+        quit()
+    with open(template_abspath, 'wb') as f:
+        f.write(probe_output)
+
+def main():
+    settings = {
+    'mov count' : args.mov_count,
+    'mov seconds' : args.mov_seconds,
+    'mov size' : args.mov_size,
+    'dpx count' : args.dpx_count,
+    'dpx frames' : args.dpx_frames,
+    'dpx size' : args.dpx_size,
+    'stub' : args.stub
+    }
+    manifest_abspath = os.path.join(args.output_path, 'fixtures.json')
+    if os.path.isfile(manifest_abspath):
+        with open(manifest_abspath) as f:
+            if json.load(f)['settings'] == settings:
+                print('fixtures with the same settings already exist in', args.output_path)
+                return
+        print('removing fixtures created with different settings')
+    for folder in ['mov', 'dpx']:
+        shutil.rmtree(os.path.join(args.output_path, folder), ignore_errors=True)
+    mov_folder = os.path.join(args.output_path, 'mov')
+    dpx_folder = os.path.join(args.output_path, 'dpx')
+    os.makedirs(mov_folder)
+    os.makedirs(dpx_folder)
+
+    #only the first file of each type is encoded. The rest are copies, which keeps fixtures for thousands of files quick to create
+    print('*creating', args.mov_count, 'MOV files*')
+    mov_list = ['bench' + str(i + 1).zfill(5) + '.mov' for i in range(args.mov_count)]
+    for mov_filename in mov_list:
+        mov_abspath = os.path.join(mov_folder, mov_filename)
+        if mov_filename == mov_list[0]:
+            make_mov(mov_abspath)
+        else:
+            shutil.copyfile(os.path.join(mov_folder, mov_list[0]), mov_abspath)
+
+    print('*creating', args.dpx_count, 'DPX sequences*')
+    title_list = ['bench' + str(i + 1).zfill(5) for i in range(args.dpx_count)]
+    for title in title_list:
+        title_folder = os.path.join(dpx_folder, title, 'pm')
+        if title == title_list[0]:
+            make_dpx_sequence(title, title_folder)
+        else:
+            copy_dpx_sequence(title_list[0], os.path.join(dpx_folder, title_list[0], 'pm'), title, title_folder)
+
+    fixture_hashes = {}
+    if mov_list:
+        fixture_hashes['mov'] = md5_file(os.path.join(mov_folder, mov_list[0]))
+        record_probe_template(os.path.join(mov_folder, mov_list[0]), os.path.join(args.output_path, 'probe_template.json'))
+    if title_list:
+        first_dpx_folder = os.path.join(dpx_folder, title_list[0], 'pm')
+        fixture_hashes['dpx'] = md5_file(os.path.join(first_dpx_folder, sorted(os.listdir(first_dpx_folder))[0]))
+
+    #the hashes identify the fixtures in stored benchmark results, so results from different inputs are not compared
+    with open(manifest_abspath, 'w') as f:
+        json.dump({'settings' : settings, 'hashes' : fixture_hashes}, f, indent=4)
+    print('fixtures created in', args.output_path)
+
+if __name__ == "__main__":
+    if sys.version_info[0] < 3:
+        raise Exception("Python 3 or a more recent version is required.")
+    main()
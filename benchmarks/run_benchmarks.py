@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import shutil
+import platform
+import datetime
+import subprocess
+
+parser = argparse.ArgumentParser(description='Measures end-to-end and per-stage throughput of aja_mov2ffv1 and dpx2ffv1 on fixtures made by make_fixtures.py and compares the results with earlier runs')
+parser.add_argument('--fixtures', '-f', action='store', dest='fixtures_path', required=True, type=str, help='full path to the folder created by make_fixtures.py')
+parser.add_argument('--work', '-w', action='store', dest='work_path', required=True, type=str, help='full path to a scratch folder for the pipeline outputs. Outputs from earlier benchmark runs in this folder are deleted')
+parser.add_argument('--pipeline', action='store', dest='pipeline', default='all', choices=['mov', 'rawcooked', 'all'], help='pipeline to benchmark. Default is all')
+parser.add_argument('--stub', required=False, action='store_true', help='use the stub ffprobe, mediaconch, qcli and rawcooked in the stub_tools folder to measure orchestration overhead. ffmpeg is still the real ffmpeg')
+parser.add_argument('--repeat', action='store', dest='repeat', default=1, type=int, help='number of times each pipeline is run. The run with the median wall time is stored. Default is 1')
+parser.add_argument('--results', action='store', dest='results_path', type=str, help='file where results are stored, one json line per run. Defaults to results.jsonl in the fixtures folder')
+parser.add_argument('--label', action='store', dest='label', default='', type=str, help='note stored with the results, for example the change being measured')
+parser.add_argument('--threshold', action='store', dest='threshold', default=10, type=float, help='percent increase in a time over the previous matching run that is reported as a regression. Default is 10')
+parser.add_argument('--min_change', action='store', dest='min_change', default=0.1, type=float, help='smallest increase in seconds that is reported as a regression, so that very short stages are not reported because of timing noise. Default is 0.1')
+parser.add_argument('--mov_args', action='store', dest='mov_args', default='', type=str, help='extra arguments for aja_mov2ffv1 in quotes, for example "-j 2 --skipqcli"')
+parser.add_argument('--rawcooked_args', action='store', dest='rawcooked_args', default='', type=str, help='extra arguments for dpx2ffv1 in quotes, for example "-j 2 --io_jobs 2"')
+args = parser.parse_args()
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+stub_tools_path = os.path.join(repo_path, 'benchmarks', 'stub_tools')
+
+def pipeline_command(pipeline, output_path, run_path):
+    '''
+    Returns the command and working folder for a pipeline
+    The ffprobe and tool caches are kept in the run folder so every run starts cold
+    '''
+    common_args = ['-o', output_path, '--probe_cache', os.path.join(run_path, 'probe_cache'), '--tool_cache', os.path.join(run_path, 'tools.json'), '--metrics_file', os.path.join(run_path, 'metrics.prom')]
+    if pipeline == 'mov':
+        command = [sys.executable, 'run.py', '-i', os.path.join(args.fixtures_path, 'mov')] + common_args + shlex.split(args.mov_args)
+        return command, os.path.join(repo_path, 'aja_mov2ffv1')
+    command = [sys.executable, 'dpx2ffv1.py', '-i', os.path.join(args.fixtures_path, 'dpx')] + common_args + shlex.split(args.rawcooked_args)
+    return command, os.path.join(repo_path, 'rawcooked')
+
+def parse_metrics(metrics_abspath):
+    '''
+    Reads the Prometheus text file written by --metrics_file
+    Stage values are summed over every item. Returns the stage totals, tool totals and batch values
+    '''
+    stages = {}
+    tools = {}
+    batch = {}
+    stage_metrics = {'transcode_stage_seconds' : 'seconds', 'transcode_stage_read_bytes' : 'read bytes', 'transcode_stage_written_bytes' : 'written bytes'}
+    tool_metrics = {'transcode_tool_commands' : 'commands', 'transcode_tool_failed_commands' : 'failed', 'transcode_tool_seconds' : 'seconds', 'transcode_tool_user_cpu_seconds' : 'user cpu', 'transcode_tool_system_cpu_seconds' : 'system cpu'}
+    with open(metrics_abspath) as f:
+        for line in f:
+            metric_match = re.match(r'(\w+)\{(.*)\} (\S+)$', line.rstrip('\n'))
+            if not metric_match:
+                continue
+            metric_name, labels, value = metric_match.groups()
+            labels = {key : value.replace('\\"', '"').replace('\\\\', '\\') for key, value in re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels)}
+            value = float(value)
+            if metric_name in stage_metrics:
+                stage = stages.setdefault(labels['stage'], {'seconds' : 0, 'read bytes' : 0, 'written bytes' : 0, 'items' : set()})
+                stage[stage_metrics[metric_name]] += value
+                stage['items'].add(labels['item'])
+            elif metric_name in tool_metrics:
+                tool = tools.setdefault(labels['command'], {})
+                tool[tool_metrics[metric_name]] = value
+            elif metric_name == 'transcode_batch_seconds':
+                batch['seconds'] = value
+            elif metric_name == 'transcode_batch_items':
+                batch['items'] = int(value)
+    for stage in stages.values():
+        stage['items'] = len(stage['items'])
+    return stages, tools, batch
+
+def run_pipeline(pipeline, run_path):
+    '''
+    Runs a pipeline once and measures its wall time and the CPU time of the script and every tool it ran
+    '''
+    shutil.rmtree(run_path, ignore_errors=True)
+    output_path = os.path.join(run_path, 'output')
+    os.makedirs(output_path)
+    command, working_folder = pipeline_command(pipeline, output_path, run_path)
+    environment = dict(os.environ)
+    environment['BENCHMARK_PROBE_TEMPLATE'] = os.path.join(args.fixtures_path, 'probe_template.json')
+    if args.stub:
+        environment['PATH'] = stub_tools_path + os.pathsep + environment['PATH']
+    log_abspath = os.path.join(run_path, 'console.log')
+    start_time = time.perf_counter()
+    with open(log_abspath, 'w') as log:
+        process = subprocess.Popen(command, cwd=working_folder, env=environment, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        #wait4 returns the resource usage of the script together with every tool it waited for
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    wall_time = time.perf_counter() - start_time
+
+    #the scripts exit with status 0 after printing most errors, so a missing metrics file also means the run failed
+    metrics_abspath = os.path.join(run_path, 'metrics.prom')
+    if process.returncode != 0 or not os.path.isfile(metrics_abspath):
+        print(pipeline, 'benchmark failed. See', log_abspath)
+        quit()
+    stages, tools, batch = parse_metrics(metrics_abspath)
+    items = batch.get('items', 0)
+    tool_cpu = sum(tool.get('user cpu', 0) + tool.get('system cpu', 0) for tool in tools.values())
+    total_cpu = rusage.ru_utime + rusage.ru_stime
+    #CPU time that was not spent in a tool is the overhead of the scripts themselves
+    orchestration_cpu = max(total_cpu - tool_cpu, 0)
+    stage_results = {}
+    for stage_name, stage in stages.items():
+        stage_results[stage_name] = {
+        'seconds' : round(stage['seconds'], 3),
+        'items' : stage['items'],
+        'read MB/s' : round(stage['read bytes'] / 1000000 / stage['seconds'], 1) if stage['seconds'] else None,
+        'write MB/s' : round(stage['written bytes'] / 1000000 / stage['seconds'], 1) if stage['seconds'] else None
+        }
+    return {
+    'wall time' : round(wall_time, 3),
+    'items' : items,
+    'items/s' : round(items / wall_time, 3) if wall_time else None,
+    'cpu time' : round(total_cpu, 3),
+    'tool cpu time' : round(tool_cpu, 3),
+    'orchestration cpu time' : round(orchestration_cpu, 3),
+    'orchestration cpu ms per item' : round(orchestration_cpu * 1000 / items, 2) if items else None,
+    'tool commands' : int(sum(tool.get('commands', 0) for tool in tools.values())),
+    'stages' : stage_results
+    }
+
+def compare_results(previous_record, result):
+    '''
+    Prints the change in each time against the previous matching run
+    Returns a list of the times that went up by more than the threshold
+    '''
+    previous = previous_record['result']
+    #the last value in each tuple is the smallest increase that counts as a regression, in the units of that value
+    comparison_list = [(key, previous.get(key), result.get(key), args.min_change) for key in ['wall time', 'orchestration cpu time']]
+    comparison_list.append(('orchestration cpu ms per item', previous.get('orchestration cpu ms per item'), result.get('orchestration cpu ms per item'), 0))
+    for stage_name in sorted(result['stages']):
+        if stage_name in previous['stages']:
+            comparison_list.append((stage_name + ' seconds', previous['stages'][stage_name]['seconds'], result['stages'][stage_name]['seconds'], args.min_change))
+    print('compared with', previous_record['date'], previous_record.get('label') or previous_record.get('commit') or '')
+    regressions = []
+    for name, previous_value, value, min_change in comparison_list:
+        if not previous_value or value is None:
+            continue
+        change = (value - previous_value) * 100 / previous_value
+        note = ''
+        if change > args.threshold and value - previous_value >= min_change:
+            note = '  REGRESSION'
+            regressions.append(name)
+        print('\t' + name + ':', previous_value, '->', value, '(' + format(change, '+.1f') + '%)' + note)
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    manifest_abspath = os.path.join(args.fixtures_path, 'fixtures.json')
+    if not os.path.isfile(manifest_abspath):
+        print('No fixtures found in', args.fixtures_path + '. Create them with make_fixtures.py')
+        quit()
+    with open(manifest_abspath) as f:
+        fixtures = json.load(f)
+    results_abspath = args.results_path or os.path.join(args.fixtures_path, 'results.jsonl')
+    previous_records = []
+    if os.path.isfile(results_abspath):
+        with open(results_abspath) as f:
+            previous_records = [json.loads(line) for line in f if line.strip()]
+
+    pipeline_list = ['mov', 'rawcooked'] if args.pipeline == 'all' else [args.pipeline]
+    regressions = []
+    for pipeline in pipeline_list:
+        pipeline_args = args.mov_args if pipeline == 'mov' else args.rawcooked_args
+        run_list = []
+        for i in range(args.repeat):
+            print('***Benchmarking', pipeline, 'run', str(i + 1), 'of', str(args.repeat) + '***')
+            run_list.append(run_pipeline(pipeline, os.path.join(args.work_path, pipeline, 'run' + str(i + 1))))
+            print('\twall time', run_list[-1]['wall time'], 's,', run_list[-1]['items'], 'items,', run_list[-1]['orchestration cpu ms per item'], 'ms orchestration cpu per item')
+        result = sorted(run_list, key=lambda run: run['wall time'])[len(run_list) // 2]
+        for stage_name, stage in sorted(result['stages'].items()):
+            stage_line = '\t' + stage_name + ': ' + str(stage['seconds']) + ' s'
+            if stage['read MB/s'] is not None:
+                stage_line += ', ' + str(stage['read MB/s']) + ' MB/s read, ' + str(stage['write MB/s']) + ' MB/s written'
+            print(stage_line)
+
+        record = {
+        'date' : datetime.datetime.now().isoformat(timespec='seconds'),
+        'label' : args.label,
+        'commit' : git_commit(),
+        'pipeline' : pipeline,
+        'stub' : args.stub,
+        'arguments' : pipeline_args,
+        'fixtures' : fixtures,
+        'python' : platform.python_version(),
+        'host' : platform.node(),
+        'wall times' : [run['wall time'] for run in run_list],
+        'result' : result
+        }
+        #only runs of the same pipeline, with the same fixtures, arguments and tools are compared
+        matching_records = [previous for previous in previous_records if all(previous.get(key) == record[key] for key in ['pipeline', 'stub', 'arguments', 'fixtures', 'host'])]
+        if matching_records:
+            regressions += [pipeline + ' ' + name for name in compare_results(matching_records[-1], result)]
+        with open(results_abspath, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    print('results saved to', results_abspath)
+    if regressions:
+        print('***Regressions***')
+        print('\n'.join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    if sys.version_info[0] < 3:
+        raise Exception("Python 3 or a more recent version is required.")
+    main()
@@ -7,9 +7,25 @@ input, output, checksumming, checking that software exists, etc.
 '''
 
 import os
+import io
+import mmap
 import hashlib
 import sys
 import subprocess
+import json
+import shutil
+import threading
+import sqlite3
+import datetime
+import contextlib
+import time
+import concurrent.futures
+try:
+    import fcntl
+except ImportError:
+    #fcntl is not available on Windows
+    fcntl = None
+import matroska
 from dpx2ffv1parameters import args
 
 def input_check():
@@ -43,30 +59,301 @@ def output_check():
         quit()
     return (outdir)
 
+def digest_list():
+    '''
+    Returns the checksum algorithms given with --digests
+    md5 is always included because the md5 sidecars and the journal use it
+    '''
+    digest_names = ['md5'] + [digest_name.strip().lower() for digest_name in args.digests.split(',') if digest_name.strip()]
+    return list(dict.fromkeys(digest_names))
+
+def digests_check():
+    '''
+    checks that hashlib supports every algorithm given with --digests and that --read_block_size is valid
+    '''
+    for digest_name in digest_list():
+        try:
+            hashlib.new(digest_name).hexdigest()
+        except (ValueError, TypeError):
+            #shake algorithms are also rejected because their hexdigest needs a length
+            print("Unsupported checksum algorithm:", digest_name)
+            quit()
+    if args.read_block_size < 1:
+        print("--read_block_size must be at least 1")
+        quit()
+
+#threads that update the checksums of one read at the same time. hashlib releases the GIL while hashing large buffers
+digest_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+class MultiDigest:
+    '''
+    Creates a checksum for every algorithm in --digests from the same reads of a file
+    Can be used anywhere a single hashlib object is updated
+    '''
+    def __init__(self, digest_names=None):
+        self.digests = {digest_name : hashlib.new(digest_name) for digest_name in (digest_names or digest_list())}
+
+    def update(self, buf):
+        if len(self.digests) == 1:
+            for digest in self.digests.values():
+                digest.update(buf)
+        else:
+            list(digest_executor.map(lambda digest: digest.update(buf), self.digests.values()))
+
+    def hexdigests(self):
+        return {digest_name : digest.hexdigest() for digest_name, digest in self.digests.items()}
+
+#buffer that read_blocks reads into, one for each thread so it is reused from file to file
+read_buffers = threading.local()
+#pages that have been read are dropped from the page cache in steps of this many bytes
+page_cache_drop_size = 64 * 2**20
+
+def open_for_reading(filename):
+    '''
+    Opens a file for read_blocks and returns its file descriptor and whether it bypasses the page cache
+    With --direct_io the file is opened with O_DIRECT (F_NOCACHE on macOS) if the filesystem allows it
+    '''
+    if args.direct_io and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(filename, os.O_RDONLY | os.O_DIRECT), True
+        except OSError:
+            #some filesystems, like tmpfs and many network filesystems, do not support O_DIRECT
+            pass
+    fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    if args.direct_io and fcntl and hasattr(fcntl, 'F_NOCACHE'):
+        fcntl.fcntl(fd, fcntl.F_NOCACHE, 1)
+        return fd, True
+    return fd, False
+
+def read_blocks(filename, progress=False):
+    '''
+    Reads a file from start to end with readinto and yields a memoryview of each block
+    The same buffer is used for every block, so a view is only valid until the next block is read
+    Unless --keep_page_cache is used, pages are dropped from the page cache once they have been read
+    so that hashing large files does not push out data that running encodes are using
+    If progress is True, the percent read is printed once a second
+    Progress is only printed to a terminal when one job is running, as it is rewritten in place with a carriage return
+    '''
+    progress = progress and args.jobs == 1 and args.io_jobs == 1 and sys.stdout.isatty()
+    block_size = args.read_block_size * 2**20
+    #a thread that is already reading a file gets a buffer of its own
+    reuse_buffer = not getattr(read_buffers, 'in_use', False)
+    buffer = getattr(read_buffers, 'buffer', None) if reuse_buffer else None
+    if buffer is None or len(buffer) != block_size:
+        #anonymous mmaps are page aligned, which O_DIRECT needs
+        buffer = mmap.mmap(-1, block_size)
+        if reuse_buffer:
+            read_buffers.buffer = buffer
+    if reuse_buffer:
+        read_buffers.in_use = True
+    fd, direct = open_for_reading(filename)
+    try:
+        with io.FileIO(fd, 'rb', closefd=False) as f:
+            total_size = os.fstat(fd).st_size
+            drop_pages = not direct and not args.keep_page_cache and hasattr(os, 'posix_fadvise')
+            if hasattr(os, 'posix_fadvise') and not direct:
+                #lets the kernel read further ahead of the hashing
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            read_size = 0
+            dropped_size = 0
+            last_progress_time = time.time()
+            view = memoryview(buffer)
+            while True:
+                block_read_size = f.readinto(view)
+                if not block_read_size:
+                    break
+                yield view[:block_read_size]
+                read_size += block_read_size
+                if drop_pages and read_size - dropped_size >= page_cache_drop_size:
+                    os.posix_fadvise(fd, dropped_size, read_size - dropped_size, os.POSIX_FADV_DONTNEED)
+                    dropped_size = read_size
+                if progress and time.time() - last_progress_time >= 1:
+                    sys.stdout.write('[%d%%]\r' % (100 * read_size / total_size))
+                    sys.stdout.flush()
+                    last_progress_time = time.time()
+            if drop_pages and read_size > dropped_size:
+                os.posix_fadvise(fd, dropped_size, 0, os.POSIX_FADV_DONTNEED)
+            if progress and total_size:
+                sys.stdout.write('[100%]\n')
+                sys.stdout.flush()
+    finally:
+        os.close(fd)
+        if reuse_buffer:
+            read_buffers.in_use = False
+
+def hashlib_digests(filename, digest_names=None):
+    '''
+    Uses hashlib to return a checksum of an input filename for each algorithm in --digests
+    The file is only read once however many algorithms are used
+    Returns {algorithm : checksum}
+    '''
+    chksm = MultiDigest(digest_names)
+    for buf in read_blocks(filename, progress=True):
+        chksm.update(buf)
+    return chksm.hexdigests()
+
 def hashlib_md5(filename):
     '''
     Uses hashlib to return an MD5 checksum of an input filename
-    Credit: IFI scripts
-    '''
-    read_size = 0
-    last_percent_done = 0
-    chksm = hashlib.md5()
-    total_size = os.path.getsize(filename)
-    with open(filename, 'rb') as f:
-        while True:
-            #2**20 is for reading the file in 1 MiB chunks
-            buf = f.read(2**20)
-            if not buf:
-                break
-            read_size += len(buf)
-            chksm.update(buf)
-            percent_done = 100 * read_size / total_size
-            if percent_done > last_percent_done:
-                sys.stdout.write('[%d%%]\r' % percent_done)
-                sys.stdout.flush()
-                last_percent_done = percent_done
-    md5_output = chksm.hexdigest()
-    return md5_output
+    '''
+    return hashlib_digests(filename, ['md5'])['md5']
+
+def digest_sidecar_list(sidecar_base):
+    '''
+    Returns the checksum sidecar files for a file, one for each algorithm in --digests (file.md5, file.sha256, ...)
+    '''
+    return [sidecar_base + '.' + digest_name for digest_name in digest_list()]
+
+def write_digest_sidecars(digests, filename, sidecar_base):
+    '''
+    Writes a checksum sidecar file for each algorithm in digests in the same format as the md5 sidecar
+    '''
+    for digest_name in digests:
+        with open (sidecar_base + '.' + digest_name, 'w',  newline='\n') as f:
+            print(digests[digest_name], '*' + filename, file=f)
+
+#resource usage of every command run by this process, formatted as {item : [records]}
+command_records = {}
+command_records_lock = threading.Lock()
+#the item (file or title) that commands run by the current thread are counted against
+command_context = threading.local()
+
+def set_command_item(item):
+    '''
+    Sets the item that commands run by the current thread are counted against
+    '''
+    command_context.item = item
+
+def get_command_item():
+    return getattr(command_context, 'item', 'batch')
+
+class AccountedPopen(subprocess.Popen):
+    '''
+    Popen whose wait() reaps the child with os.wait4 so that the child's resource usage can be recorded
+    communicate() and leaving a with block also go through wait()
+    rusage stays None if the child was reaped some other way, for example by poll() or wait() with a timeout,
+    and on systems without os.wait4 (Windows)
+    '''
+    rusage = None
+
+    def wait(self, timeout=None):
+        if self.returncode is None and timeout is None and hasattr(os, 'wait4'):
+            try:
+                pid, sts, rusage = os.wait4(self.pid, 0)
+            except ChildProcessError:
+                #the child was reaped elsewhere, Popen.wait below reports what it knows
+                pass
+            else:
+                self.rusage = rusage
+                self.returncode = -os.WTERMSIG(sts) if os.WIFSIGNALED(sts) else os.WEXITSTATUS(sts)
+        return super().wait(timeout)
+
+def record_command(process, start_time):
+    '''
+    Records the exit status, duration, CPU time and peak memory use of a finished AccountedPopen process
+    '''
+    command_record = {
+    'tool' : os.path.basename(process.args[0]),
+    'exit status' : process.returncode,
+    'wall time' : round(time.time() - start_time, 3),
+    'user cpu' : None,
+    'system cpu' : None,
+    'peak rss MB' : None
+    }
+    if process.rusage:
+        command_record['user cpu'] = round(process.rusage.ru_utime, 3)
+        command_record['system cpu'] = round(process.rusage.ru_stime, 3)
+        #ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak_rss = process.rusage.ru_maxrss if sys.platform == 'darwin' else process.rusage.ru_maxrss * 1024
+        command_record['peak rss MB'] = round(peak_rss / 1024**2, 1)
+    with command_records_lock:
+        command_records.setdefault(get_command_item(), []).append(command_record)
+    return command_record
+
+def run_command(command, check=False, input=None, **kwargs):
+    '''
+    Runs a command like subprocess.run and records its resource usage
+    '''
+    start_time = time.time()
+    #input is sent through a pipe in place of any stdin that was given
+    stdin = kwargs.pop('stdin', None)
+    if input is not None:
+        stdin = subprocess.PIPE
+    with AccountedPopen(command, stdin=stdin, **kwargs) as process:
+        stdout, stderr = process.communicate(input)
+    record_command(process, start_time)
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+def command_summary(record_list):
+    '''
+    Totals a list of command records by tool
+    Returns {tool : {'commands', 'failed', 'wall time', 'user cpu', 'system cpu', 'peak rss MB'}}
+    '''
+    summary = {}
+    for command_record in record_list:
+        tool_summary = summary.setdefault(command_record['tool'], {'commands' : 0, 'failed' : 0, 'wall time' : 0, 'user cpu' : 0, 'system cpu' : 0, 'peak rss MB' : 0})
+        add_command_summary(tool_summary, {
+        'commands' : 1,
+        'failed' : 1 if command_record['exit status'] else 0,
+        'wall time' : command_record['wall time'],
+        'user cpu' : command_record['user cpu'] or 0,
+        'system cpu' : command_record['system cpu'] or 0,
+        'peak rss MB' : command_record['peak rss MB'] or 0
+        })
+    return summary
+
+def add_command_summary(total_summary, tool_summary):
+    '''
+    Adds one tool summary to another. Peak memory is the highest of the two rather than the sum
+    '''
+    for key in ['commands', 'failed', 'wall time', 'user cpu', 'system cpu']:
+        total_summary[key] = round(total_summary[key] + tool_summary[key], 3)
+    total_summary['peak rss MB'] = max(total_summary['peak rss MB'], tool_summary['peak rss MB'])
+
+def item_command_summary(item, clear=True):
+    '''
+    Returns the command summary of an item
+    Its records are removed unless clear is False
+    '''
+    with command_records_lock:
+        if clear:
+            record_list = command_records.pop(item, [])
+        else:
+            record_list = list(command_records.get(item, []))
+    return command_summary(record_list)
+
+def batch_command_summary(summary_list):
+    '''
+    Combines the command summaries of every item in a batch
+    '''
+    batch_summary = {}
+    for summary in summary_list:
+        for tool, tool_summary in summary.items():
+            add_command_summary(batch_summary.setdefault(tool, {'commands' : 0, 'failed' : 0, 'wall time' : 0, 'user cpu' : 0, 'system cpu' : 0, 'peak rss MB' : 0}), tool_summary)
+    return batch_summary
+
+#held while a message is written so that messages from titles running at the same time are not mixed together
+print_lock = threading.Lock()
+
+def print_message(*values):
+    '''
+    Prints the values separated by spaces as one line, written in a single call while holding print_lock
+    '''
+    message = ' '.join(str(value) for value in values) + '\n'
+    with print_lock:
+        sys.stdout.write(message)
+        sys.stdout.flush()
+
+def print_command_summary(summary):
+    '''
+    Prints the resource usage of each tool
+    '''
+    print ("tool resource usage:")
+    for tool in sorted(summary):
+        tool_summary = summary[tool]
+        print ('\t' + tool + ':', tool_summary['commands'], 'commands,', tool_summary['failed'], 'failed, wall time %(wall time).1fs, user cpu %(user cpu).1fs, system cpu %(system cpu).1fs, peak rss %(peak rss MB).1f MB' % tool_summary)
 
 def mediaconch_policy_exists(policy_path):
     '''
@@ -77,14 +364,58 @@ def mediaconch_policy_exists(policy_path):
         print("Check if file exists before running")
         quit()
 
+#cache of tool versions and capabilities that have already been loaded by this process
+tool_memory_cache = {}
+tool_cache_loaded = False
+tool_cache_lock = threading.Lock()
+
+def tool_capabilities(tool_path, version_flag):
+    '''
+    Returns the version output of a tool
+    Results are cached on disk by resolved path, size and modification time so that a tool is only run again when it changes
+    '''
+    resolved_path = shutil.which(tool_path)
+    if not resolved_path:
+        raise FileNotFoundError(tool_path)
+    resolved_path = os.path.realpath(resolved_path)
+    tool_stat = os.stat(resolved_path)
+    cache_key = resolved_path + '|' + str(tool_stat.st_size) + '|' + str(tool_stat.st_mtime_ns) + '|' + version_flag
+    global tool_cache_loaded
+    with tool_cache_lock:
+        #load the persisted cache once per process
+        if not tool_cache_loaded and not args.no_tool_cache:
+            tool_cache_loaded = True
+            try:
+                with open(args.tool_cache, encoding='utf-8') as f:
+                    tool_memory_cache.update(json.load(f))
+            except (FileNotFoundError, ValueError):
+                pass
+        capabilities = tool_memory_cache.get(cache_key)
+        if capabilities:
+            return capabilities
+        capabilities = {
+        'path' : resolved_path,
+        'version output' : run_command([tool_path, version_flag], check=True, stdout=subprocess.PIPE).stdout.decode("utf-8", errors="replace").rstrip()
+        }
+        tool_memory_cache[cache_key] = capabilities
+        if not args.no_tool_cache:
+            #write to a temporary file first so that parallel jobs never read a partially written cache
+            try:
+                os.makedirs(os.path.dirname(args.tool_cache), exist_ok=True)
+                temp_cache_file = args.tool_cache + '.' + str(os.getpid()) + '.tmp'
+                with open(temp_cache_file, 'w', encoding='utf-8') as f:
+                    json.dump(tool_memory_cache, f, indent=4)
+                os.replace(temp_cache_file, args.tool_cache)
+            except OSError:
+                print("unable to write to tool cache:", args.tool_cache)
+    return capabilities
+
 def ffprobe_check():
     '''
     checks that ffprobe exists by running its -version command
     '''
     try:
-        subprocess.check_output([
-            args.ffprobe_path, '-version'
-        ]).decode("ascii").rstrip().splitlines()[0].split()[2]
+        tool_capabilities(args.ffprobe_path, '-version')['version output'].splitlines()[0].split()[2]
     except:
         print("Error locating ffprobe")
         quit()
@@ -94,9 +425,7 @@ def mediaconch_check():
     checks that mediaconch exists by running its -v command
     '''
     try:
-        subprocess.check_output([
-            args.mediaconch_path, '-v'
-        ]).decode("ascii").rstrip().splitlines()[0]
+        tool_capabilities(args.mediaconch_path, '-v')['version output'].splitlines()[0]
     except:
         print('Error locating mediaconch')
         quit()
@@ -106,9 +435,7 @@ def qcli_check():
     checks that qcli exists by running its -version command
     '''
     try:
-        subprocess.check_output([
-            args.qcli_path, '-version'
-        ]).decode("ascii").rstrip().splitlines()[0]
+        tool_capabilities(args.qcli_path, '-version')['version output'].splitlines()[0]
     except:
         print('Error locating qcli')
         quit()
@@ -118,9 +445,7 @@ def mediainfo_check():
     checks that qcli exists by running its -version command
     '''
     try:
-        mediainfo_version = subprocess.check_output([
-            args.mediainfo_path, '--version'
-        ]).decode("ascii").rstrip().splitlines()[1].split()[2]
+        mediainfo_version = tool_capabilities(args.mediainfo_path, '--version')['version output'].splitlines()[1].split()[2]
     except:
         print('Error locating mediainfo')
         quit()
@@ -131,9 +456,7 @@ def get_ffmpeg_version():
     '''
     ffmpeg_version = 'ffmpeg'
     try:
-        ffmpeg_version = subprocess.check_output([
-            args.ffmpeg_path, '-version'
-        ]).decode("ascii").rstrip().splitlines()[0].split()[2]
+        ffmpeg_version = tool_capabilities(args.ffmpeg_path, '-version')['version output'].splitlines()[0].split()[2]
     except:
         print ("Error getting ffmpeg version")
         quit()
@@ -145,10 +468,424 @@ def get_rawcooked_version():
     '''
     rawcooked_version = 'rawcooked'
     try:
-        rawcooked_version = subprocess.check_output([
-            args.rawcooked_path, '--version'
-        ]).decode("ascii").rstrip().split()[1]
+        rawcooked_version = tool_capabilities(args.rawcooked_path, '--version')['version output'].split()[1]
     except:
         print ("Error getting rawcooked version")
         quit()
     return rawcooked_version
+
+#cache of ffprobe results that have already been loaded by this process
+probe_memory_cache = {}
+
+def ffprobe_json(input_file_abspath):
+    '''
+    Returns the stream and format metadata of a file from a single ffprobe call, or from the Matroska reader for MKVs
+    ffprobe results are cached on disk by path, size and modification time so that a file is only probed once
+    '''
+    input_file_abspath = os.path.abspath(input_file_abspath)
+    file_stat = os.stat(input_file_abspath)
+    cache_key = hashlib.sha1((input_file_abspath + '|' + str(file_stat.st_size) + '|' + str(file_stat.st_mtime_ns)).encode('utf-8')).hexdigest()
+    if cache_key in probe_memory_cache:
+        return probe_memory_cache[cache_key]
+    #MKVs are read directly, which is much quicker than starting ffprobe
+    #the reader returns None for anything it does not describe the same way as ffprobe
+    if os.path.splitext(input_file_abspath)[1].lower() == '.mkv' and not args.ffprobe_mkv:
+        probe_output = matroska.probe_metadata(input_file_abspath)
+        if probe_output:
+            probe_memory_cache[cache_key] = probe_output
+            return probe_output
+    cache_file = None
+    if not args.no_probe_cache:
+        cache_file = os.path.join(args.probe_cache, cache_key + '.json')
+        try:
+            with open(cache_file, encoding='utf-8') as f:
+                probe_output = json.load(f)['ffprobe']
+            probe_memory_cache[cache_key] = probe_output
+            return probe_output
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+    probe_output = json.loads(run_command([args.ffprobe_path, '-v', 'error', '-show_streams', '-show_format', input_file_abspath, '-of', 'json'], check=True, stdout=subprocess.PIPE).stdout.decode("utf-8").rstrip())
+    probe_output.setdefault('streams', [])
+    probe_output.setdefault('format', {})
+    probe_memory_cache[cache_key] = probe_output
+    if cache_file:
+        #write to a temporary file first so that parallel jobs never read a partially written cache entry
+        try:
+            os.makedirs(args.probe_cache, exist_ok=True)
+            temp_cache_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+            with open(temp_cache_file, 'w', encoding='utf-8') as f:
+                json.dump({'path' : input_file_abspath, 'size' : file_stat.st_size, 'mtime' : file_stat.st_mtime_ns, 'ffprobe' : probe_output}, f)
+            os.replace(temp_cache_file, cache_file)
+        except OSError:
+            print("unable to write to ffprobe cache:", args.probe_cache)
+    return probe_output
+
+def ffprobe_streams(input_file_abspath, codec_type):
+    '''
+    Returns the ffprobe stream metadata of a file for a single codec type (video, audio, data, attachment)
+    '''
+    return [stream for stream in ffprobe_json(input_file_abspath)['streams'] if stream.get('codec_type') == codec_type]
+
+def journal_path(outdir):
+    '''
+    Returns the path of the job journal for an output folder
+    '''
+    return os.path.join(outdir, 'transcode_journal.sqlite')
+
+def open_journal(journal_abspath):
+    '''
+    Opens the job journal, creating it if needed
+    The journal records the stages each item has finished, the outputs of each stage, its result and how long it took
+    '''
+    connection = sqlite3.connect(journal_abspath, timeout=60)
+    #the output folder is often a network share, where WAL's shared memory index does not work, so the default rollback journal is used
+    #the journal mode is saved in the database, so journals made by earlier versions that used WAL are switched back
+    connection.execute('PRAGMA journal_mode=DELETE')
+    connection.execute('CREATE TABLE IF NOT EXISTS stages (item TEXT, stage TEXT, outputs TEXT, result TEXT, timing TEXT, finished TEXT, PRIMARY KEY (item, stage))')
+    return connection
+
+def journal_record(journal_abspath, item, stage, output_list=None, result=None, hash_dict=None, timing=None):
+    '''
+    Records that a stage has finished for an item
+    The size and modification time of each output that exists are saved along with its md5 checksum if it is known
+    '''
+    if output_list is None:
+        output_list = []
+    if hash_dict is None:
+        hash_dict = {}
+    if args.no_journal:
+        return
+    outputs = {}
+    for output_abspath in output_list:
+        if os.path.isfile(output_abspath):
+            output_stat = os.stat(output_abspath)
+            outputs[output_abspath] = {'size' : output_stat.st_size, 'mtime' : output_stat.st_mtime_ns, 'md5' : hash_dict.get(output_abspath)}
+    finished = datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+    with contextlib.closing(open_journal(journal_abspath)) as connection, connection:
+        connection.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)', (item, stage, json.dumps(outputs), json.dumps(result, default=str), json.dumps(timing), finished))
+
+def journal_lookup(journal_abspath, item, stage):
+    '''
+    Returns {'result': result, 'timing': timing} if a stage has finished for an item and all of its outputs still match, otherwise None
+    Outputs whose size and modification time are unchanged are trusted. If only the modification time has changed, the output is checked against its md5 checksum
+    '''
+    if args.no_journal or not os.path.isfile(journal_abspath):
+        return None
+    with contextlib.closing(open_journal(journal_abspath)) as connection:
+        item_rows = connection.execute('SELECT stage, outputs, result, timing FROM stages WHERE item = ?', (item,)).fetchall()
+    stage_rows = [row for row in item_rows if row[0] == stage]
+    if not stage_rows:
+        return None
+    #a checksum of an output may have been recorded by a later stage, for example the mkv checksum
+    known_md5s = {}
+    for row in item_rows:
+        for output_abspath, recorded in json.loads(row[1]).items():
+            if recorded['md5']:
+                known_md5s[output_abspath] = recorded['md5']
+    for output_abspath, recorded in json.loads(stage_rows[0][1]).items():
+        if not os.path.isfile(output_abspath):
+            return None
+        output_stat = os.stat(output_abspath)
+        if output_stat.st_size != recorded['size']:
+            return None
+        if output_stat.st_mtime_ns != recorded['mtime']:
+            if not output_abspath in known_md5s or hashlib_md5(output_abspath) != known_md5s[output_abspath]:
+                return None
+    return {'result' : json.loads(stage_rows[0][2]), 'timing' : json.loads(stage_rows[0][3])}
+
+def journal_reset(journal_abspath, item):
+    '''
+    Removes every stage recorded for an item so that all of its stages run again
+    '''
+    if args.no_journal or not os.path.isfile(journal_abspath):
+        return
+    with contextlib.closing(open_journal(journal_abspath)) as connection, connection:
+        connection.execute('DELETE FROM stages WHERE item = ?', (item,))
+
+def journal_move(journal_abspath, item, old_folder, new_folder):
+    '''
+    Changes the outputs recorded for an item from one folder to another once they have been moved
+    The size and modification time of each moved output are taken from its new location
+    '''
+    if args.no_journal or not os.path.isfile(journal_abspath):
+        return
+    old_prefix = os.path.join(old_folder, '')
+    with contextlib.closing(open_journal(journal_abspath)) as connection, connection:
+        for stage, outputs in connection.execute('SELECT stage, outputs FROM stages WHERE item = ?', (item,)).fetchall():
+            moved_outputs = {}
+            for output_abspath, recorded in json.loads(outputs).items():
+                if output_abspath.startswith(old_prefix):
+                    output_abspath = os.path.join(new_folder, output_abspath[len(old_prefix):])
+                    if os.path.isfile(output_abspath):
+                        output_stat = os.stat(output_abspath)
+                        recorded = dict(recorded, size=output_stat.st_size, mtime=output_stat.st_mtime_ns)
+                moved_outputs[output_abspath] = recorded
+            connection.execute('UPDATE stages SET outputs = ? WHERE item = ? AND stage = ?', (json.dumps(moved_outputs), item, stage))
+
+def scratch_check(outdir):
+    '''
+    Checks that --scratch is a directory that exists and is not the output folder, and that --scratch_limit is valid
+    Returns the folder that item folders are created in: --scratch if it was given, otherwise the output folder
+    '''
+    if not args.scratch_path:
+        return outdir
+    if not os.path.isdir(args.scratch_path):
+        print('scratch is not a directory')
+        quit()
+    if os.path.realpath(args.scratch_path) == os.path.realpath(outdir):
+        print('scratch must be a different folder from the output folder')
+        quit()
+    if args.scratch_limit <= 0:
+        print("--scratch_limit must be more than 0")
+        quit()
+    return args.scratch_path
+
+#finished item folders are moved from --scratch to the output folder by one background thread,
+#so the next item is processed while the last one is being transferred
+transfer_executor = None
+transfer_futures = {}
+transfer_condition = threading.Condition()
+#bytes of scratch taken up by item folders that are waiting to be transferred or are being transferred
+transfer_pending_size = 0
+#bytes of scratch expected to be taken up by items that are still being processed, formatted as {item : bytes}
+scratch_reserved_sizes = {}
+
+def read_digest_sidecars(folder):
+    '''
+    Returns the checksums in the checksum sidecar files of a folder, formatted as {filename : {algorithm : checksum}}
+    '''
+    sidecar_digests = {}
+    for sidecar_name in os.listdir(folder):
+        digest_name = os.path.splitext(sidecar_name)[1][1:].lower()
+        if not digest_name in hashlib.algorithms_available:
+            continue
+        try:
+            with open(os.path.join(folder, sidecar_name)) as f:
+                checksum, filename = f.readline().rstrip('\n').split(' *', 1)
+        except (OSError, ValueError, UnicodeDecodeError):
+            continue
+        sidecar_digests.setdefault(filename, {})[digest_name] = checksum
+    return sidecar_digests
+
+def copy_verified(source_abspath, destination_abspath, known_digests=None):
+    '''
+    Copies a file to a temporary file next to the destination, reads the copy back and renames it into place if it matches
+    The checksums of the source are made from the same read that copies it and are checked against known_digests,
+    the checksums already made for the file, so nothing on scratch is read twice
+    Returns a list of problems, which is empty if the copy was checked and renamed into place
+    '''
+    if known_digests is None:
+        known_digests = {}
+    digest_names = list(known_digests) or ['md5']
+    source_digest = MultiDigest(digest_names)
+    temp_abspath = destination_abspath + '.' + str(os.getpid()) + '.tmp'
+    problems = []
+    try:
+        with open(temp_abspath, 'wb') as f:
+            for buf in read_blocks(source_abspath):
+                f.write(buf)
+                source_digest.update(buf)
+            f.flush()
+            os.fsync(f.fileno())
+            if hasattr(os, 'posix_fadvise'):
+                #the copy is dropped from the page cache so that it is read back from the destination instead of from memory
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        copy_digest = MultiDigest(digest_names)
+        for buf in read_blocks(temp_abspath):
+            copy_digest.update(buf)
+        source_digests = source_digest.hexdigests()
+        for digest_name in known_digests:
+            if source_digests[digest_name] != known_digests[digest_name]:
+                problems.append(source_abspath + " does not match its " + digest_name + " checksum")
+        if copy_digest.hexdigests() != source_digests:
+            problems.append(destination_abspath + " does not match the file on scratch")
+        if not problems:
+            shutil.copystat(source_abspath, temp_abspath)
+            os.replace(temp_abspath, destination_abspath)
+    finally:
+        #the temporary file is removed unless it was renamed into place, so a failed write doesn't leave it in the output folder
+        if os.path.exists(temp_abspath):
+            os.remove(temp_abspath)
+    return problems
+
+def transfer_item_folder(item, scratch_folder, output_folder, journal_abspath, folder_size):
+    '''
+    Moves an item folder from scratch to the output folder, checking every file once it has been copied
+    Outputs recorded in the journal are changed to their new location and the scratch folder is removed
+    If any file could not be copied or checked, the scratch folder is kept
+    Returns a short status for the batch summary
+    '''
+    global transfer_pending_size
+    problems = []
+    transferred_list = []
+    try:
+        print_message(item + ": transferring to", output_folder)
+        for folder, subfolders, files in os.walk(scratch_folder):
+            destination_folder = os.path.normpath(os.path.join(output_folder, os.path.relpath(folder, scratch_folder)))
+            os.makedirs(destination_folder, exist_ok=True)
+            sidecar_digests = read_digest_sidecars(folder)
+            for filename in sorted(files):
+                destination_abspath = os.path.join(destination_folder, filename)
+                problems += copy_verified(os.path.join(folder, filename), destination_abspath, sidecar_digests.get(filename, {}))
+                transferred_list.append(destination_abspath)
+        if not problems:
+            journal_move(journal_abspath, item, scratch_folder, output_folder)
+            journal_record(journal_abspath, item, 'transfer', transferred_list, {'output folder' : output_folder, 'files' : len(transferred_list)})
+            shutil.rmtree(scratch_folder)
+    except OSError as e:
+        problems.append(str(e))
+    finally:
+        with transfer_condition:
+            transfer_pending_size -= folder_size
+            transfer_condition.notify_all()
+    if problems:
+        for problem in problems:
+            print_message(item + ":", problem)
+        return "transfer failed, outputs kept in " + scratch_folder
+    print_message(item + ": transferred", len(transferred_list), "files to", output_folder)
+    return "transferred"
+
+def queue_transfer(item, scratch_folder, output_folder, journal_abspath):
+    '''
+    Queues an item folder to be moved from scratch to the output folder in the background
+    '''
+    global transfer_executor, transfer_pending_size
+    folder_size = 0
+    for folder, subfolders, files in os.walk(scratch_folder):
+        folder_size += sum(os.path.getsize(os.path.join(folder, name)) for name in files)
+    if transfer_executor is None:
+        transfer_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    with transfer_condition:
+        transfer_pending_size += folder_size
+        #the item's folder is now counted as a pending transfer in place of its expected size
+        scratch_reserved_sizes.pop(item, None)
+    transfer_futures[item] = transfer_executor.submit(transfer_item_folder, item, scratch_folder, output_folder, journal_abspath, folder_size)
+
+def wait_for_scratch_space(item, expected_size, block=True):
+    '''
+    Waits while item folders that have not been transferred yet, and the expected size of items that are still being processed,
+    would take up more than --scratch_limit GB of scratch with an item of expected_size added
+    The item's expected size is then counted until its folder is queued for transfer or release_scratch_space is called
+    It does not wait if nothing is left that could free up space, so an item larger than --scratch_limit still runs on its own
+    If block is False, returns False instead of waiting when there is not enough space. Otherwise returns True
+    '''
+    if not args.scratch_path:
+        return True
+    scratch_limit_size = args.scratch_limit * 1000**3
+    def has_space():
+        used_size = transfer_pending_size + sum(scratch_reserved_sizes.values())
+        return used_size + expected_size <= scratch_limit_size or not used_size
+    with transfer_condition:
+        if not has_space():
+            if not block:
+                return False
+            print_message("waiting for transfers to free up scratch space")
+        transfer_condition.wait_for(has_space)
+        scratch_reserved_sizes[item] = expected_size
+    return True
+
+def release_scratch_space(item):
+    '''
+    Stops counting the expected size of an item that has finished without being queued for transfer
+    '''
+    with transfer_condition:
+        if scratch_reserved_sizes.pop(item, None) is not None:
+            transfer_condition.notify_all()
+
+def finish_transfers():
+    '''
+    Waits for every queued transfer to finish and returns the status of each, formatted as {item : status}
+    '''
+    if transfer_futures:
+        print("*waiting for transfers to the output folder to finish*")
+    transfer_results = {}
+    for item, future in transfer_futures.items():
+        try:
+            transfer_results[item] = future.result()
+        except Exception as e:
+            transfer_results[item] = 'transfer error: ' + repr(e)
+    if transfer_executor:
+        transfer_executor.shutdown()
+    return transfer_results
+
+def stage_timing(start_time, input_list=None, output_list=None, frame_count=None):
+    '''
+    Returns the wall time of a stage that started at start_time, the bytes it read and wrote and its throughput
+    Bytes are counted from the sizes of the files (or folders) that the stage reads and writes
+    A byte count that is already known can be given in place of a path
+    '''
+    if input_list is None:
+        input_list = []
+    if output_list is None:
+        output_list = []
+    wall_time = time.time() - start_time
+    byte_counts = []
+    for path_list in (input_list, output_list):
+        byte_count = 0
+        for path in path_list:
+            if isinstance(path, int):
+                byte_count += path
+            elif os.path.isdir(path):
+                for folder, subfolders, files in os.walk(path):
+                    byte_count += sum(os.path.getsize(os.path.join(folder, name)) for name in files)
+            elif os.path.isfile(path):
+                byte_count += os.path.getsize(path)
+        byte_counts.append(byte_count)
+    timing = {
+    'wall time' : round(wall_time, 3),
+    'bytes read' : byte_counts[0],
+    'bytes written' : byte_counts[1],
+    'read MB/s' : round(byte_counts[0] / 1000**2 / wall_time, 2) if wall_time > 0 else None,
+    'write MB/s' : round(byte_counts[1] / 1000**2 / wall_time, 2) if wall_time > 0 else None
+    }
+    if frame_count:
+        timing['frames/s'] = round(frame_count / wall_time, 2) if wall_time > 0 else None
+    return timing
+
+def write_prometheus_metrics(metrics_abspath, tool, timing_dict, batch_time, tool_summary=None):
+    '''
+    Writes stage timings as a Prometheus text file that node_exporter's textfile collector can read
+    timing_dict is formatted as {item : {stage : timing}}
+    tool_summary is the resource usage of the external tools run by the batch, from batch_command_summary
+    '''
+    metric_list = [
+    ('transcode_stage_seconds', 'wall time', 'Wall time of a pipeline stage in seconds'),
+    ('transcode_stage_read_bytes', 'bytes read', 'Bytes read by a pipeline stage'),
+    ('transcode_stage_written_bytes', 'bytes written', 'Bytes written by a pipeline stage'),
+    ('transcode_stage_frames_per_second', 'frames/s', 'Frames processed per second by a pipeline stage')
+    ]
+    lines = []
+    for metric_name, timing_key, metric_help in metric_list:
+        lines.append('# HELP ' + metric_name + ' ' + metric_help)
+        lines.append('# TYPE ' + metric_name + ' gauge')
+        for item in sorted(timing_dict):
+            for stage, timing in timing_dict[item].items():
+                if timing.get(timing_key) is not None:
+                    labels = 'tool="%s",item="%s",stage="%s"' % tuple(value.replace('\\', '\\\\').replace('"', '\\"') for value in (tool, item, stage))
+                    lines.append(metric_name + '{' + labels + '} ' + str(timing[timing_key]))
+    lines.append('# HELP transcode_batch_seconds Wall time of the whole batch in seconds')
+    lines.append('# TYPE transcode_batch_seconds gauge')
+    lines.append('transcode_batch_seconds{tool="%s"} %s' % (tool, round(batch_time, 3)))
+    lines.append('# HELP transcode_batch_items Number of items processed in the batch')
+    lines.append('# TYPE transcode_batch_items gauge')
+    lines.append('transcode_batch_items{tool="%s"} %s' % (tool, len(timing_dict)))
+    tool_metric_list = [
+    ('transcode_tool_commands', 'commands', 'Number of times a tool was run'),
+    ('transcode_tool_failed_commands', 'failed', 'Number of times a tool exited with an error'),
+    ('transcode_tool_seconds', 'wall time', 'Total wall time of a tool in seconds'),
+    ('transcode_tool_user_cpu_seconds', 'user cpu', 'Total user CPU time of a tool in seconds'),
+    ('transcode_tool_system_cpu_seconds', 'system cpu', 'Total system CPU time of a tool in seconds'),
+    ('transcode_tool_peak_rss_megabytes', 'peak rss MB', 'Highest peak resident memory of a single run of a tool in MB')
+    ]
+    for metric_name, summary_key, metric_help in tool_metric_list:
+        if not tool_summary:
+            break
+        lines.append('# HELP ' + metric_name + ' ' + metric_help)
+        lines.append('# TYPE ' + metric_name + ' gauge')
+        for command_tool in sorted(tool_summary):
+            lines.append(metric_name + '{tool="%s",command="%s"} %s' % (tool, command_tool.replace('"', '\\"'), tool_summary[command_tool][summary_key]))
+    #node_exporter may read the file at any time, so it is written to a temporary file and renamed
+    temp_metrics_abspath = metrics_abspath + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_metrics_abspath, 'w', newline='\n') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_metrics_abspath, metrics_abspath)
@@ -8,9 +8,13 @@ import json
 import datetime
 import shutil
 import glob
+import time
+import threading
+import concurrent.futures
 from dpx2ffv1parameters import args
 import corefuncs
 import dpx2ffv1supportfuncs
+import dpx2ffv1preflight
 
 #TO DO: general clean up (improve readability by separating out some functions); merge avfuncs scripts between different transcode scripts where overlapping functions exist and separate format specific functions better
 
@@ -21,6 +25,8 @@ if sys.version_info[0] < 3:
 #expected folder/file structure is input/title/subfolder_identifier/title_0000001.dpx
 indir = corefuncs.input_check()
 outdir = corefuncs.output_check()
+#with --scratch each title's output folder is made on scratch and moved to the output folder once the title is finished
+stagingdir = corefuncs.scratch_check(outdir)
 #TO DO: allow running without subfolder identifier to support having the dpx files directly in the title folder?
 #set the subfolder_identifier. Defaults to 'pm' if not specified
 if not args.subfolder_identifier:
@@ -37,124 +43,298 @@ if args.filter_list:
 
     title_list = [item for item in title_list if item in filter_list]
 
-checklist = []
-for title in title_list:
-    if not limit or (limit) in title:
-        #currently the input folder name is fixed as input/title/pm for consistency in the structure of the RAWcooked data
-        if os.path.isdir(os.path.join(indir, title, subfolder_identifier)):
-            #TO DO: differentiate subfolder_identifier and dpx_subfolder_identifier
-            title_abspath = os.path.join(indir, title)
-            indirbase = os.path.join(title_abspath, subfolder_identifier)
-            outpathbase = os.path.join(outdir, title)
-            outpathfull = os.path.join(outpathbase, subfolder_identifier)
-            ffv1_name = os.path.join(title + '_' + subfolder_identifier + '.mkv')
-            framemd5_name = os.path.join(title + '_' + subfolder_identifier + '.framemd5')
-            mkv_abspath = os.path.join(outpathfull, ffv1_name)
-            framemd5_abspath = os.path.join(outpathfull, framemd5_name)
-            #TO DO: it may be better to make the default behavior be to just run rawcooked on title
-            #then you could add a flag where you specify pm folders if they exist
-
-            #TO DO check for md5 file in dpx folders
-            #if not found, generate and output to input folder
-
-            print('\n'"***Processing", title + "***" + '\n')
-
-            #gather system metadata
-            osinfo = platform.platform()
-            ffvers = corefuncs.get_ffmpeg_version()
-            rawcvers = corefuncs.get_rawcooked_version()
-            tstime = datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+#check that the numbers of parallel jobs are valid
+dpx2ffv1supportfuncs.check_jobs_arg()
+#check that the checksum algorithms are supported
+corefuncs.digests_check()
+
+#gather system metadata once for the batch
+osinfo = platform.platform()
+ffvers = corefuncs.get_ffmpeg_version()
+rawcvers = corefuncs.get_rawcooked_version()
+
+#finished stages of each title are recorded in the journal so that a batch can be run again after it stops partway through
+journal_abspath = corefuncs.journal_path(outdir)
+
+#stage timings of each title for the metrics file
+title_timings = {}
+batch_start_time = time.time()
+
+#limits for the title scheduler
+#rawcooked encodes are limited by --jobs and the steps that mostly read from disk (checksums, folder sizes) are limited by --io_jobs
+encode_slots = threading.BoundedSemaphore(args.jobs)
+io_slots = threading.BoundedSemaphore(args.io_jobs)
+
+def checksum_journal_lookup(title):
+    '''
+    Returns the journal entry of the checksum stage of a title
+    Returns None if it is not in the journal or was made with a different set of --digests, so that the checksums are made again
+    '''
+    checksum_journal = corefuncs.journal_lookup(journal_abspath, title, 'checksum')
+    if checksum_journal and set(checksum_journal['result'] or []) != set(corefuncs.digest_list()):
+        return None
+    return checksum_journal
 
-            #build and execute rawcooked command
-            rawcooked_command = [args.rawcooked_path, '--all', '--framemd5', '--framemd5-name', framemd5_abspath]
-            if args.framerate:
-                rawcooked_command += ['-framerate', args.framerate]
-            rawcooked_command += [indirbase, '-o', mkv_abspath]
-            #print(rawcooked_command)
-            rawcooked_results = subprocess.check_output(rawcooked_command).decode("ascii").rstrip()
+def process_title(title):
+    '''
+    Runs rawcooked on a title and creates the checksum and json sidecar for the output
+    Returns a short status for the batch summary
+    '''
+    #TO DO: differentiate subfolder_identifier and dpx_subfolder_identifier
+    title_abspath = os.path.join(indir, title)
+    indirbase = os.path.join(title_abspath, subfolder_identifier)
+    outpathbase = os.path.join(stagingdir, title)
+    outpathfull = os.path.join(outpathbase, subfolder_identifier)
+    ffv1_name = os.path.join(title + '_' + subfolder_identifier + '.mkv')
+    framemd5_name = os.path.join(title + '_' + subfolder_identifier + '.framemd5')
+    mkv_abspath = os.path.join(outpathfull, ffv1_name)
+    framemd5_abspath = os.path.join(outpathfull, framemd5_name)
+    rawcooked_log_abspath = os.path.join(outpathfull, title + '_' + subfolder_identifier + '_rawcooked.log')
+    #checksum sidecars are named after the title with the algorithm as the extension (.md5, .sha256, ...)
+    sidecar_base = os.path.join(outpathfull, title + '_' + subfolder_identifier)
+    json_abspath = os.path.join(outpathfull, title + '_pm.json')
+    stage_timings = {}
+    title_timings[title] = stage_timings
+    #commands run for this title are counted against it
+    corefuncs.set_command_item(title)
+    #TO DO: it may be better to make the default behavior be to just run rawcooked on title
+    #then you could add a flag where you specify pm folders if they exist
 
+    #skip titles that the journal shows were finished by an earlier run
+    if all(corefuncs.journal_lookup(journal_abspath, title, stage) for stage in ('rawcooked', 'json')) and checksum_journal_lookup(title):
+        corefuncs.print_message(title + ": already complete, found in journal")
+        return "complete (found in journal)"
+    if args.scratch_path and not os.path.isdir(outpathbase):
+        #stages recorded by an earlier run point at outputs that are not on scratch, so they all run again
+        corefuncs.journal_reset(journal_abspath, title)
+
+    #check the DPX sequence before spending time on the encode
+    if not args.skip_preflight:
+        with io_slots:
+            corefuncs.print_message(title + ": checking DPX sequence")
+            stage_start_time = time.time()
+            preflight_results = dpx2ffv1preflight.preflight_scan(indirbase)
+            stage_timings['preflight'] = corefuncs.stage_timing(stage_start_time, frame_count=preflight_results['frame count'])
+        if preflight_results['problems']:
+            for problem in preflight_results['problems']:
+                corefuncs.print_message(title + ":", problem)
+            return "failed pre-flight check"
+    else:
+        preflight_results = None
+
+    #wait for earlier titles to be transferred off scratch if they and the titles still running would take up more than --scratch_limit
+    #the size of the DPX sequence is used as the expected size of the title's outputs on scratch
+    if args.scratch_path:
+        corefuncs.wait_for_scratch_space(title, preflight_results['total size'] if preflight_results else dpx2ffv1supportfuncs.get_folder_size(indirbase))
+
+    #check for md5 file in dpx folders
+    #if not found, generate and output to input folder
+    if args.dpx_manifest:
+        with io_slots:
+            corefuncs.print_message(title + ": checking for md5 manifest")
+            #an existing manifest is reused, so the DPX files are only read if there isn't one that lists every file
+            stage_start_time = time.time()
+            dpx_manifest, manifest_created = dpx2ffv1supportfuncs.dpx_md5_manifest(indirbase, title + '_' + subfolder_identifier + '_dpx.md5')
+            stage_timings['dpx manifest'] = corefuncs.stage_timing(stage_start_time, [preflight_results['total size'] if preflight_results else indirbase] if manifest_created else [], [dpx_manifest] if manifest_created else [])
+    else:
+        dpx_manifest = None
+
+    rawcooked_journal = corefuncs.journal_lookup(journal_abspath, title, 'rawcooked')
+    if rawcooked_journal:
+        corefuncs.print_message(title + ": skipping rawcooked, found in journal")
+        tstime = rawcooked_journal['result']['tstime']
+        tftime = rawcooked_journal['result']['tftime']
+        if rawcooked_journal['timing']:
+            stage_timings['rawcooked'] = rawcooked_journal['timing']
+        with open(rawcooked_log_abspath) as f:
+            rawcooked_results = f.read().rstrip()
+    else:
+        #rawcooked will not overwrite outputs, so outputs left by a run of this batch that stopped partway through are removed
+        if corefuncs.journal_lookup(journal_abspath, title, 'rawcooked started'):
+            for incomplete_abspath in (mkv_abspath, framemd5_abspath):
+                if os.path.isfile(incomplete_abspath):
+                    corefuncs.print_message(title + ": removing incomplete output", incomplete_abspath)
+                    os.remove(incomplete_abspath)
+        #every later stage depends on the mkv, so they all run again
+        corefuncs.journal_reset(journal_abspath, title)
+        corefuncs.journal_record(journal_abspath, title, 'rawcooked started')
+
+        #build and execute rawcooked command
+        rawcooked_command = [args.rawcooked_path, '--all', '--framemd5', '--framemd5-name', framemd5_abspath]
+        if args.framerate:
+            rawcooked_command += ['-framerate', args.framerate]
+        rawcooked_command += [indirbase, '-o', mkv_abspath]
+        #print(rawcooked_command)
+        with encode_slots:
+            corefuncs.print_message("***Processing", title + "***")
+            tstime = datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+            stage_start_time = time.time()
+            #rawcooked output is buffered so that titles running at the same time do not mix their output
+            rawcooked_process = corefuncs.run_command(rawcooked_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
             #log transcode finish time
             tftime = datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+        rawcooked_results = rawcooked_process.stdout.decode("ascii", errors="replace").rstrip()
+        os.makedirs(outpathfull, exist_ok=True)
+        with open(rawcooked_log_abspath, 'w', newline='\n') as f:
+            print(rawcooked_results, file=f)
+        if rawcooked_process.returncode != 0:
+            corefuncs.print_message(title + ": rawcooked exited with an error. See", rawcooked_log_abspath)
+            return "rawcooked error"
+        stage_timings['rawcooked'] = corefuncs.stage_timing(stage_start_time, [preflight_results['total size'] if preflight_results else indirbase], [mkv_abspath, framemd5_abspath], preflight_results['frame count'] if preflight_results else None)
+        corefuncs.journal_record(journal_abspath, title, 'rawcooked', [mkv_abspath, framemd5_abspath, rawcooked_log_abspath], {'tstime' : tstime, 'tftime' : tftime}, timing=stage_timings['rawcooked'])
 
-            #if output exists, create an md5checksum
-            if os.path.isfile(mkv_abspath):
-                mkvhash = dpx2ffv1supportfuncs.hashlib_md5(mkv_abspath)
-            else:
-                mkvhash = None
-            #write md5 checksum to md5 file
-            with open (os.path.join(outpathfull, title + '_' + subfolder_identifier + '.md5'), 'w',  newline='\n') as f:
-                print(mkvhash, '*' + ffv1_name, file=f)
-
-            data = {}
-            data[title] = []
-            metadict = { 'system information': {
-            'operating system': osinfo,
-            'ffmpeg version': ffvers,
-            'rawcooked version': rawcvers,
-            'transcode start time': tstime,
-            'transcode end time': tftime
-            }}
-
-            attachments = dpx2ffv1supportfuncs.list_mkv_attachments(mkv_abspath)
-            format_metadict = dpx2ffv1supportfuncs.get_mkv_format_metadata(mkv_abspath)
-            video_metadict = dpx2ffv1supportfuncs.get_mkv_video_metadata(mkv_abspath)
-            audio_metadict = dpx2ffv1supportfuncs.get_mkv_audio_metadata(mkv_abspath)
-            #note that the size is output in bytes.  This can be converted to MiB by dividing by 1024**2 or GiB by dividing by 1024**3
+    checksum_journal = checksum_journal_lookup(title)
+    if checksum_journal:
+        mkv_digests = checksum_journal['result']
+        if checksum_journal['timing']:
+            stage_timings['checksum'] = checksum_journal['timing']
+    else:
+        stage_start_time = time.time()
+        #if output exists, create a checksum for each algorithm in --digests from one read of the file
+        if os.path.isfile(mkv_abspath):
+            with io_slots:
+                corefuncs.print_message(title + ": creating checksum")
+                mkv_digests = corefuncs.hashlib_digests(mkv_abspath)
+        else:
+            mkv_digests = {digest_name : None for digest_name in corefuncs.digest_list()}
+        #write each checksum to its sidecar file (.md5, .sha256, ...)
+        corefuncs.write_digest_sidecars(mkv_digests, ffv1_name, sidecar_base)
+        sidecar_list = corefuncs.digest_sidecar_list(sidecar_base)
+        stage_timings['checksum'] = corefuncs.stage_timing(stage_start_time, [mkv_abspath], sidecar_list)
+        corefuncs.journal_record(journal_abspath, title, 'checksum', sidecar_list + [mkv_abspath], mkv_digests, {mkv_abspath : mkv_digests['md5']}, stage_timings['checksum'])
+
+    data = {}
+    data[title] = []
+    metadict = { 'system information': {
+    'operating system': osinfo,
+    'ffmpeg version': ffvers,
+    'rawcooked version': rawcvers,
+    'transcode start time': tstime,
+    'transcode end time': tftime
+    }}
+
+    stage_start_time = time.time()
+    attachments = dpx2ffv1supportfuncs.list_mkv_attachments(mkv_abspath)
+    format_metadict = dpx2ffv1supportfuncs.get_mkv_format_metadata(mkv_abspath)
+    video_metadict = dpx2ffv1supportfuncs.get_mkv_video_metadata(mkv_abspath)
+    audio_metadict = dpx2ffv1supportfuncs.get_mkv_audio_metadata(mkv_abspath)
+    #note that the size is output in bytes.  This can be converted to MiB by dividing by 1024**2 or GiB by dividing by 1024**3
+    with io_slots:
+        #the pre-flight scan already added up the size of the DPX folder
+        if preflight_results:
+            dpxsize = preflight_results['total size']
+        else:
             dpxsize = dpx2ffv1supportfuncs.get_folder_size(os.path.join(indir, title, subfolder_identifier))
-            #log ffv1 (folder) size
-            mkvsize = dpx2ffv1supportfuncs.get_folder_size(outpathfull)
-            pm_runtime = format_metadict.get('format')['duration']
-            post_transcode_dict = { 'post-transcode metadata': {
-            'filename': ffv1_name,
-            'md5 checksum': mkvhash,
-            'duration' : pm_runtime,
-            'streams' : format_metadict.get('format')['nb_streams'],
-            'compressed size': mkvsize,
-            'uncompressed size': dpxsize
-            }}
-            video_dict = {'video': {
-            'video streams': [stream.get('codec_name') for stream in (video_metadict['streams'])],
-            'framerate': [stream.get('r_frame_rate') for stream in (video_metadict['streams'])][0],
-            'width': [stream.get('width') for stream in (video_metadict['streams'])][0],
-            'height': [stream.get('height') for stream in (video_metadict['streams'])][0],
-            'sample_aspect_ratio': [stream.get('sample_aspect_ratio') for stream in (video_metadict['streams'])][0],
-            'display_aspect_ratio': [stream.get('display_aspect_ratio') for stream in (video_metadict['streams'])][0],
-            'pixel format': [stream.get('pix_fmt') for stream in (video_metadict['streams'])][0]
-            }}
-            audio_dict = {'audio': {
-            'audio codecs': [stream.get('codec_long_name') for stream in (audio_metadict['streams'])],
-            'audio bitrate': [stream.get('bits_per_raw_sample') for stream in (audio_metadict['streams'])],
-            'audio sample rate': [stream.get('sample_rate') for stream in (audio_metadict['streams'])],
-            'audio channels': [stream.get('channels') for stream in (audio_metadict['streams'])]
-            }}
-            data_dict = {'data': {
-            'attachments': attachments
-            }}
-            output_technical_metadata = {'technical metadata': [video_dict, audio_dict, data_dict]}
-            post_transcode_dict.update(output_technical_metadata)
-            metadict.update(post_transcode_dict)
-            data[title].append(metadict)
-            with open(os.path.join(outpathfull, title + '_pm.json'), 'w', newline='\n') as outfile:
-                json.dump(data, outfile, indent=4)
-
-            #compare runtimes between the ac and pm files
-            #TO DO - write to csv file in base output directory rather than txt file
-            if args.check_runtime:
-                #It may be a good idea to format the runtime outputs as sets or lists
-                ac_runtime = dpx2ffv1supportfuncs.grab_runtime(title_abspath, 'ac', 'mp4')
-                #pm_runtime = dpx2ffv1supportfuncs.grab_runtime(outpathbase, subfolder_identifier, 'mkv')
-
-                with open(os.path.join(indir, os.path.join(outpathfull, 'verification_log.txt')), 'a',  newline='\n') as f:
-                    print(rawcooked_results, file=f)
-                    print('\n'"Access Copy Runtime:", file=f)
-                    print(ac_runtime, file=f)
-                    print('\n'"Preservation Master Runtime:", file=f)
-                    print(pm_runtime, file=f)
-
-        elif not os.path.isdir(os.path.join(indir, title, 'pm')):
-            print('no pm folder in input directory')
-    elif limit and not (limit) in title:
-        print(title, 'does not contain ', limit)
+        #log ffv1 (folder) size
+        mkvsize = dpx2ffv1supportfuncs.get_folder_size(outpathfull)
+    pm_runtime = format_metadict.get('format')['duration']
+    post_transcode_dict = { 'post-transcode metadata': {
+    'filename': ffv1_name,
+    'md5 checksum': mkv_digests['md5'],
+    'dpx md5 manifest': dpx_manifest,
+    'duration' : pm_runtime,
+    'streams' : format_metadict.get('format')['nb_streams'],
+    'compressed size': mkvsize,
+    'uncompressed size': dpxsize,
+    'dpx frame count': preflight_results['frame count'] if preflight_results else None
+    }}
+    video_dict = {'video': {
+    'video streams': [stream.get('codec_name') for stream in (video_metadict['streams'])],
+    'framerate': [stream.get('r_frame_rate') for stream in (video_metadict['streams'])][0],
+    'width': [stream.get('width') for stream in (video_metadict['streams'])][0],
+    'height': [stream.get('height') for stream in (video_metadict['streams'])][0],
+    'sample_aspect_ratio': [stream.get('sample_aspect_ratio') for stream in (video_metadict['streams'])][0],
+    'display_aspect_ratio': [stream.get('display_aspect_ratio') for stream in (video_metadict['streams'])][0],
+    'pixel format': [stream.get('pix_fmt') for stream in (video_metadict['streams'])][0]
+    }}
+    audio_dict = {'audio': {
+    'audio codecs': [stream.get('codec_long_name') for stream in (audio_metadict['streams'])],
+    'audio bitrate': [stream.get('bits_per_raw_sample') for stream in (audio_metadict['streams'])],
+    'audio sample rate': [stream.get('sample_rate') for stream in (audio_metadict['streams'])],
+    'audio channels': [stream.get('channels') for stream in (audio_metadict['streams'])]
+    }}
+    data_dict = {'data': {
+    'attachments': attachments
+    }}
+    output_technical_metadata = {'technical metadata': [video_dict, audio_dict, data_dict]}
+    post_transcode_dict.update(output_technical_metadata)
+    #checksums made with --digests are added next to the md5
+    for digest_name in mkv_digests:
+        if digest_name != 'md5':
+            post_transcode_dict['post-transcode metadata'][digest_name + ' checksum'] = mkv_digests[digest_name]
+    metadict.update(post_transcode_dict)
+    stage_timings['output metadata'] = corefuncs.stage_timing(stage_start_time)
+    #wall time, bytes read and written and throughput of each stage
+    metadict['stage timings'] = stage_timings
+    #number of runs, CPU time and peak memory use of each external tool
+    metadict['tool usage'] = corefuncs.item_command_summary(title, clear=False)
+    data[title].append(metadict)
+    stage_start_time = time.time()
+    with open(json_abspath, 'w', newline='\n') as outfile:
+        json.dump(data, outfile, indent=4)
+    stage_timings['json'] = corefuncs.stage_timing(stage_start_time, [], [json_abspath])
+    corefuncs.journal_record(journal_abspath, title, 'json', [json_abspath], timing=stage_timings['json'])
+
+    #compare runtimes between the ac and pm files
+    #TO DO - write to csv file in base output directory rather than txt file
+    if args.check_runtime:
+        #It may be a good idea to format the runtime outputs as sets or lists
+        ac_runtime = dpx2ffv1supportfuncs.grab_runtime(title_abspath, 'ac', 'mp4')
+        #pm_runtime = dpx2ffv1supportfuncs.grab_runtime(outpathbase, subfolder_identifier, 'mkv')
+
+        with open(os.path.join(indir, os.path.join(outpathfull, 'verification_log.txt')), 'a',  newline='\n') as f:
+            print(rawcooked_results, file=f)
+            print('\n'"Access Copy Runtime:", file=f)
+            print(ac_runtime, file=f)
+            print('\n'"Preservation Master Runtime:", file=f)
+            print(pm_runtime, file=f)
+    return "complete"
+
+checklist = []
+if not (args.verifymkv or args.decodeffv1):
+    scheduled_titles = []
+    for title in title_list:
+        if not limit or (limit) in title:
+            #currently the input folder name is fixed as input/title/pm for consistency in the structure of the RAWcooked data
+            if os.path.isdir(os.path.join(indir, title, subfolder_identifier)):
+                scheduled_titles.append(title)
+            elif not os.path.isdir(os.path.join(indir, title, 'pm')):
+                print('no pm folder in input directory')
+        elif limit and not (limit) in title:
+            print(title, 'does not contain ', limit)
+
+    #run titles in parallel. The pool has room for every encode and io slot so that titles that are checksumming don't hold up encodes
+    title_results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs + args.io_jobs) as executor:
+        future_dict = {executor.submit(process_title, title) : title for title in scheduled_titles}
+        for future in concurrent.futures.as_completed(future_dict):
+            title = future_dict[future]
+            try:
+                title_results[title] = future.result()
+            except Exception as e:
+                title_results[title] = 'error: ' + repr(e)
+            corefuncs.print_message(title + ":", title_results[title])
+            #finished titles are moved from scratch to the output folder in the background while other titles are processed
+            if args.scratch_path and title_results[title].startswith('complete') and os.path.isdir(os.path.join(stagingdir, title)):
+                corefuncs.queue_transfer(title, os.path.join(stagingdir, title), os.path.join(outdir, title), journal_abspath)
+            corefuncs.release_scratch_space(title)
+
+    if args.scratch_path:
+        for title, transfer_status in corefuncs.finish_transfers().items():
+            title_results[title] += ', ' + transfer_status
+        for title in title_results:
+            if not title_results[title].startswith('complete') and os.path.isdir(os.path.join(stagingdir, title)):
+                title_results[title] += ', outputs kept in ' + os.path.join(stagingdir, title)
+
+    if title_results:
+        print('\n' + "***Batch summary***")
+        for title in sorted(title_results):
+            print(title + ":", title_results[title])
+    #every title's commands are still recorded, along with the tool checks counted against the batch
+    batch_tool_usage = corefuncs.batch_command_summary([corefuncs.item_command_summary(item) for item in list(corefuncs.command_records)])
+    corefuncs.print_command_summary(batch_tool_usage)
+    if args.metrics_file:
+        corefuncs.write_prometheus_metrics(args.metrics_file, 'dpx2ffv1', {title : stage_timings for title, stage_timings in title_timings.items() if stage_timings}, time.time() - batch_start_time, batch_tool_usage)
 
 #TO DO - replace verification check with simply writing PASS/FAIL outputs to a CSV file
 if checklist:
@@ -162,39 +342,51 @@ if checklist:
     for i in checklist:
         dpx2ffv1supportfuncs.verification_check(i)
 
-#if args.verifylossless:
-    #for *.mkv run ffprobe to check if file contains a rawcooked reversibility file
-    #if so, funnel into rawcooked decode pathway
-
-#TO DO - move this to supportfuncs and rewrite it for the new version of rawcooked
-if args.decodeffv1:
-    indir = corefuncs.input_check()
-    outdir = corefuncs.output_check()
-    limit = dpx2ffv1supportfuncs.assign_limit()
-    corefuncs.input_check(indir)
-
-    #TO DO: make sure terminology is consistent across script (i.e. title vs object_folder)
-    for object_folder in os.listdir(indir):
-        dpxverifolder = os.path.join(outdir, object_folder, object_folder + '_dpx')
-        #TO DO: add check for more than one mkv file
-        if not limit or (limit) in object_folder:
-            if os.path.isdir(os.path.join(indir, object_folder)):
-                print ('\n', "FOLDER: ", os.path.join(object_folder))
-                mkv_file = glob.glob1(os.path.join(indir, object_folder, 'pm'), "*.mkv")
-                mkvcounter = len(mkv_file)
-                if mkvcounter == 1:
-                    for i in mkv_file:
-                        ffv1_file_abspath = os.path.join(indir, object_folder, 'pm', i)
-                        mkvsize = dpx2ffv1avfuncs.get_folder_size(os.path.join(indir, object_folder, 'pm'))
-                        subprocess.call([args.rawcooked_path, ffv1_file_abspath, '-o', dpxverifolder])
-                        #may want to allow passing an md5 file or md5 data into dpx_md5_compare so that the md5 doesn't have to be embedded
-                        dpxsize = dpx2ffv1avfuncs.get_folder_size(os.path.join(dpxverifolder, 'pm'))
-                        #compareset, orig_md5list = dpx2ffv1avfuncs.dpx_md5_compare(os.path.join(dpxverifolder, 'pm'))
-                        print ("mkv folder size:", mkvsize)
-                        print ("DPX folder size:", dpxsize)
-                elif mkvcounter < 1:
-                    print ("No mkv files found in", os.path.join(indir, object_folder))
-                elif mkvcounter > 1:
-                    print ("More than 1 mkv file found in", os.path.join(indir, object_folder))
-        elif limit and not (limit) in object_folder:
-            print("Skipped", object_folder)
+#verify that mkv files can be decoded back to the original DPX sequence without writing the DPX files to disk
+#--decodeffv1 is kept as another name for --verifymkv
+if args.verifymkv or args.decodeffv1:
+    verification_list = []
+    for title in title_list:
+        if not limit or (limit) in title:
+            mkv_files = glob.glob1(os.path.join(indir, title, subfolder_identifier), "*.mkv")
+            if len(mkv_files) == 1:
+                mkv_abspath = os.path.join(indir, title, subfolder_identifier, mkv_files[0])
+                verification_list.append((title, mkv_abspath, os.path.splitext(mkv_abspath)[0] + '.framemd5'))
+            elif len(mkv_files) < 1:
+                print("No mkv files found in", os.path.join(indir, title, subfolder_identifier))
+            else:
+                print("More than 1 mkv file found in", os.path.join(indir, title, subfolder_identifier))
+        elif limit and not (limit) in title:
+            print("Skipped", title)
+
+    def verify_title(title, mkv_abspath, framemd5_abspath):
+        '''
+        Verifies the mkv file of a title and adds the resource usage of the tools it ran to the results
+        '''
+        corefuncs.set_command_item(title)
+        title_results = dpx2ffv1supportfuncs.verify_mkv(mkv_abspath, framemd5_abspath, os.path.join(outdir, title))
+        title_results['tool usage'] = corefuncs.item_command_summary(title)
+        return title_results
+
+    verification_results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        future_dict = {executor.submit(verify_title, title, mkv_abspath, framemd5_abspath) : title for title, mkv_abspath, framemd5_abspath in verification_list}
+        for future in concurrent.futures.as_completed(future_dict):
+            title = future_dict[future]
+            try:
+                verification_results[title] = future.result()
+            except Exception as e:
+                verification_results[title] = {'status' : 'error: ' + repr(e)}
+            corefuncs.print_message(title + ":", verification_results[title]['status'])
+
+    if verification_results:
+        print('\n' + "***Verification summary***")
+        for title in sorted(verification_results):
+            title_results = verification_results[title]
+            print(title + ":", title_results['status'])
+            if 'rawcooked check' in title_results:
+                print('\t' + "rawcooked check:", title_results['rawcooked check'])
+                print('\t' + "framemd5 check:", title_results['framemd5 check'])
+                if title_results['framemd5 comparison']:
+                    print('\t' + "frames compared:", title_results['framemd5 comparison']['frames compared'])
+        corefuncs.print_command_summary(corefuncs.batch_command_summary([title_results['tool usage'] for title_results in verification_results.values() if 'tool usage' in title_results]))
@@ -2,6 +2,7 @@
 
 import argparse
 import sys
+import os
 
 parser = argparse.ArgumentParser()
 
@@ -15,14 +16,22 @@ parser.add_argument('--input', '-i', action='store', dest='input_path', type=str
 parser.add_argument('--output', '-o', action='store', dest='output_path', type=str, help='full path to output folder')
 parser.add_argument('--subfolder_identifier', action='store', dest='subfolder_identifier', type=str, help='Specifies the folder identifier if files are located in a subfolder. For example, a pm folder within an object folder.')
 parser.add_argument('--limit', action='store', dest='textlimit', type=str, help='Defines a string that limits which folders batch commands run on.  If not used, commands will run on all immediate subdirectories of the input')
+parser.add_argument('--jobs', '-j', action='store', dest='jobs', default=1, type=int, help='Number of titles that rawcooked can encode at the same time. Default is 1')
+parser.add_argument('--io_jobs', action='store', dest='io_jobs', default=1, type=int, help='Number of titles that can be checksummed or measured at the same time. These steps mostly read from disk. Default is 1')
+parser.add_argument('--hash_jobs', action='store', dest='hash_jobs', default=4, type=int, help='Number of DPX files that are hashed at the same time when creating or checking md5 manifests. Default is 4')
+parser.add_argument('--scan_jobs', action='store', dest='scan_jobs', default=8, type=int, help='Number of DPX headers that are read at the same time during the pre-flight check. Default is 8')
 parser.add_argument('--filter_list', action='store', dest='filter_list', type=str, help='Pull list of files to process from a text file')
 
 
+parser.add_argument('--skip_preflight', required=False, action='store_true', help='Skip checking each DPX sequence for missing frames, frames with an unexpected size and frames with different resolution, bit depth or frame rate before encoding')
+parser.add_argument('--dpx_manifest', required=False, action='store_true', help='Before encoding, create an md5 manifest of the DPX files in each input subfolder if it does not already have one. The manifest is saved in the subfolder so rawcooked stores it in the mkv file')
+parser.add_argument('--digests', action='store', dest='digests', default='md5', type=str, help='Comma separated list of checksum algorithms for the mkv file, for example md5,sha256,blake2b. Every checksum is made from the same read of the file and written to its own sidecar file. md5 is always included. Default is md5')
+parser.add_argument('--read_block_size', action='store', dest='read_block_size', default=4, type=int, help='Size in MiB of the blocks that files are read in when they are checksummed (mkv files and DPX files for md5 manifests). Default is 4')
+parser.add_argument('--keep_page_cache', required=False, action='store_true', dest='keep_page_cache', help='Leave files that have been checksummed in the page cache. By default they are dropped from the cache as they are read so that they do not push out data that other programs are using')
+parser.add_argument('--direct_io', required=False, action='store_true', dest='direct_io', help='Read files that are checksummed with O_DIRECT (F_NOCACHE on macOS) so they do not go through the page cache at all. Falls back to normal reads on filesystems that do not support it')
 parser.add_argument('--dpxcheck', action='store', dest='dpxcheck_path', type=str, help='Full path to a location where DPX files will be decoded from FFV1 files.  If left blank, this will default to the folder where the FFV1 file being decoded is located.')
-#TO DO: implement ffv1 decode
-parser.add_argument('--decodeffv1', required=False, action='store_true', help='For each folder in input, generate a decode the FFV1 file back to a dpx sequence, check md5 checksums and compare file size of FFV1 file and DPX sequence')
-#TO DO: implement mkv verification
-parser.add_argument('--verifymkv', required=False, action='store_true', help='')
+parser.add_argument('--decodeffv1', required=False, action='store_true', help='Same as --verifymkv')
+parser.add_argument('--verifymkv', required=False, action='store_true', help='For each folder in input, check that the mkv file in the subfolder decodes back to the original DPX sequence without writing DPX files to disk. Runs rawcooked --check and compares the decoded frames against the framemd5 file made during the transcode if it is present. Reports are written to the output folder. Use --jobs to verify more than one title at a time')
 
 
 parser.add_argument('--check_runtime', action='store_true', required=False, help='checks ffv1 runtime against access copy runtime after transcode')
@@ -33,4 +42,14 @@ parser.add_argument('--rawcooked', action='store', dest='rawcooked_path', defaul
 parser.add_argument('--ffmpeg', action='store', dest='ffmpeg_path', default='ffmpeg', type=str, help='The full path to ffmpeg. Use if you need to specify a custom path to ffmpeg.')
 parser.add_argument('--ffprobe', action='store', dest='ffprobe_path', default='ffprobe', type=str, help='The full path to ffprobe. Use if you need to specify a custom path to ffprobe.')
 
+parser.add_argument('--probe_cache', action='store', dest='probe_cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'transcoding_scripts', 'ffprobe'), type=str, help='Folder where ffprobe results are cached between runs. Defaults to .cache/transcoding_scripts/ffprobe in the home folder')
+parser.add_argument('--no_probe_cache', required=False, action='store_true', dest='no_probe_cache', help='Do not read or write the ffprobe cache')
+parser.add_argument('--ffprobe_mkv', required=False, action='store_true', dest='ffprobe_mkv', help='Use ffprobe for the metadata of MKV files. By default the Matroska header, Info, Tracks, Tags and Attachments are read directly and ffprobe is only used for MKVs with codecs or layouts the reader does not handle')
+parser.add_argument('--tool_cache', action='store', dest='tool_cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'transcoding_scripts', 'tools.json'), type=str, help='File where the versions of ffmpeg, rawcooked and other tools are cached between runs. Entries are refreshed when a tool is replaced. Defaults to .cache/transcoding_scripts/tools.json in the home folder')
+parser.add_argument('--no_tool_cache', required=False, action='store_true', dest='no_tool_cache', help='Do not read or write the tool cache')
+parser.add_argument('--no_journal', required=False, action='store_true', dest='no_journal', help='Do not use the job journal (transcode_journal.sqlite in the output folder). By default, finished stages are recorded in the journal and skipped when the batch is run again, as long as their outputs are unchanged')
+parser.add_argument('--scratch', action='store', dest='scratch_path', type=str, help='Fast local folder where each title is encoded and checked before its output folder is moved to the output folder. Each finished output folder is copied in the background while the next title is processed, and every copied file is read back and checked against its checksums before the scratch copy is removed')
+parser.add_argument('--scratch_limit', action='store', dest='scratch_limit', default=100, type=float, help='With --scratch, new titles wait to start while output folders that have not been transferred yet, together with the titles still being processed, would take up more than this many GB of scratch. The size of the DPX sequence of a title is used as the size of its outputs until they are transferred. Default is 100')
+parser.add_argument('--metrics_file', action='store', dest='metrics_file', type=str, help='Write the wall time, bytes read and written and throughput of every stage to this file in the Prometheus text format, for example a .prom file in the node_exporter textfile collector folder')
+
 args = parser.parse_args()
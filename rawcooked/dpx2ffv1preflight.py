@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import mmap
+import math
+import struct
+import concurrent.futures
+from dpx2ffv1parameters import args
+
+#byte offsets of the DPX header fields that are checked
+#the image information header starts at 768, the film header at 1664 and the television header at 1920
+DPX_HEADER_SIZE = 2048
+DPX_WIDTH_OFFSET = 772
+DPX_HEIGHT_OFFSET = 776
+DPX_DESCRIPTOR_OFFSET = 800
+DPX_BIT_DEPTH_OFFSET = 803
+DPX_FILM_FRAME_RATE_OFFSET = 1724
+DPX_TV_FRAME_RATE_OFFSET = 1940
+
+def read_dpx_header(dpx_abspath):
+    '''
+    Reads the resolution, bit depth and frame rate from a DPX header
+    Only the header pages of the file are mapped into memory
+    Returns a dictionary with an error message if the header can't be read
+    '''
+    try:
+        with open(dpx_abspath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < DPX_HEADER_SIZE:
+                return {'error': 'file is too small to contain a DPX header'}
+            with mmap.mmap(f.fileno(), DPX_HEADER_SIZE, access=mmap.ACCESS_READ) as header:
+                magic = header[0:4]
+                #the magic number is SDPX in big endian files and XPDS in little endian files
+                if magic == b'SDPX':
+                    endian = '>'
+                elif magic == b'XPDS':
+                    endian = '<'
+                else:
+                    return {'error': 'not a DPX file'}
+                width, height = struct.unpack_from(endian + 'II', header, DPX_WIDTH_OFFSET)
+                descriptor = header[DPX_DESCRIPTOR_OFFSET]
+                bit_depth = header[DPX_BIT_DEPTH_OFFSET]
+                frame_rate = None
+                for offset in (DPX_FILM_FRAME_RATE_OFFSET, DPX_TV_FRAME_RATE_OFFSET):
+                    rate = struct.unpack_from(endian + 'f', header, offset)[0]
+                    #undefined fields are filled with 0xFF bytes, which read as NaN
+                    if not math.isnan(rate) and rate > 0:
+                        frame_rate = round(rate, 3)
+                        break
+    except (OSError, ValueError) as e:
+        #the file could not be read, or it was truncated after its size was checked
+        return {'error': 'unable to read DPX header: ' + str(e)}
+    return {'width': width, 'height': height, 'descriptor': descriptor, 'bit depth': bit_depth, 'frame rate': frame_rate}
+
+def scan_folder(folder):
+    '''
+    Walks a folder once with scandir
+    Returns a list of (path, size) for every file and the total size of the folder
+    '''
+    file_list = []
+    total_size = 0
+    folder_stack = [folder]
+    while folder_stack:
+        with os.scandir(folder_stack.pop()) as d:
+            for entry in d:
+                try:
+                    if entry.is_dir():
+                        folder_stack.append(entry.path)
+                    else:
+                        file_size = entry.stat().st_size
+                        file_list.append((entry.path, file_size))
+                        total_size += file_size
+                except FileNotFoundError:
+                    #file was deleted during scandir
+                    pass
+    return file_list, total_size
+
+def find_gaps(frame_numbers):
+    '''
+    Returns the missing ranges in a list of frame numbers as strings like "101-105"
+    '''
+    gaps = []
+    frame_numbers = sorted(frame_numbers)
+    for previous, current in zip(frame_numbers, frame_numbers[1:]):
+        if current - previous > 1:
+            if current - previous == 2:
+                gaps.append(str(previous + 1))
+            else:
+                gaps.append(str(previous + 1) + '-' + str(current - 1))
+    return gaps
+
+def preflight_scan(dpxfolder):
+    '''
+    Checks a DPX sequence before it is encoded
+    Collects the total size, frame count, gaps in the frame numbers and frames whose size is different from the rest
+    DPX headers are read in parallel to check that resolution, bit depth and frame rate are the same for every frame
+    Returns a dictionary of the results. Problems that should stop the title from being encoded are listed under 'problems'
+    '''
+    file_list, total_size = scan_folder(dpxfolder)
+    dpx_list = sorted((path, size) for path, size in file_list if path.lower().endswith('.dpx'))
+    problems = []
+    preflight_results = {
+    'total size': total_size,
+    'frame count': len(dpx_list),
+    'missing frames': [],
+    'size outliers': [],
+    'header values': {},
+    'problems': problems
+    }
+    if not dpx_list:
+        problems.append('no DPX files found')
+        return preflight_results
+
+    #frame numbers are the digits at the end of the filename. Each subfolder is numbered separately
+    sequences = {}
+    for path, size in dpx_list:
+        frame_match = re.search(r'(\d+)$', os.path.splitext(os.path.basename(path))[0])
+        if frame_match:
+            sequences.setdefault(os.path.dirname(path), []).append(int(frame_match.group(1)))
+        else:
+            problems.append('no frame number in ' + os.path.basename(path))
+    for sequence_folder in sorted(sequences):
+        gaps = find_gaps(sequences[sequence_folder])
+        preflight_results['missing frames'] += gaps
+        if gaps:
+            #a sequence directly in the DPX folder is named after the folder instead of '.'
+            sequence_name = os.path.relpath(sequence_folder, dpxfolder)
+            if sequence_name == os.curdir:
+                sequence_name = os.path.basename(os.path.normpath(dpxfolder))
+            problems.append(str(len(gaps)) + ' gaps in frame numbers in ' + sequence_name + ': ' + ', '.join(gaps[:10]))
+
+    #uncompressed frames should all be the same size, so a frame that is more than 1% off of the most common size is likely truncated or damaged
+    size_counts = {}
+    for path, size in dpx_list:
+        size_counts[size] = size_counts.get(size, 0) + 1
+    common_size = max(size_counts, key=size_counts.get)
+    preflight_results['size outliers'] = [os.path.basename(path) for path, size in dpx_list if abs(size - common_size) > common_size / 100]
+    if preflight_results['size outliers']:
+        problems.append(str(len(preflight_results['size outliers'])) + ' frames with an unexpected size: ' + ', '.join(preflight_results['size outliers'][:10]))
+
+    header_values = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.scan_jobs) as executor:
+        for (path, size), header in zip(dpx_list, executor.map(read_dpx_header, [path for path, size in dpx_list])):
+            if 'error' in header:
+                problems.append(os.path.basename(path) + ': ' + header['error'])
+                continue
+            for key, value in header.items():
+                header_values.setdefault(key, {}).setdefault(value, 0)
+                header_values[key][value] += 1
+    for key, value_counts in header_values.items():
+        if len(value_counts) == 1:
+            preflight_results['header values'][key] = list(value_counts)[0]
+        else:
+            preflight_results['header values'][key] = sorted(value_counts, key=str)
+            problems.append('frames have different ' + key + ' values: ' + ', '.join(str(value) + ' (' + str(count) + ' frames)' for value, count in value_counts.items()))
+    return preflight_results
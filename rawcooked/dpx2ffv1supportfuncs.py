@@ -1,16 +1,17 @@
 #!/usr/bin/env python3
 
 import os
-import sys
 import hashlib
 import subprocess
 import platform
-import json
 import datetime
 import glob
 import shutil
 import posixpath
+import time
+import concurrent.futures
 from dpx2ffv1parameters import args
+import corefuncs
 
 def assign_limit():
     if args.textlimit:
@@ -19,6 +20,11 @@ def assign_limit():
         limit = None
     return limit
 
+def check_jobs_arg():
+    if args.jobs < 1 or args.io_jobs < 1 or args.hash_jobs < 1 or args.scan_jobs < 1:
+        print("The number of jobs must be 1 or more")
+        quit()
+
 def get_immediate_subdirectories(folder):
     '''
     get list of immediate subdirectories of input
@@ -29,28 +35,67 @@ def get_immediate_subdirectories(folder):
 def hashlib_md5(filename):
     '''
     Uses hashlib to return an MD5 checksum of an input filename
+    Shares corefuncs.hashlib_digests, which can also create other checksums from the same read
+    '''
+    return corefuncs.hashlib_md5(filename)
+
+def quiet_md5(filename):
+    '''
+    Returns the MD5 checksum and size of a file without printing progress
+    Used when many files are hashed at the same time
     '''
-    read_size = 0
-    last_percent_done = 0
     chksm = hashlib.md5()
-    total_size = os.path.getsize(filename)
-    with open(filename, 'rb') as f:
-        while True:
-            #2**20 is for reading the file in 1 MiB chunks
-            buf = f.read(2**20)
-            if not buf:
-                break
-            read_size += len(buf)
-            chksm.update(buf)
-            percent_done = 100 * read_size / total_size
-            if percent_done > last_percent_done:
-                sys.stdout.write('[%d%%]\r' % percent_done)
-                sys.stdout.flush()
-                last_percent_done = percent_done
-    md5_output = chksm.hexdigest()
-    return md5_output
-#this function is from the IFI's scripts with a minor change
-#open(str(filename)), 'rb') as f has been changed to open(filename, 'rb') as f
+    file_size = 0
+    for buf in corefuncs.read_blocks(filename):
+        file_size += len(buf)
+        chksm.update(buf)
+    return chksm.hexdigest(), file_size
+
+def hash_files(file_list, max_workers):
+    '''
+    Hashes a list of files with a thread pool. hashlib releases the GIL while hashing so the threads run in parallel
+    Returns a dictionary of {filename: md5}, the total number of bytes read and the time taken in seconds
+    '''
+    start_time = time.time()
+    hash_dict = {}
+    total_size = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for filename, (md5, file_size) in zip(file_list, executor.map(quiet_md5, file_list)):
+            hash_dict[filename] = md5
+            total_size += file_size
+    return hash_dict, total_size, time.time() - start_time
+
+def dpx_md5_manifest(dpxfolder, manifest_name):
+    '''
+    Looks for an md5 manifest in a DPX folder and creates one if none is found
+    Only the files at the top of the folder are listed, as rawcooked expects the sequence to be directly in the folder
+    An existing manifest is only reused if it has one entry for each of those files
+    Returns the path to the manifest and whether it was created
+    '''
+    #remove partial manifests left by an interrupted run so they aren't hashed or encoded as part of the sequence
+    for stale_manifest in glob.glob1(dpxfolder, '*.md5.tmp'):
+        os.remove(os.path.join(dpxfolder, stale_manifest))
+    file_list = sorted(entry.path for entry in os.scandir(dpxfolder) if entry.is_file() and not entry.name.endswith(('.md5', '.md5.tmp', '.xml')))
+    #a manifest made by an earlier run is checked first
+    existing_manifests = sorted(glob.glob1(dpxfolder, '*.md5'), key=lambda name: name != manifest_name)
+    for existing_manifest in existing_manifests:
+        existing_abspath = os.path.join(dpxfolder, existing_manifest)
+        with open(existing_abspath) as f:
+            entry_count = sum(1 for line in f if line.strip())
+        if entry_count == len(file_list):
+            corefuncs.print_message("using existing md5 manifest", existing_abspath)
+            return existing_abspath, False
+        corefuncs.print_message("not using md5 manifest", existing_abspath + ",", "it has", entry_count, "entries for", len(file_list), "files")
+    hash_dict, total_size, hash_time = hash_files(file_list, args.hash_jobs)
+    manifest_abspath = os.path.join(dpxfolder, manifest_name)
+    #write to a temporary file first so that an interrupted run doesn't leave a partial manifest to be reused
+    temp_manifest_abspath = manifest_abspath + '.tmp'
+    with open(temp_manifest_abspath, 'w', newline='\n') as f:
+        for filename in file_list:
+            print(hash_dict[filename], '*' + os.path.basename(filename), file=f)
+    os.replace(temp_manifest_abspath, manifest_abspath)
+    corefuncs.print_message("created md5 manifest for %d files (%.2f GiB) in %s in %.1f seconds, %.1f MiB/s" % (len(file_list), total_size / 1024**3, dpxfolder, hash_time, total_size / 1024**2 / max(hash_time, 0.001)))
+    return manifest_abspath, True
 
 def get_folder_size(folder):
     '''
@@ -80,8 +125,7 @@ def dpx2ffv1_ffprobe_report(input_abspath):
 
 def list_mkv_attachments(input_file_abspath):
     #could also identify with -select streams m:filename
-    t_probe_out = json.loads(subprocess.check_output([args.ffprobe_path, '-v', 'error', '-select_streams', 't', '-show_entries', 'stream_tags=filename', input_file_abspath, '-of', 'json']).decode("ascii").rstrip())
-    tags = [streams.get('tags') for streams in (t_probe_out['streams'])]
+    tags = [streams.get('tags', {}) for streams in corefuncs.ffprobe_streams(input_file_abspath, 'attachment')]
     attachment_list = []
     for i in tags:
         filename = [i.get('filename')]
@@ -89,24 +133,15 @@ def list_mkv_attachments(input_file_abspath):
     return attachment_list
 
 def get_mkv_video_metadata(input_file_abspath):
-    ffprobe_command = [args.ffprobe_path, '-v', 'error', '-select_streams', 'v',]
-    ffprobe_command += ['-show_entries', 'stream=codec_name,width,height,pix_fmt,sample_aspect_ratio,display_aspect_ratio,r_frame_rate']
-    ffprobe_command += [input_file_abspath, '-of', 'json']
-    video_meta_out = json.loads(subprocess.check_output(ffprobe_command).decode("ascii").rstrip())
+    video_meta_out = {'streams' : corefuncs.ffprobe_streams(input_file_abspath, 'video')}
     return video_meta_out
 
 def get_mkv_audio_metadata(input_file_abspath):
-    ffprobe_command = [args.ffprobe_path, '-v', 'error', '-select_streams', 'a',]
-    ffprobe_command += ['-show_entries', 'stream=codec_long_name,bits_per_raw_sample,sample_rate,channels']
-    ffprobe_command += [input_file_abspath, '-of', 'json']
-    audio_meta_out = json.loads(subprocess.check_output(ffprobe_command).decode("ascii").rstrip())
+    audio_meta_out = {'streams' : corefuncs.ffprobe_streams(input_file_abspath, 'audio')}
     return audio_meta_out
 
 def get_mkv_format_metadata(input_file_abspath):
-    ffprobe_command = [args.ffprobe_path, '-v', 'error']
-    ffprobe_command += ['-show_entries', 'format=duration,nb_streams']
-    ffprobe_command += [input_file_abspath, '-of', 'json']
-    format_meta_out = json.loads(subprocess.check_output(ffprobe_command).decode("ascii").rstrip())
+    format_meta_out = {'format' : corefuncs.ffprobe_json(input_file_abspath)['format']}
     return format_meta_out
 
 def dpx_md5_compare(dpxfolder):
@@ -117,6 +152,7 @@ def dpx_md5_compare(dpxfolder):
     '''
     md5list = []
     orig_md5list = {}
+    file_list = []
     for i in os.listdir(dpxfolder):
         abspath = os.path.join(dpxfolder, i)
         if i.endswith(".md5"):
@@ -124,12 +160,148 @@ def dpx_md5_compare(dpxfolder):
         elif i.endswith(".xml"):
             pass
         else:
-            y = hashlib_md5(abspath)
-            filehash = y + ' *' + i
-            md5list.append(filehash)
+            file_list.append(abspath)
+    hash_dict, total_size, hash_time = hash_files(file_list, args.hash_jobs)
+    for abspath in file_list:
+        filehash = hash_dict[abspath] + ' *' + os.path.basename(abspath)
+        md5list.append(filehash)
     compareset = set(md5list)
     return compareset, orig_md5list
 
+def read_framemd5(framemd5_lines, time_bases, media_type=None):
+    '''
+    Yields the frame entries of framemd5 output one line at a time
+    framemd5_lines can be an open file or the stdout of an ffmpeg process
+    Time bases from the header are added to the time_bases dictionary as they are read
+    If media_type is given, only the frames of streams of that type are yielded
+    Stream 0 is taken to be video if the header does not give the type of each stream
+    '''
+    media_types = {}
+    for line in framemd5_lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#tb'):
+            #header format is "#tb 0: 1/24"
+            stream, tb = line[3:].split(':')
+            num, den = tb.strip().split('/')
+            time_bases[int(stream)] = (int(num), int(den))
+        elif line.startswith('#media_type'):
+            #header format is "#media_type 0: video"
+            stream, stream_type = line[11:].split(':')
+            media_types[int(stream)] = stream_type.strip()
+        elif not line.startswith('#'):
+            stream, dts, pts, duration, size, hash = [field.strip() for field in line.split(',')]
+            if media_type and media_types.get(int(stream), 'video' if int(stream) == 0 else None) != media_type:
+                continue
+            yield int(stream), int(pts), size, hash
+
+def compare_framemd5(source_lines, output_lines, source_name, report_abspath, print_limit=10, media_type=None):
+    '''
+    Compares two sets of framemd5 lines in lockstep without loading either into memory
+    Every frame that does not match is written to a report file with its frame number and timestamp
+    Only the stream, frame size and hash are compared since the DPX sequence and the mkv file use different time bases
+    If media_type is given, only streams of that type are compared
+    Returns a dictionary summarizing the comparison
+    '''
+    source_time_bases = {}
+    output_time_bases = {}
+    source_frames = read_framemd5(source_lines, source_time_bases, media_type)
+    output_frames = read_framemd5(output_lines, output_time_bases, media_type)
+    frame_counters = {}
+    frames_compared = 0
+    mismatch_count = 0
+    missing_frames = 0
+    extra_frames = 0
+    report = None
+    try:
+        while True:
+            source_frame = next(source_frames, None)
+            output_frame = next(output_frames, None)
+            if source_frame is None and output_frame is None:
+                break
+            if source_frame is None:
+                extra_frames += 1
+                continue
+            if output_frame is None:
+                missing_frames += 1
+                continue
+            stream, pts, size, hash = source_frame
+            frame_number = frame_counters.get(stream, 0)
+            frame_counters[stream] = frame_number + 1
+            frames_compared += 1
+            if output_frame[0] != stream or output_frame[2] != size or output_frame[3] != hash:
+                mismatch_count += 1
+                num, den = source_time_bases.get(stream, (0, 1))
+                mismatch = 'stream ' + str(stream) + ', frame ' + str(frame_number) + ', pts ' + str(pts) + ', time ' + '%.3f' % (pts * num / den) + 's'
+                if report is None:
+                    report = open(report_abspath, 'w', newline='\n')
+                    print('frames that do not match between', source_name, 'and the decoded mkv file', file=report)
+                print(mismatch, file=report)
+                if mismatch_count <= print_limit:
+                    corefuncs.print_message('\tframe checksum mismatch:', mismatch)
+    finally:
+        if report:
+            report.close()
+    if mismatch_count > print_limit:
+        corefuncs.print_message('\t' + str(mismatch_count - print_limit), 'more mismatched frames. See', report_abspath)
+    framemd5_comparison = {
+    'frames compared' : frames_compared,
+    'mismatched frames' : mismatch_count,
+    'frames missing from output' : missing_frames,
+    'extra frames in output' : extra_frames,
+    'mismatch report' : report_abspath if report else None
+    }
+    return framemd5_comparison
+
+def verify_mkv(mkv_abspath, framemd5_abspath, report_folder):
+    '''
+    Checks that an mkv file made by rawcooked decodes back to the original DPX sequence without writing the DPX files to disk
+    rawcooked --check compares the decoded files against the checksums rawcooked embedded in the mkv file
+    If the framemd5 made during the transcode is present, the frames that ffmpeg decodes are also compared against it one frame at a time
+    Returns a dictionary of the results
+    '''
+    mkv_name = os.path.splitext(os.path.basename(mkv_abspath))[0]
+    rawcooked_log_abspath = os.path.join(report_folder, mkv_name + '_rawcooked_check.log')
+    ffmpeg_log_abspath = os.path.join(report_folder, mkv_name + '_ffmpeg_decode.log')
+    report_abspath = os.path.join(report_folder, mkv_name + '_framemd5_mismatches.txt')
+    os.makedirs(report_folder, exist_ok=True)
+    verification_results = {'mkv file' : mkv_abspath}
+    #both processes read the mkv file at the same time so that it only has to come off of the disk once
+    #tool output goes to logs in the report folder so that titles verified at the same time do not mix their output
+    with open(rawcooked_log_abspath, 'w', newline='\n') as rawcooked_log, open(ffmpeg_log_abspath, 'w', newline='\n') as ffmpeg_log:
+        start_time = time.time()
+        rawcooked_process = corefuncs.AccountedPopen([args.rawcooked_path, '--check', mkv_abspath], stdout=rawcooked_log, stderr=subprocess.STDOUT)
+        if os.path.isfile(framemd5_abspath):
+            ffmpeg_process = corefuncs.AccountedPopen([args.ffmpeg_path, '-loglevel', 'error', '-i', mkv_abspath, '-map', '0:v', '-f', 'framemd5', '-'], stdout=subprocess.PIPE, stderr=ffmpeg_log, universal_newlines=True)
+            with open(framemd5_abspath) as source_lines:
+                #only the video is decoded, so frames of any audio streams in the framemd5 made during the transcode are left out
+                verification_results['framemd5 comparison'] = compare_framemd5(source_lines, ffmpeg_process.stdout, os.path.basename(framemd5_abspath), report_abspath, media_type='video')
+            ffmpeg_process.stdout.close()
+            ffmpeg_process.wait()
+            corefuncs.record_command(ffmpeg_process, start_time)
+            if ffmpeg_process.returncode != 0:
+                verification_results['framemd5 comparison']['decode error'] = True
+        else:
+            verification_results['framemd5 comparison'] = None
+        rawcooked_process.wait()
+        corefuncs.record_command(rawcooked_process, start_time)
+    verification_results['rawcooked check'] = 'PASS' if rawcooked_process.returncode == 0 else 'FAIL'
+    verification_results['rawcooked log'] = rawcooked_log_abspath
+    framemd5_comparison = verification_results['framemd5 comparison']
+    if framemd5_comparison is None:
+        framemd5_status = 'NO FRAMEMD5'
+    elif framemd5_comparison.get('decode error') or framemd5_comparison['mismatched frames'] or framemd5_comparison['frames missing from output'] or framemd5_comparison['extra frames in output']:
+        framemd5_status = 'FAIL'
+    else:
+        framemd5_status = 'PASS'
+    verification_results['framemd5 check'] = framemd5_status
+    if verification_results['rawcooked check'] == 'PASS' and framemd5_status != 'FAIL':
+        verification_results['status'] = 'PASS'
+    else:
+        verification_results['status'] = 'FAIL'
+    return verification_results
+
 def grab_runtime(folder, subfolder_identifier, filetype):
     '''
     Look for an ac folder containing an video file of specified type
@@ -142,7 +314,7 @@ def grab_runtime(folder, subfolder_identifier, filetype):
         if filecounter == 1:
             for i in videofile:
                 file_abspath = os.path.join(itemfolder, i)
-                runtime = subprocess.check_output([args.ffprobe_path, '-v', 'error', file_abspath, '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1']).decode("ascii").rstrip()
+                runtime = corefuncs.ffprobe_json(file_abspath)['format'].get('duration')
                 #this returns the total runtime in seconds
         elif filecounter < 1:
             runtime = "no " + filetype + "files found in " + itemfolder